@@ -0,0 +1 @@
+default_app_config = 'pdata_app.apps.PdataAppConfig'
@@ -0,0 +1,11 @@
+from __future__ import unicode_literals, division, absolute_import
+
+from django.apps import AppConfig
+
+
+class PdataAppConfig(AppConfig):
+    name = 'pdata_app'
+
+    def ready(self):
+        # connect the signal handlers
+        import pdata_app.signals  # noqa
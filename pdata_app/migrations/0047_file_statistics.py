@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pdata_app', '0046_variablerequest_out_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataRequestStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('num_files', models.IntegerField(default=0, verbose_name='# Data Files')),
+                ('total_size', models.BigIntegerField(default=0, verbose_name='Data Size')),
+                ('num_online', models.IntegerField(default=0, verbose_name='# Files Online')),
+                ('num_offline', models.IntegerField(default=0, verbose_name='# Files Offline')),
+                ('num_issues', models.IntegerField(default=0, verbose_name='# Data Issues')),
+                ('earliest_time', models.FloatField(blank=True, null=True, verbose_name='Earliest time')),
+                ('latest_time', models.FloatField(blank=True, null=True, verbose_name='Latest time')),
+                ('earliest_date', models.CharField(blank=True, max_length=20, null=True, verbose_name='Earliest date')),
+                ('latest_date', models.CharField(blank=True, max_length=20, null=True, verbose_name='Latest date')),
+                ('file_versions', models.TextField(blank=True, null=True, verbose_name='File versions')),
+                ('tape_urls', models.TextField(blank=True, null=True, verbose_name='Tape URLs')),
+                ('date_updated', models.DateTimeField(auto_now=True, verbose_name='Date Updated')),
+                ('data_request', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='statistics', to='pdata_app.DataRequest', verbose_name='Data Request')),
+            ],
+            options={
+                'verbose_name': 'Data Request Statistics',
+                'verbose_name_plural': 'Data Request Statistics',
+            },
+        ),
+        migrations.CreateModel(
+            name='DataSubmissionStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('num_files', models.IntegerField(default=0, verbose_name='# Data Files')),
+                ('total_size', models.BigIntegerField(default=0, verbose_name='Data Size')),
+                ('num_online', models.IntegerField(default=0, verbose_name='# Files Online')),
+                ('num_offline', models.IntegerField(default=0, verbose_name='# Files Offline')),
+                ('num_issues', models.IntegerField(default=0, verbose_name='# Data Issues')),
+                ('earliest_time', models.FloatField(blank=True, null=True, verbose_name='Earliest time')),
+                ('latest_time', models.FloatField(blank=True, null=True, verbose_name='Latest time')),
+                ('earliest_date', models.CharField(blank=True, max_length=20, null=True, verbose_name='Earliest date')),
+                ('latest_date', models.CharField(blank=True, max_length=20, null=True, verbose_name='Latest date')),
+                ('file_versions', models.TextField(blank=True, null=True, verbose_name='File versions')),
+                ('tape_urls', models.TextField(blank=True, null=True, verbose_name='Tape URLs')),
+                ('date_updated', models.DateTimeField(auto_now=True, verbose_name='Date Updated')),
+                ('data_submission', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='statistics', to='pdata_app.DataSubmission', verbose_name='Data Submission')),
+            ],
+            options={
+                'verbose_name': 'Data Submission Statistics',
+                'verbose_name_plural': 'Data Submission Statistics',
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pdata_app', '0047_file_statistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datafile',
+            name='start_year',
+            field=models.IntegerField(blank=True, db_index=True, null=True, verbose_name='Start year'),
+        ),
+        migrations.AddField(
+            model_name='datafile',
+            name='end_year',
+            field=models.IntegerField(blank=True, db_index=True, null=True, verbose_name='End year'),
+        ),
+        migrations.AddField(
+            model_name='replacedfile',
+            name='start_year',
+            field=models.IntegerField(blank=True, db_index=True, null=True, verbose_name='Start year'),
+        ),
+        migrations.AddField(
+            model_name='replacedfile',
+            name='end_year',
+            field=models.IntegerField(blank=True, db_index=True, null=True, verbose_name='End year'),
+        ),
+    ]
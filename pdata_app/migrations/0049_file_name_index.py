@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pdata_app', '0048_datafile_years'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='datafile',
+            name='name',
+            field=models.CharField(db_index=True, max_length=200, verbose_name='File name'),
+        ),
+        migrations.AlterField(
+            model_name='replacedfile',
+            name='name',
+            field=models.CharField(db_index=True, max_length=200, verbose_name='File name'),
+        ),
+    ]
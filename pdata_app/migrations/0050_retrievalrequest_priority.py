@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pdata_app', '0049_file_name_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='retrievalrequest',
+            name='priority',
+            field=models.IntegerField(default=0, verbose_name='Priority'),
+        ),
+    ]
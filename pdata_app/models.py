@@ -4,13 +4,14 @@ import re
 import cf_units
 
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from solo.models import SingletonModel
 from django.db.models import PROTECT, SET_NULL, CASCADE
 from django.core.exceptions import ValidationError
 
-from pdata_app.utils.common import standardise_time_unit, safe_strftime
+from pdata_app.utils.common import (standardise_time_unit, safe_strftime,
+                                    calculate_file_years)
 from vocabs import (STATUS_VALUES, ESGF_STATUSES, FREQUENCY_VALUES,
                     ONLINE_STATUS, CHECKSUM_TYPES, VARIABLE_TYPES, CALENDARS)
 
@@ -18,7 +19,8 @@ model_names = ['Project', 'Institute', 'ClimateModel', 'Experiment',
                'ActivityId', 'DataSubmission', 'DataFile', 'ESGFDataset',
                'CEDADataset', 'DataRequest', 'DataIssue', 'Checksum',
                'Settings', 'VariableRequest', 'RetrievalRequest', 'EmailQueue',
-               'ReplacedFile', 'ObservationDataset', 'ObservationFile']
+               'ReplacedFile', 'ObservationDataset', 'ObservationFile',
+               'DataRequestStatistics', 'DataSubmissionStatistics']
 __all__ = model_names
 
 
@@ -247,56 +249,22 @@ class DataFileAggregationBase(models.Model):
     def start_time(self):
         std_units = Settings.get_solo().standard_time_units
 
-        start_times = self.datafile_set.values_list('start_time', 'time_units',
-            'calendar')
+        earliest, _latest = _time_limits(self.datafile_set.all(), std_units)
 
-        if not start_times:
+        if not earliest:
             return None
 
-        std_times = [
-            (standardise_time_unit(time, unit, std_units, cal), cal)
-            for time, unit, cal in start_times
-        ]
-
-        none_values_removed = [(std_time, cal)
-                               for std_time, cal in std_times
-                               if std_time is not None]
-
-        if not none_values_removed:
-            return None
-
-        earliest_time, calendar = min(none_values_removed, key=lambda x: x[0])
-
-        earliest_obj = cf_units.num2date(earliest_time, std_units, calendar)
-
-        return earliest_obj.strftime('%Y-%m-%d')
+        return _time_string(earliest[0], std_units, earliest[1])
 
     def end_time(self):
         std_units = Settings.get_solo().standard_time_units
 
-        end_times = self.datafile_set.values_list('end_time', 'time_units',
-            'calendar')
+        _earliest, latest = _time_limits(self.datafile_set.all(), std_units)
 
-        if not end_times:
+        if not latest:
             return None
 
-        std_times = [
-            (standardise_time_unit(time, unit, std_units, cal), cal)
-            for time, unit, cal in end_times
-        ]
-
-        none_values_removed = [(std_time, cal)
-                               for std_time, cal in std_times
-                               if std_time is not None]
-
-        if not none_values_removed:
-            return None
-
-        latest_time, calendar = max(none_values_removed, key=lambda x: x[0])
-
-        latest_obj = cf_units.num2date(latest_time, std_units, calendar)
-
-        return latest_obj.strftime('%Y-%m-%d')
+        return _time_string(latest[0], std_units, latest[1])
 
     def online_status(self):
         """
@@ -576,7 +544,7 @@ class DataFile(models.Model):
     # DataIssues: DataIssue - multiple is OK
 
     name = models.CharField(max_length=200, verbose_name="File name",
-                            null=False, blank=False)
+                            null=False, blank=False, db_index=True)
     incoming_name = models.CharField(max_length=200,
                                      verbose_name="Original file name",
                                      null=False, blank=False)
@@ -623,6 +591,12 @@ class DataFile(models.Model):
     time_units = models.CharField(verbose_name='Time units', max_length=50, null=True, blank=True)
     calendar = models.CharField(verbose_name='Calendar', max_length=20,
         null=True, blank=True, choices=list(CALENDARS.items()))
+    # The years that the data starts and ends in, which are calculated from
+    # the times when the file is saved
+    start_year = models.IntegerField(verbose_name='Start year', null=True,
+                                     blank=True, db_index=True)
+    end_year = models.IntegerField(verbose_name='End year', null=True,
+                                   blank=True, db_index=True)
 
     data_submission = models.ForeignKey(DataSubmission, null=False, blank=False,
         on_delete=CASCADE)
@@ -644,6 +618,32 @@ class DataFile(models.Model):
     online = models.BooleanField(default=True, verbose_name="Is the file online?", null=False, blank=False)
     tape_url = models.CharField(verbose_name="Tape URL", max_length=200, null=True, blank=True)
 
+    # The fields that the DataRequest and DataSubmission statistics are
+    # calculated from
+    statistics_fields = ('data_request_id', 'data_submission_id', 'size',
+                         'online', 'version', 'tape_url', 'start_time',
+                         'end_time', 'time_units', 'calendar')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(DataFile, cls).from_db(db, field_names, values)
+        # remember the values loaded so that changes can be found when saved
+        instance._loaded_values = instance.get_statistics_values()
+        return instance
+
+    def save(self, *args, **kwargs):
+        _set_file_years(self, kwargs)
+        super(DataFile, self).save(*args, **kwargs)
+
+    def get_statistics_values(self):
+        """
+        :returns: a dictionary of the current values of the fields in
+            `statistics_fields`. Any fields deferred when the object was
+            loaded are not included.
+        """
+        return {field: self.__dict__[field]
+                for field in self.statistics_fields if field in self.__dict__}
+
     def start_date_string(self):
         """Return a string containing the start date"""
         dto = cf_units.num2date(self.start_time, self.time_units, self.calendar)
@@ -667,7 +667,7 @@ class ReplacedFile(models.Model):
     An old DataFile that has been replaced by another DataFile
     """
     name = models.CharField(max_length=200, verbose_name="File name",
-                            null=False, blank=False)
+                            null=False, blank=False, db_index=True)
     incoming_directory = models.CharField(max_length=500,
                                           verbose_name="Incoming directory",
                                           null=False, blank=False)
@@ -714,6 +714,12 @@ class ReplacedFile(models.Model):
     calendar = models.CharField(verbose_name='Calendar', max_length=20,
                                 null=True, blank=True,
                                 choices=list(CALENDARS.items()))
+    # The years that the data starts and ends in, which are calculated from
+    # the times when the file is saved
+    start_year = models.IntegerField(verbose_name='Start year', null=True,
+                                     blank=True, db_index=True)
+    end_year = models.IntegerField(verbose_name='End year', null=True,
+                                   blank=True, db_index=True)
 
     data_submission = models.ForeignKey(DataSubmission,
                                         null=False, blank=False,
@@ -729,6 +735,10 @@ class ReplacedFile(models.Model):
                                      choices=list(CHECKSUM_TYPES.items()),
                                      null=True, blank=True)
 
+    def save(self, *args, **kwargs):
+        _set_file_years(self, kwargs)
+        super(ReplacedFile, self).save(*args, **kwargs)
+
     def start_date_string(self):
         """Return a string containing the start date"""
         dto = cf_units.num2date(self.start_time, self.time_units,
@@ -808,6 +818,296 @@ class TapeChecksum(models.Model):
                                 self.data_file.name)
 
 
+class FileStatisticsBase(models.Model):
+    """
+    An abstract base class for a denormalised summary of the DataFiles that
+    belong to a parent object.
+
+    Calculating these values from the DataFiles each time that a page is
+    displayed is slow and so they are stored here and kept up to date by the
+    signal handlers in pdata_app.signals. `recalculate()` rebuilds the
+    summary from scratch.
+    """
+    class Meta:
+        abstract = True
+
+    # The name of the foreign key from DataFile to the parent object
+    parent_field = None
+
+    num_files = models.IntegerField(verbose_name='# Data Files', default=0,
+                                    null=False, blank=False)
+    total_size = models.BigIntegerField(verbose_name='Data Size', default=0,
+                                        null=False, blank=False)
+    num_online = models.IntegerField(verbose_name='# Files Online', default=0,
+                                     null=False, blank=False)
+    num_offline = models.IntegerField(verbose_name='# Files Offline',
+                                      default=0, null=False, blank=False)
+    num_issues = models.IntegerField(verbose_name='# Data Issues', default=0,
+                                     null=False, blank=False)
+    # Times are in the standard time units from Settings
+    earliest_time = models.FloatField(verbose_name='Earliest time',
+                                      null=True, blank=True)
+    latest_time = models.FloatField(verbose_name='Latest time',
+                                    null=True, blank=True)
+    earliest_date = models.CharField(verbose_name='Earliest date',
+                                     max_length=20, null=True, blank=True)
+    latest_date = models.CharField(verbose_name='Latest date',
+                                   max_length=20, null=True, blank=True)
+    # Comma separated lists of the distinct values
+    file_versions = models.TextField(verbose_name='File versions',
+                                     null=True, blank=True)
+    tape_urls = models.TextField(verbose_name='Tape URLs',
+                                 null=True, blank=True)
+    date_updated = models.DateTimeField(auto_now=True,
+                                        verbose_name='Date Updated')
+
+    def get_data_files(self):
+        """
+        :returns: a QuerySet of all of the parent object's DataFiles
+        """
+        return DataFile.objects.filter(
+            **{self.parent_field: getattr(self, self.parent_field + '_id')})
+
+    def get_data_issues(self):
+        """
+        :returns: a QuerySet of the distinct DataIssues attached to any of the
+            parent object's DataFiles
+        """
+        return DataIssue.objects.filter(
+            **{'data_file__' + self.parent_field:
+               getattr(self, self.parent_field + '_id')}).distinct()
+
+    def online_status(self):
+        """
+        Returns one of:
+            ONLINE_STATUS.online
+            ONLINE_STATUS.offline
+            ONLINE_STATUS.partial
+        """
+        if self.num_offline:
+            if self.num_online:
+                return ONLINE_STATUS.partial
+            else:
+                return ONLINE_STATUS.offline
+        else:
+            return ONLINE_STATUS.online
+
+    def start_time(self):
+        return self.earliest_date
+
+    def end_time(self):
+        return self.latest_date
+
+    def get_tape_urls(self):
+        return _split_list(self.tape_urls)
+
+    def get_file_versions(self):
+        return _split_list(self.file_versions)
+
+    def recalculate(self, std_units=None, save=True):
+        """
+        Calculate all of the statistics from the parent's DataFiles and save
+        them.
+
+        :param str std_units: the standard time units, which are loaded from
+            Settings if not specified
+        :param bool save: if False then the statistics are only calculated
+            and aren't saved
+        """
+        data_files = self.get_data_files().order_by()
+        totals = data_files.aggregate(
+            num_files=models.Count('id'),
+            total_size=models.Sum('size'),
+            num_online=models.Count('id', filter=models.Q(online=True)),
+            num_offline=models.Count('id', filter=models.Q(online=False))
+        )
+        self.num_files = totals['num_files']
+        self.total_size = totals['total_size'] or 0
+        self.num_online = totals['num_online']
+        self.num_offline = totals['num_offline']
+        self.num_issues = self.get_data_issues().count()
+        self.file_versions = _join_list(
+            data_files.values_list('version', flat=True).distinct())
+        self.tape_urls = _join_list(
+            data_files.values_list('tape_url', flat=True).distinct())
+        self._calculate_times(std_units)
+        if save:
+            self.save()
+
+    def recalculate_issues(self):
+        """
+        Count the distinct DataIssues attached to the parent's DataFiles and
+        save just this field.
+        """
+        self.num_issues = self.get_data_issues().count()
+        type(self).objects.filter(pk=self.pk).update(
+            num_issues=self.num_issues
+        )
+
+    def apply_change(self, old=None, new=None, std_units=None):
+        """
+        Incrementally update the statistics after a DataFile belonging to
+        the parent has been created, changed or deleted. The changes are
+        applied to the database with update() so that simultaneous changes
+        from different processes do not overwrite each other.
+
+        :param dict old: the DataFile's tracked values before the change, or
+            None if the file has just been created
+        :param dict new: the DataFile's tracked values after the change, or
+            None if the file has been deleted
+        :param str std_units: the standard time units, which are loaded from
+            Settings if not specified
+        """
+        this_stats = type(self).objects.filter(pk=self.pk)
+
+        deltas = {}
+        for field, value in _file_contribution(new).items():
+            deltas[field] = value - _file_contribution(old)[field]
+        deltas = {field: models.F(field) + value
+                  for field, value in deltas.items() if value}
+        if deltas:
+            this_stats.update(**deltas)
+
+        for field, stats_field in (('version', 'file_versions'),
+                                   ('tape_url', 'tape_urls')):
+            old_value = old[field] if old else None
+            new_value = new[field] if new else None
+            if old_value == new_value:
+                continue
+            if new_value:
+                self._add_to_list(stats_field, new_value)
+            if old_value and not self.get_data_files().filter(
+                    **{field: old_value}).exists():
+                self._remove_from_list(stats_field, old_value)
+
+        if std_units is None:
+            std_units = Settings.get_solo().standard_time_units
+        old_start, old_end = _standard_times(old, std_units)
+        new_start, new_end = _standard_times(new, std_units)
+        if (old_start, old_end) == (new_start, new_end):
+            return
+        if ((old_start is not None and
+                this_stats.filter(earliest_time=old_start).exists()) or
+                (old_end is not None and
+                 this_stats.filter(latest_time=old_end).exists())):
+            # the file defined one of the limits and so the limits must be
+            # found again from the remaining files
+            self._calculate_times(std_units)
+            this_stats.update(earliest_time=self.earliest_time,
+                              earliest_date=self.earliest_date,
+                              latest_time=self.latest_time,
+                              latest_date=self.latest_date)
+            return
+        if new_start is not None:
+            this_stats.filter(
+                models.Q(earliest_time__isnull=True) |
+                models.Q(earliest_time__gt=new_start)
+            ).update(earliest_time=new_start,
+                     earliest_date=_time_string(new_start, std_units,
+                                                new['calendar']))
+        if new_end is not None:
+            this_stats.filter(
+                models.Q(latest_time__isnull=True) |
+                models.Q(latest_time__lt=new_end)
+            ).update(latest_time=new_end,
+                     latest_date=_time_string(new_end, std_units,
+                                              new['calendar']))
+
+    def _calculate_times(self, std_units=None):
+        """
+        Find the earliest start and latest end time of the parent's DataFiles.
+
+        :param str std_units: the standard time units, which are loaded from
+            Settings if not specified
+        """
+        if std_units is None:
+            std_units = Settings.get_solo().standard_time_units
+
+        earliest, latest = _time_limits(self.get_data_files(), std_units)
+
+        if earliest:
+            self.earliest_time = earliest[0]
+            self.earliest_date = _time_string(earliest[0], std_units,
+                                              earliest[1])
+        else:
+            self.earliest_time = None
+            self.earliest_date = None
+        if latest:
+            self.latest_time = latest[0]
+            self.latest_date = _time_string(latest[0], std_units, latest[1])
+        else:
+            self.latest_time = None
+            self.latest_date = None
+
+    def _add_to_list(self, stats_field, value):
+        """
+        Add `value` to the comma separated list in `stats_field` if it isn't
+        already there. The row is locked while the list is updated.
+        """
+        if value in _split_list(getattr(self, stats_field)):
+            return
+        with transaction.atomic():
+            current = (type(self).objects.select_for_update().
+                       filter(pk=self.pk).
+                       values_list(stats_field, flat=True).first())
+            values = _split_list(current)
+            if value not in values:
+                values.append(value)
+                type(self).objects.filter(pk=self.pk).update(
+                    **{stats_field: _join_list(values)})
+        setattr(self, stats_field, _join_list(values))
+
+    def _remove_from_list(self, stats_field, value):
+        """
+        Remove `value` from the comma separated list in `stats_field`. The
+        row is locked while the list is updated.
+        """
+        with transaction.atomic():
+            current = (type(self).objects.select_for_update().
+                       filter(pk=self.pk).
+                       values_list(stats_field, flat=True).first())
+            values = [item for item in _split_list(current) if item != value]
+            type(self).objects.filter(pk=self.pk).update(
+                **{stats_field: _join_list(values)})
+        setattr(self, stats_field, _join_list(values))
+
+
+class DataRequestStatistics(FileStatisticsBase):
+    """
+    Summary statistics of the DataFiles received for a DataRequest
+    """
+    class Meta:
+        verbose_name = 'Data Request Statistics'
+        verbose_name_plural = 'Data Request Statistics'
+
+    parent_field = 'data_request'
+
+    data_request = models.OneToOneField(DataRequest, on_delete=CASCADE,
+                                        related_name='statistics',
+                                        verbose_name='Data Request')
+
+    def __str__(self):
+        return 'Statistics for {}'.format(self.data_request_id)
+
+
+class DataSubmissionStatistics(FileStatisticsBase):
+    """
+    Summary statistics of the DataFiles in a DataSubmission
+    """
+    class Meta:
+        verbose_name = 'Data Submission Statistics'
+        verbose_name_plural = 'Data Submission Statistics'
+
+    parent_field = 'data_submission'
+
+    data_submission = models.OneToOneField(DataSubmission, on_delete=CASCADE,
+                                           related_name='statistics',
+                                           verbose_name='Data Submission')
+
+    def __str__(self):
+        return 'Statistics for {}'.format(self.data_submission_id)
+
+
 class RetrievalRequest(models.Model):
     """
     A collection of DataRequests to retrieve from Elastic Tape or MASS
@@ -836,6 +1136,10 @@ class RetrievalRequest(models.Model):
     start_year = models.IntegerField(verbose_name="Start Year", null=True, blank=False)
     end_year = models.IntegerField(verbose_name="End Year", null=True, blank=False)
 
+    # Retrievals with a higher priority are started first
+    priority = models.IntegerField(verbose_name="Priority", default=0,
+                                   null=False, blank=False)
+
     def __str__(self):
         return '{}'.format(self.id)
 
@@ -1117,3 +1421,126 @@ class ObservationFile(models.Model):
 
     def __str__(self):
         return '{} (Directory: {})'.format(self.name, self.incoming_directory)
+
+
+def _set_file_years(data_file, save_kwargs):
+    """
+    Set a DataFile's or ReplacedFile's start_year and end_year from its times
+    before it is saved. Nothing is done if any of the time fields were
+    deferred when the file was loaded.
+
+    :param data_file: the DataFile or ReplacedFile being saved
+    :param dict save_kwargs: the keyword arguments passed to save(), which
+        are updated so that the years are saved with the times
+    """
+    time_fields = ('start_time', 'end_time', 'time_units', 'calendar')
+    if not all(field in data_file.__dict__ for field in time_fields):
+        return
+
+    data_file.start_year, data_file.end_year = calculate_file_years(
+        data_file.start_time, data_file.end_time, data_file.time_units,
+        data_file.calendar
+    )
+
+    update_fields = save_kwargs.get('update_fields')
+    if (update_fields is not None and
+            set(update_fields).intersection(time_fields)):
+        save_kwargs['update_fields'] = (list(update_fields) +
+                                        ['start_year', 'end_year'])
+
+
+def _split_list(list_string):
+    """
+    Convert a comma separated string from a FileStatisticsBase object to a
+    list.
+    """
+    if list_string:
+        return list_string.split(',')
+    else:
+        return []
+
+
+def _join_list(list_values):
+    """
+    Convert a list of values to a sorted comma separated string with any None
+    or blank items removed. None is returned if there are no values.
+    """
+    actual_vals = sorted(set(item for item in list_values if item))
+    if actual_vals:
+        return ','.join(actual_vals)
+    else:
+        return None
+
+
+def _file_contribution(values):
+    """
+    The amount that a DataFile with the specified statistics values adds to
+    the FileStatisticsBase counters.
+
+    :param dict values: the DataFile's statistics values or None
+    :returns: a dictionary of the counter field names and amounts
+    """
+    if not values:
+        return {'num_files': 0, 'total_size': 0, 'num_online': 0,
+                'num_offline': 0}
+    return {
+        'num_files': 1,
+        'total_size': values['size'] or 0,
+        'num_online': 1 if values['online'] else 0,
+        'num_offline': 0 if values['online'] else 1
+    }
+
+
+def _standard_times(values, std_units):
+    """
+    Convert a DataFile's start and end times to the standard time units.
+
+    :param dict values: the DataFile's statistics values or None
+    :param str std_units: the standard time units
+    :returns: a tuple of the start and end times, which may be None
+    """
+    if not values:
+        return None, None
+    return (standardise_time_unit(values['start_time'], values['time_units'],
+                                  std_units, values['calendar']),
+            standardise_time_unit(values['end_time'], values['time_units'],
+                                  std_units, values['calendar']))
+
+
+def _time_limits(data_files, std_units):
+    """
+    Find the earliest start time and latest end time of some DataFiles in
+    the standard time units. The database finds the minimum and maximum for
+    each combination of time units and calendar and so only these few
+    values need to be converted to the standard units.
+
+    :param django.db.models.query.QuerySet data_files: the DataFiles
+    :param str std_units: the standard time units
+    :returns: a tuple of the earliest and latest times. Each time is a tuple
+        of the time in the standard units and its calendar, or None if no
+        files have a time.
+    """
+    groups = (data_files.order_by().values('time_units', 'calendar').
+              annotate(min_start=models.Min('start_time'),
+                       max_end=models.Max('end_time')))
+
+    earliest = latest = None
+    for group in groups:
+        start = standardise_time_unit(group['min_start'], group['time_units'],
+                                      std_units, group['calendar'])
+        end = standardise_time_unit(group['max_end'], group['time_units'],
+                                    std_units, group['calendar'])
+        if start is not None and (earliest is None or start < earliest[0]):
+            earliest = (start, group['calendar'])
+        if end is not None and (latest is None or end > latest[0]):
+            latest = (end, group['calendar'])
+
+    return earliest, latest
+
+
+def _time_string(time_float, std_units, calendar):
+    """
+    Format a time in the standard units as a date string.
+    """
+    return cf_units.num2date(time_float, std_units,
+                             calendar).strftime('%Y-%m-%d')
@@ -0,0 +1,349 @@
+"""
+Signal handlers that keep the DataRequestStatistics and
+DataSubmissionStatistics up to date as DataFiles are created, changed and
+deleted and as DataIssues are attached to them.
+
+Each incremental update costs several queries and so code that saves or
+deletes many DataFiles one at a time must do so inside defer_statistics(),
+which refreshes each affected parent once at the end instead. This is done
+by replace_files() and restore_files(), delete_request.py, incoming_to_drs.py
+and submissions_to_tape.py.
+
+Bulk QuerySet operations such as update() and bulk_create() do not send
+signals and so code that uses them must call
+pdata_app.utils.dbapi.refresh_statistics() for the affected parents
+afterwards. validate_data_submission.py does this after its bulk_create() and
+pdata_app.utils.dbapi.bulk_update_files(), which retrieve_request.py and
+db_netcdf_housekeeping.py use, does it after its bulk_update(). The
+update_dreqs scripts change files with update() and don't, and so
+rebuild_file_statistics.py must be run after them.
+"""
+from __future__ import unicode_literals, division, absolute_import
+
+from contextlib import contextmanager
+import logging
+import threading
+
+from django.db import DatabaseError
+from django.db.models.signals import (post_save, pre_delete, post_delete,
+                                      m2m_changed)
+from django.dispatch import receiver
+
+from pdata_app.models import (DataFile, DataIssue, DataRequestStatistics,
+                              DataSubmissionStatistics, Settings)
+from pdata_app.utils.dbapi import refresh_statistics
+
+logger = logging.getLogger(__name__)
+
+STATISTICS_CLASSES = (DataRequestStatistics, DataSubmissionStatistics)
+
+_deferred = threading.local()
+
+
+@contextmanager
+def defer_statistics():
+    """
+    A context manager that postpones the statistics updates until the end
+    of the block. While it is active the signal handlers just record which
+    DataRequests and DataSubmissions have changed and the statistics for
+    each of these are then recalculated once on exit. This is much quicker
+    than the incremental updates when many DataFiles are being changed.
+    """
+    if _get_pending() is not None:
+        # an outer block is already deferring the updates
+        yield
+        return
+
+    _deferred.pending = {stats_class: set()
+                         for stats_class in STATISTICS_CLASSES}
+    failed = False
+    try:
+        yield
+    except Exception:
+        failed = True
+        raise
+    finally:
+        pending = _deferred.pending
+        _deferred.pending = None
+        try:
+            refresh_statistics(pending[DataRequestStatistics],
+                               pending[DataSubmissionStatistics])
+        except DatabaseError:
+            if not failed:
+                raise
+            logger.error('Unable to refresh statistics after an error')
+
+
+@receiver(post_save, sender=DataFile)
+def data_file_saved(sender, instance, created, raw=False, **kwargs):
+    """
+    Update the statistics of the parents of a created or changed DataFile.
+    """
+    if raw:
+        return
+
+    new = instance.get_statistics_values()
+    if created:
+        old = None
+    else:
+        old = getattr(instance, '_loaded_values', None)
+
+    if old == new:
+        return
+
+    pending = _get_pending()
+    if (pending is not None and old is not None and _has_parents(old) and
+            _has_parents(new)):
+        # the parents are refreshed at the end of the deferred block and so
+        # only their ids are needed
+        _add_pending(pending, old)
+        _add_pending(pending, new)
+        instance._loaded_values = new
+        return
+
+    # Any fields that were deferred when the file was loaded haven't been
+    # saved and so are the same before and after the change
+    new = _complete_values(instance, new)
+    instance._loaded_values = new
+
+    if not created and old is None:
+        # The previous values are not known and so recalculate everything
+        for stats_class in STATISTICS_CLASSES:
+            _refresh(stats_class, _parent_id(stats_class, new))
+        return
+
+    if old is not None:
+        old = dict(new, **old)
+
+    std_units = Settings.get_solo().standard_time_units
+    for stats_class in STATISTICS_CLASSES:
+        old_parent = _parent_id(stats_class, old)
+        new_parent = _parent_id(stats_class, new)
+        if old_parent == new_parent:
+            _apply_change(stats_class, new_parent, old, new, std_units)
+        else:
+            _apply_change(stats_class, old_parent, old, None, std_units)
+            _apply_change(stats_class, new_parent, None, new, std_units)
+
+
+@receiver(pre_delete, sender=DataFile)
+def data_file_deleting(sender, instance, **kwargs):
+    """
+    Record the values of a DataFile's fields before it is deleted.
+    """
+    old = getattr(instance, '_loaded_values', None)
+    if old is None:
+        old = instance.get_statistics_values()
+
+    pending = _get_pending()
+    if pending is not None:
+        # only the ids of the parents to refresh at the end of the deferred
+        # block are needed
+        if not _has_parents(old):
+            old = _complete_values(instance, old)
+        _add_pending(pending, old)
+        return
+
+    instance._loaded_values = _complete_values(instance, old)
+
+
+@receiver(post_delete, sender=DataFile)
+def data_file_deleted(sender, instance, **kwargs):
+    """
+    Update the statistics of the parents of a deleted DataFile.
+    """
+    if _get_pending() is not None:
+        # the parents were recorded before the file was deleted
+        return
+    old = instance._loaded_values
+
+    std_units = Settings.get_solo().standard_time_units
+    for stats_class in STATISTICS_CLASSES:
+        _apply_change(stats_class, _parent_id(stats_class, old), old, None,
+                      std_units)
+
+
+@receiver(m2m_changed, sender=DataIssue.data_file.through)
+def data_issue_files_changed(sender, instance, action, reverse, pk_set,
+                             **kwargs):
+    """
+    Update the number of issues when DataIssues and DataFiles are linked or
+    unlinked.
+    """
+    if action == 'pre_clear':
+        instance._cleared_parents = _issue_parents(instance, reverse)
+    elif action == 'post_clear':
+        _update_issues(getattr(instance, '_cleared_parents', {}))
+    elif action in ('post_add', 'post_remove'):
+        if reverse:
+            _update_issues(_issue_parents(instance, reverse))
+        else:
+            _update_issues(_issue_parents(
+                DataFile.objects.filter(pk__in=pk_set), reverse))
+
+
+@receiver(pre_delete, sender=DataIssue)
+def data_issue_deleting(sender, instance, **kwargs):
+    """
+    Record the parents of the files that a DataIssue is attached to before
+    it is deleted.
+    """
+    instance._cleared_parents = _issue_parents(instance, False)
+
+
+@receiver(post_delete, sender=DataIssue)
+def data_issue_deleted(sender, instance, **kwargs):
+    """
+    Update the number of issues after a DataIssue has been deleted.
+    """
+    _update_issues(getattr(instance, '_cleared_parents', {}))
+
+
+def _get_pending():
+    """
+    :returns: the dictionary of parent ids to refresh if the updates are
+        being deferred, otherwise None
+    """
+    return getattr(_deferred, 'pending', None)
+
+
+def _has_parents(values):
+    """
+    :param dict values: a DataFile's statistics values
+    :returns: True if the values include the ids of all of the parents
+    """
+    return all(stats_class.parent_field + '_id' in values
+               for stats_class in STATISTICS_CLASSES)
+
+
+def _add_pending(pending, values):
+    """
+    Record the parents in a DataFile's statistics values as needing to be
+    refreshed at the end of the deferred block.
+
+    :param dict pending: the statistics classes as keys and the sets of
+        parent ids as values
+    :param dict values: the DataFile's statistics values
+    """
+    for stats_class in STATISTICS_CLASSES:
+        parent_id = _parent_id(stats_class, values)
+        if parent_id is not None:
+            pending[stats_class].add(parent_id)
+
+
+def _parent_id(stats_class, values):
+    """
+    Get the id of the parent object from a DataFile's statistics values.
+    """
+    if not values:
+        return None
+    return values.get(stats_class.parent_field + '_id')
+
+
+def _complete_values(data_file, values):
+    """
+    Load any of a DataFile's statistics values that are missing because the
+    fields were deferred when the file was loaded.
+
+    :param pdata_app.models.DataFile data_file: the file
+    :param dict values: the known statistics values
+    :returns: a dictionary containing all of the statistics values
+    """
+    missing = [field for field in DataFile.statistics_fields
+               if field not in values]
+    if not missing:
+        return values
+    loaded = DataFile.objects.filter(pk=data_file.pk).values(*missing).first()
+    return dict(values, **(loaded or {}))
+
+
+def _refresh(stats_class, parent_id):
+    """
+    Completely recalculate a parent's statistics.
+    """
+    if parent_id is None:
+        return
+    pending = _get_pending()
+    if pending is not None:
+        pending[stats_class].add(parent_id)
+    elif stats_class is DataRequestStatistics:
+        refresh_statistics(data_request_ids=[parent_id])
+    else:
+        refresh_statistics(data_submission_ids=[parent_id])
+
+
+def _apply_change(stats_class, parent_id, old, new, std_units):
+    """
+    Incrementally update a parent's statistics after one of its DataFiles
+    has been created, changed or deleted.
+    """
+    if parent_id is None:
+        return
+    pending = _get_pending()
+    if pending is not None:
+        pending[stats_class].add(parent_id)
+        return
+
+    parent_kwargs = {stats_class.parent_field + '_id': parent_id}
+    if new is None:
+        # Nothing to do if the statistics have never been calculated or
+        # if the parent itself is being deleted
+        stats = stats_class.objects.filter(**parent_kwargs).first()
+        if stats is None:
+            return
+    else:
+        stats, created = stats_class.objects.get_or_create(**parent_kwargs)
+        if created:
+            # the new file is already included in the calculation
+            stats.recalculate(std_units)
+            return
+
+    stats.apply_change(old, new, std_units)
+    if new is None:
+        # any links to DataIssues have been deleted with the file
+        stats.recalculate_issues()
+
+
+def _issue_parents(data_files, reverse):
+    """
+    Find the parents of DataFiles.
+
+    :param data_files: a DataFile if `reverse` is True, else either a
+        DataIssue or a QuerySet of DataFiles
+    :param bool reverse: True if `data_files` is a single DataFile
+    :returns: a dictionary with the statistics classes as keys and the sets
+        of parent ids as the values
+    """
+    if reverse:
+        return {stats_class: {_parent_id(stats_class,
+                                         data_files.get_statistics_values())}
+                for stats_class in STATISTICS_CLASSES}
+
+    if isinstance(data_files, DataIssue):
+        data_files = data_files.data_file.all()
+    parents = {stats_class: set() for stats_class in STATISTICS_CLASSES}
+    for dreq_id, sub_id in (data_files.order_by().
+                            values_list('data_request_id',
+                                        'data_submission_id').distinct()):
+        parents[DataRequestStatistics].add(dreq_id)
+        parents[DataSubmissionStatistics].add(sub_id)
+    return parents
+
+
+def _update_issues(parents):
+    """
+    Recalculate the number of DataIssues for each of the parents.
+
+    :param dict parents: the statistics classes as keys and the sets of
+        parent ids as values
+    """
+    pending = _get_pending()
+    for stats_class, parent_ids in parents.items():
+        parent_ids = {parent_id for parent_id in parent_ids
+                      if parent_id is not None}
+        if pending is not None:
+            pending[stats_class].update(parent_ids)
+            continue
+        for stats in stats_class.objects.filter(
+                **{stats_class.parent_field + '_id__in': parent_ids}):
+            stats.recalculate_issues()
@@ -6,7 +6,7 @@ try:
 except ImportError:
     from urllib import urlencode  # Python 2.7
 
-from django.db.models import Count, Sum
+from django.core.exceptions import ObjectDoesNotExist
 from django.template.defaultfilters import filesizeformat
 from django.utils.html import format_html
 from django.urls import reverse
@@ -14,12 +14,17 @@ import django_tables2 as tables
 
 from .models import (DataRequest, DataSubmission, DataFile, ESGFDataset,
                      CEDADataset, DataIssue, VariableRequest, RetrievalRequest,
-                     ReplacedFile, ObservationDataset, ObservationFile)
+                     ReplacedFile, ObservationDataset, ObservationFile,
+                     DataRequestStatistics, DataSubmissionStatistics)
 
-from pdata_app.utils.common import get_request_size
+from pdata_app.utils.common import get_retrieval_sizes
 
 DEFAULT_VALUE = '—'
 
+# Sort the online status from fully online, through partially online, to
+# offline
+ONLINE_STATUS_ORDER = ('statistics__num_offline', '-statistics__num_online')
+
 
 class DataFileTable(tables.Table):
     class Meta:
@@ -43,8 +48,7 @@ class DataFileTable(tables.Table):
     checksum = tables.Column(empty_values=(), verbose_name='Checksum',
                              orderable=False)
     num_dataissues = tables.Column(empty_values=(),
-                                   verbose_name='# Data Issues',
-                                   orderable=False)
+                                   verbose_name='# Data Issues')
     climate_model = tables.Column(accessor='climate_model__short_name',
                                   verbose_name='Climate Model')
     institute = tables.Column(accessor='institute__short_name',
@@ -55,15 +59,19 @@ class DataFileTable(tables.Table):
                             verbose_name='Project')
 
     def render_checksum(self, record):
-        checksum = record.checksum_set.first()
-        if checksum:
+        # use all() so that any checksums prefetched by the view are used
+        checksums = record.checksum_set.all()
+        if checksums:
+            checksum = checksums[0]
             return '{}: {}'.format(checksum.checksum_type,
                                    checksum.checksum_value)
         else:
             return DEFAULT_VALUE
 
     def render_num_dataissues(self, record):
-        num_dataissues = record.dataissue_set.count()
+        num_dataissues = getattr(record, 'num_dataissues', None)
+        if num_dataissues is None:
+            num_dataissues = record.dataissue_set.count()
         url_query = urlencode({'data_file': record.id,
                                'data_file_string': '{} ({})'.format(
                                    record.name,
@@ -90,16 +98,23 @@ class DataSubmissionTable(tables.Table):
                     'file_versions')
         order_by = '-date_submitted'
 
-    online_status = tables.Column(empty_values=(), orderable=False)
-    num_files = tables.Column(empty_values=(), verbose_name='# Data Files',
-                              orderable=False)
-    num_issues = tables.Column(empty_values=(), verbose_name='# Data Issues',
-                               orderable=False)
-    earliest_date = tables.Column(empty_values=(), orderable=False)
-    latest_date = tables.Column(empty_values=(), orderable=False)
-    tape_urls = tables.Column(empty_values=(), verbose_name='Tape URLs',
-                              orderable=False)
-    file_versions = tables.Column(empty_values=(), orderable=False)
+    online_status = tables.Column(empty_values=(), accessor='statistics',
+                                  order_by=ONLINE_STATUS_ORDER)
+    num_files = tables.Column(empty_values=(), accessor='statistics',
+                              verbose_name='# Data Files',
+                              order_by='statistics__num_files')
+    num_issues = tables.Column(empty_values=(), accessor='statistics',
+                               verbose_name='# Data Issues',
+                               order_by='statistics__num_issues')
+    earliest_date = tables.Column(empty_values=(), accessor='statistics',
+                                  order_by='statistics__earliest_time')
+    latest_date = tables.Column(empty_values=(), accessor='statistics',
+                                order_by='statistics__latest_time')
+    tape_urls = tables.Column(empty_values=(), accessor='statistics',
+                              verbose_name='Tape URLs',
+                              order_by='statistics__tape_urls')
+    file_versions = tables.Column(empty_values=(), accessor='statistics',
+                                  order_by='statistics__file_versions')
     user = tables.Column(accessor='user__username', verbose_name='User')
 
     def render_date_submitted(self, value):
@@ -109,13 +124,13 @@ class DataSubmissionTable(tables.Table):
         if record.status in ['PENDING_PROCESSING', 'ARRIVED']:
             return DEFAULT_VALUE
         else:
-            return record.online_status()
+            return _get_statistics(record).online_status()
 
     def render_num_files(self, record):
         if record.status in ['PENDING_PROCESSING', 'ARRIVED']:
             return DEFAULT_VALUE
         else:
-            num_datafiles = record.datafile_set.count()
+            num_datafiles = _get_statistics(record).num_files
             url_query = urlencode({'data_submission': record.id,
                                    'data_submission_string': '{}'.format(
                                        record.incoming_directory)})
@@ -129,8 +144,7 @@ class DataSubmissionTable(tables.Table):
         if record.status in ['PENDING_PROCESSING', 'ARRIVED']:
             return DEFAULT_VALUE
         else:
-            num_dataissues = record.datafile_set.aggregate(
-                Count('dataissue', distinct=True))['dataissue__count']
+            num_dataissues = _get_statistics(record).num_issues
             url_query = urlencode({'data_submission': record.id,
                                    'data_submission_string': '{}'.format(
                                        record.incoming_directory)})
@@ -144,7 +158,7 @@ class DataSubmissionTable(tables.Table):
         if record.status in ['PENDING_PROCESSING', 'ARRIVED']:
             return DEFAULT_VALUE
         else:
-            start_time = record.start_time()
+            start_time = _get_statistics(record).start_time()
             if start_time:
                 return start_time
             else:
@@ -154,7 +168,7 @@ class DataSubmissionTable(tables.Table):
         if record.status in ['PENDING_PROCESSING', 'ARRIVED']:
             return DEFAULT_VALUE
         else:
-            end_time = record.end_time()
+            end_time = _get_statistics(record).end_time()
             if end_time:
                 return end_time
             else:
@@ -164,7 +178,7 @@ class DataSubmissionTable(tables.Table):
         if record.status in ['PENDING_PROCESSING', 'ARRIVED']:
             return DEFAULT_VALUE
         else:
-            tape_urls = record.get_tape_urls()
+            tape_urls = _get_statistics(record).get_tape_urls()
             return format_html('<div class="truncate-ellipsis"><span>{}'
                                '</span></div>'.
                                format(_to_comma_sep(tape_urls)))
@@ -173,7 +187,7 @@ class DataSubmissionTable(tables.Table):
         if record.status in ['PENDING_PROCESSING', 'ARRIVED']:
             return DEFAULT_VALUE
         else:
-            file_versions = record.get_file_versions()
+            file_versions = _get_statistics(record).get_file_versions()
             return _to_comma_sep(file_versions)
 
 
@@ -218,20 +232,28 @@ class DataReceivedTable(DataRequestTable):
                     'tape_urls', 'file_versions', 'total_data_size',
                     'retrieval_request')
 
-    start_time = tables.Column(empty_values=(), orderable=False)
-    end_time = tables.Column(empty_values=(), orderable=False)
-    online_status = tables.Column(empty_values=(), orderable=False)
-    num_files = tables.Column(empty_values=(), verbose_name='# Data Files',
-                              orderable=False)
-    num_issues = tables.Column(empty_values=(), verbose_name='# Data Issues',
-                               orderable=False)
-    tape_urls = tables.Column(empty_values=(), verbose_name='Tape URLs',
-                              orderable=False)
-    file_versions = tables.Column(empty_values=(), orderable=False)
+    start_time = tables.Column(empty_values=(), accessor='statistics',
+                               order_by='statistics__earliest_time')
+    end_time = tables.Column(empty_values=(), accessor='statistics',
+                             order_by='statistics__latest_time')
+    online_status = tables.Column(empty_values=(), accessor='statistics',
+                                  order_by=ONLINE_STATUS_ORDER)
+    num_files = tables.Column(empty_values=(), accessor='statistics',
+                              verbose_name='# Data Files',
+                              order_by='statistics__num_files')
+    num_issues = tables.Column(empty_values=(), accessor='statistics',
+                               verbose_name='# Data Issues',
+                               order_by='statistics__num_issues')
+    tape_urls = tables.Column(empty_values=(), accessor='statistics',
+                              verbose_name='Tape URLs',
+                              order_by='statistics__tape_urls')
+    file_versions = tables.Column(empty_values=(), accessor='statistics',
+                                  order_by='statistics__file_versions')
     retrieval_request = tables.Column(empty_values=(), orderable=False,
                                       verbose_name='Request Retrieval?')
-    total_data_size = tables.Column(empty_values=(), orderable=False,
-                                    verbose_name='Data Size')
+    total_data_size = tables.Column(empty_values=(), accessor='statistics',
+                                    verbose_name='Data Size',
+                                    order_by='statistics__total_size')
     climate_model = tables.Column(accessor='climate_model__short_name',
                                   verbose_name='Climate Model')
     institute = tables.Column(accessor='institute__short_name',
@@ -242,16 +264,16 @@ class DataReceivedTable(DataRequestTable):
                             verbose_name='Project')
 
     def render_start_time(self, record):
-        return record.start_time()
+        return _get_statistics(record).start_time()
 
     def render_end_time(self, record):
-        return record.end_time()
+        return _get_statistics(record).end_time()
 
     def render_online_status(self, record):
-        return record.online_status()
+        return _get_statistics(record).online_status()
 
     def render_num_files(self, record):
-        num_datafiles = record.datafile_set.count()
+        num_datafiles = _get_statistics(record).num_files
         url_query = urlencode({'data_request': record.id,
                                'data_request_string': '{}'.format(record)})
         return format_html('<a href="{}?{}">{}</a>'.format(
@@ -261,8 +283,7 @@ class DataReceivedTable(DataRequestTable):
         ))
 
     def render_num_issues(self, record):
-        num_dataissues = record.datafile_set.aggregate(
-            Count('dataissue', distinct=True))['dataissue__count']
+        num_dataissues = _get_statistics(record).num_issues
         url_query = urlencode({'data_request': record.id,
                                'data_request_string': '{}'.format(record)})
         return format_html('<a href="{}?{}">{}</a>'.format(
@@ -272,12 +293,12 @@ class DataReceivedTable(DataRequestTable):
         ))
 
     def render_tape_urls(self, record):
-        tape_urls = record.get_tape_urls()
+        tape_urls = _get_statistics(record).get_tape_urls()
         return format_html('<div class="truncate-ellipsis"><span>{}'
                            '</span></div>'.format(_to_comma_sep(tape_urls)))
 
     def render_file_versions(self, record):
-        file_versions = record.get_file_versions()
+        file_versions = _get_statistics(record).get_file_versions()
         return _to_comma_sep(file_versions)
 
     def render_retrieval_request(self, record):
@@ -288,8 +309,7 @@ class DataReceivedTable(DataRequestTable):
         )
 
     def render_total_data_size(self, record):
-        return filesizeformat(
-            record.datafile_set.aggregate(Sum('size'))['size__sum'])
+        return filesizeformat(_get_statistics(record).total_size)
 
 
 class ESGFDatasetTable(tables.Table):
@@ -410,25 +430,55 @@ class RetrievalRequestTable(tables.Table):
         return reqs_str
 
     def render_req_size(self, record):
-        return filesizeformat(get_request_size(record.data_request.all(),
-                                               record.start_year,
-                                               record.end_year))
+        sizes = self._get_page_summary()['sizes'].get(record.id, {})
+        return filesizeformat(sizes.get('total', 0))
 
     def render_retrieval_size(self, record):
-        return filesizeformat(get_request_size(record.data_request.all(),
-                                               record.start_year,
-                                               record.end_year,
-                                               offline = True))
+        sizes = self._get_page_summary()['sizes'].get(record.id, {})
+        return filesizeformat(sizes.get('offline', 0))
 
     def render_tape_urls(self, record):
-        tape_urls = list(record.data_request.all().values_list(
-            'datafile__tape_url', flat=True).distinct())
+        tape_urls = self._get_page_summary()['tape_urls'].get(record.id, [])
 
-        tape_urls_str = ', '.join([tu for tu in tape_urls if tu is not None])
+        tape_urls_str = ', '.join(tape_urls)
 
         return format_html('<div class="truncate-ellipsis"><span>{}'
                            '</span></div>'.format(tape_urls_str))
 
+    def _get_page_summary(self):
+        """
+        Find the sizes and tape URLs of all of the retrieval requests being
+        displayed the first time that any of them are needed so that the
+        number of queries doesn't depend on the number of rows.
+
+        :returns: dictionaries of the sizes and sorted tape URLs with the
+            retrieval request ids as keys
+        :rtype: dict
+        """
+        summary = getattr(self, '_page_summary', None)
+        if summary is not None:
+            return summary
+
+        page = getattr(self, 'page', None)
+        rows = page.object_list if page is not None else self.rows
+        ret_ids = [row.record.id for row in rows]
+
+        tape_urls = {}
+        for ret_id, tape_url in (
+                DataFile.objects.filter(
+                    data_request__retrievalrequest__in=ret_ids,
+                    tape_url__isnull=False
+                ).order_by().values_list('data_request__retrievalrequest',
+                                         'tape_url').distinct()):
+            tape_urls.setdefault(ret_id, []).append(tape_url)
+
+        self._page_summary = {
+            'sizes': get_retrieval_sizes(ret_ids),
+            'tape_urls': {ret_id: sorted(urls)
+                          for ret_id, urls in tape_urls.items()}
+        }
+        return self._page_summary
+
 
 class ReplacedFileTable(tables.Table):
     class Meta:
@@ -552,6 +602,29 @@ class ObservationFileTable(tables.Table):
             return DEFAULT_VALUE
 
 
+def _get_statistics(record):
+    """
+    Get the cached statistics for a DataRequest or DataSubmission. If these
+    haven't been saved yet then they are calculated but not saved, so that
+    displaying a page doesn't change the database.
+    """
+    try:
+        return record.statistics
+    except ObjectDoesNotExist:
+        pass
+
+    # the calculated statistics are kept so that each column of the row
+    # doesn't calculate them again
+    if not hasattr(record, '_calculated_statistics'):
+        if isinstance(record, DataRequest):
+            statistics = DataRequestStatistics(data_request_id=record.id)
+        else:
+            statistics = DataSubmissionStatistics(data_submission_id=record.id)
+        statistics.recalculate(save=False)
+        record._calculated_statistics = statistics
+    return record._calculated_statistics
+
+
 def _to_comma_sep(list_values):
     """
     Removes any None, False or blank items from a list and then converts the
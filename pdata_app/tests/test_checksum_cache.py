@@ -0,0 +1,67 @@
+"""
+test_checksum_cache.py - unit tests for pdata_app.utils.checksum_cache.py
+"""
+from __future__ import unicode_literals, division, absolute_import
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from pdata_app.utils.checksum_cache import ChecksumCache
+
+
+class TestChecksumCache(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.cache = ChecksumCache(os.path.join(self.temp_dir, 'cache.db'))
+        self.file_path = os.path.join(self.temp_dir, 'file.nc')
+        with open(self.file_path, 'wb') as fh:
+            fh.write(b'some data')
+
+    def test_empty(self):
+        self.assertEqual({}, self.cache.get(os.stat(self.file_path),
+                                            ['ADLER32']))
+
+    def test_set_and_get(self):
+        file_stat = os.stat(self.file_path)
+        self.cache.set(file_stat, {'ADLER32': '1', 'MD5': 'abcd'})
+        self.assertEqual({'ADLER32': '1', 'MD5': 'abcd'},
+                         self.cache.get(file_stat, ['ADLER32', 'MD5',
+                                                    'SHA256']))
+
+    def test_only_types_requested(self):
+        file_stat = os.stat(self.file_path)
+        self.cache.set(file_stat, {'ADLER32': '1', 'MD5': 'abcd'})
+        self.assertEqual({'MD5': 'abcd'},
+                         self.cache.get(file_stat, ['MD5']))
+
+    def test_replaced(self):
+        file_stat = os.stat(self.file_path)
+        self.cache.set(file_stat, {'ADLER32': '1'})
+        self.cache.set(file_stat, {'ADLER32': '2'})
+        self.assertEqual({'ADLER32': '2'},
+                         self.cache.get(file_stat, ['ADLER32']))
+
+    def test_file_changed(self):
+        self.cache.set(os.stat(self.file_path), {'ADLER32': '1'})
+        with open(self.file_path, 'ab') as fh:
+            fh.write(b'more data')
+        self.assertEqual({}, self.cache.get(os.stat(self.file_path),
+                                            ['ADLER32']))
+
+    def test_mtime_changed(self):
+        file_stat = os.stat(self.file_path)
+        self.cache.set(file_stat, {'ADLER32': '1'})
+        os.utime(self.file_path, ns=(file_stat.st_atime_ns,
+                                     file_stat.st_mtime_ns + 1000))
+        self.assertEqual({}, self.cache.get(os.stat(self.file_path),
+                                            ['ADLER32']))
+
+    def test_shared_between_instances(self):
+        file_stat = os.stat(self.file_path)
+        self.cache.set(file_stat, {'ADLER32': '1'})
+        other_cache = ChecksumCache(self.cache.db_path)
+        self.assertEqual({'ADLER32': '1'},
+                         other_cache.get(file_stat, ['ADLER32']))
@@ -2,6 +2,7 @@
 test_common.py - unit tests for pdata_app.utils.common.py
 """
 from __future__ import unicode_literals, division, absolute_import
+import os
 from pathlib import Path
 import shutil
 import tempfile
@@ -20,7 +21,9 @@ from numpy.testing import assert_almost_equal
 from django.test import TestCase
 
 from pdata_app import models
-from pdata_app.utils.common import (make_partial_date_time,
+from pdata_app.utils.common import (adler32, md5, sha256,
+                                    calculate_checksums, get_checksums,
+                                    make_partial_date_time,
                                     standardise_time_unit,
                                     calc_last_day_in_month, pdt2num,
                                     list_files, ilist_files,
@@ -30,13 +33,121 @@ from pdata_app.utils.common import (make_partial_date_time,
                                     construct_filename,
                                     construct_cylc_task_name,
                                     construct_time_string, get_request_size,
+                                    get_request_sizes, get_retrieval_sizes,
                                     date_filter_files, grouper,
+                                    calculate_file_years,
                                     directories_spanned, run_ncatted,
                                     run_ncrename)
 from pdata_app.utils import dbapi
+from pdata_app.utils.checksum_cache import ChecksumCache
 from .common import make_example_files
 
 
+class TestChecksums(TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.file_path = str(self.temp_dir.joinpath('file.nc'))
+        with open(self.file_path, 'wb') as fh:
+            fh.write(b'Wikipedia' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(str(self.temp_dir))
+
+    def test_adler32(self):
+        self.assertEqual(adler32(self.file_path), '4221634219')
+
+    def test_md5(self):
+        self.assertEqual(md5(self.file_path),
+                         'b2d7af11d28b59fd8dd98cd131109bc7')
+
+    def test_sha256(self):
+        self.assertEqual(sha256(self.file_path),
+                         '69b9575badb7ef43f317f38b4a46db19eee6a936012642fad'
+                         '34daa39db83a256')
+
+    def test_missing_file(self):
+        self.assertIsNone(adler32(str(self.temp_dir.joinpath('missing.nc'))))
+
+    def test_single_pass(self):
+        self.assertEqual(
+            {'ADLER32': adler32(self.file_path),
+             'MD5': md5(self.file_path),
+             'SHA256': sha256(self.file_path)},
+            calculate_checksums(self.file_path, ['ADLER32', 'MD5', 'SHA256'])
+        )
+
+    def test_block_sizes(self):
+        expected = calculate_checksums(self.file_path, ['ADLER32', 'MD5'])
+        for use_mmap in (False, True):
+            self.assertEqual(
+                expected,
+                calculate_checksums(self.file_path, ['ADLER32', 'MD5'],
+                                    block_size=1000, use_mmap=use_mmap)
+            )
+
+    def test_empty_file(self):
+        empty_path = str(self.temp_dir.joinpath('empty.nc'))
+        open(empty_path, 'wb').close()
+        self.assertEqual({'ADLER32': '1'},
+                         calculate_checksums(empty_path, ['ADLER32'],
+                                             use_mmap=True))
+
+    def test_unknown_type(self):
+        self.assertRaises(ValueError, calculate_checksums, self.file_path,
+                          ['CRC32'])
+
+
+class TestGetChecksums(TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.temp_dir))
+        self.file_path = str(self.temp_dir.joinpath('file.nc'))
+        with open(self.file_path, 'wb') as fh:
+            fh.write(b'Wikipedia' * 1000)
+        self.cache = ChecksumCache(str(self.temp_dir.joinpath('cache.db')))
+
+        patch = mock.patch('pdata_app.utils.common._get_checksum_cache')
+        self.mock_get_cache = patch.start()
+        self.addCleanup(patch.stop)
+        self.mock_get_cache.return_value = self.cache
+
+    def test_cached(self):
+        self.assertEqual({'ADLER32': '4221634219'},
+                         get_checksums(self.file_path, ['ADLER32']))
+        self.assertEqual({'ADLER32': '4221634219'},
+                         self.cache.get(os.stat(self.file_path),
+                                        ['ADLER32']))
+
+    def test_cache_used(self):
+        self.cache.set(os.stat(self.file_path), {'ADLER32': '1'})
+        with mock.patch('pdata_app.utils.common.calculate_checksums') as calc:
+            self.assertEqual('1', adler32(self.file_path))
+            calc.assert_not_called()
+
+    def test_missing_types_calculated(self):
+        self.cache.set(os.stat(self.file_path), {'ADLER32': '1'})
+        self.assertEqual(
+            {'ADLER32': '1', 'MD5': 'b2d7af11d28b59fd8dd98cd131109bc7'},
+            get_checksums(self.file_path, ['ADLER32', 'MD5'])
+        )
+
+    def test_file_changed(self):
+        self.assertEqual('4221634219', adler32(self.file_path))
+        with open(self.file_path, 'wb') as fh:
+            fh.write(b'Wikipedia')
+        self.assertEqual('300286872', adler32(self.file_path))
+
+    def test_no_cache(self):
+        self.cache.set(os.stat(self.file_path), {'ADLER32': '1'})
+        self.assertEqual('4221634219',
+                         adler32(self.file_path, use_cache=False))
+        self.mock_get_cache.assert_not_called()
+
+    def test_not_in_gws(self):
+        self.mock_get_cache.return_value = None
+        self.assertEqual('4221634219', adler32(self.file_path))
+
+
 class TestMakePartialDateTime(TestCase):
     def test_yyyymm(self):
         expected = PartialDateTime(year=2014, month=8)
@@ -329,6 +440,31 @@ class TestStandardiseTimeUnit(TestCase):
                                                 time_unit, '360_day'))
 
 
+class TestCalculateFileYears(TestCase):
+    """
+    Test calculate_file_years()
+    """
+    def test_mid_year(self):
+        self.assertEqual(calculate_file_years(15, 705, 'days since 1950-01-01',
+                                              '360_day'),
+                         (1950, 1951))
+
+    def test_ends_at_year_start(self):
+        self.assertEqual(calculate_file_years(0, 3600,
+                                              'days since 1950-01-01',
+                                              '360_day'),
+                         (1950, 1959))
+
+    def test_instantaneous(self):
+        self.assertEqual(calculate_file_years(0, 0, 'days since 1950-01-01',
+                                              '360_day'),
+                         (1950, 1950))
+
+    def test_no_times(self):
+        self.assertEqual(calculate_file_years(None, None, None, None),
+                         (None, None))
+
+
 class TestIsSameGws(TestCase):
     def test_same(self):
         path1 = '/group_workspaces/jasmin2/primavera1/some/dir'
@@ -604,6 +740,82 @@ class TestGetRequestSize(TestCase):
                                              1950, 2000))
 
 
+class TestGetRequestSizes(TestCase):
+    def setUp(self):
+        make_example_files(self)
+
+    def test_all_files(self):
+        self.assertEqual(
+            {self.dreq1.id: {'total': 13, 'online': 1, 'offline': 12},
+             self.dreq2.id: {'total': 2, 'online': 2, 'offline': 0}},
+            get_request_sizes(models.DataRequest.objects.all(), 1950, 2000)
+        )
+
+    def test_dates(self):
+        self.assertEqual(
+            {self.dreq1.id: {'total': 5, 'online': 1, 'offline': 4},
+             self.dreq2.id: {'total': 2, 'online': 2, 'offline': 0}},
+            get_request_sizes([self.dreq1, self.dreq2], 1950, 1975)
+        )
+
+    def test_no_years(self):
+        self.assertEqual(
+            {self.dreq1.id: {'total': 13, 'online': 1, 'offline': 12}},
+            get_request_sizes([self.dreq1, self.dreq3], None, None)
+        )
+
+    def test_num_queries(self):
+        with self.assertNumQueries(1):
+            get_request_sizes(models.DataRequest.objects.all(), 1950, 2000)
+
+
+class TestGetRetrievalSizes(TestCase):
+    def setUp(self):
+        make_example_files(self)
+        self.rreq1 = models.RetrievalRequest.objects.create(
+            requester=self.user, start_year=1950, end_year=1975)
+        self.rreq1.data_request.add(self.dreq1, self.dreq2)
+        self.rreq2 = models.RetrievalRequest.objects.create(
+            requester=self.user, start_year=1985, end_year=2000)
+        self.rreq2.data_request.add(self.dreq1)
+        self.rreq3 = models.RetrievalRequest.objects.create(
+            requester=self.user)
+        self.rreq3.data_request.add(self.dreq1, self.dreq3)
+
+    def test_sizes(self):
+        self.assertEqual(
+            {self.rreq1.id: {'total': 7, 'online': 3, 'offline': 4},
+             self.rreq2.id: {'total': 8, 'online': 0, 'offline': 8},
+             self.rreq3.id: {'total': 13, 'online': 1, 'offline': 12}},
+            get_retrieval_sizes(models.RetrievalRequest.objects.all())
+        )
+
+    def test_matches_get_request_size(self):
+        sizes = get_retrieval_sizes([self.rreq1.id, self.rreq2.id])
+        for rreq in (self.rreq1, self.rreq2):
+            self.assertEqual(
+                get_request_size(rreq.data_request.all(), rreq.start_year,
+                                 rreq.end_year),
+                sizes[rreq.id]['total']
+            )
+
+    def test_years_not_calculated(self):
+        models.DataFile.objects.filter(name='test8').update(start_year=None,
+                                                            end_year=None)
+        sizes = get_retrieval_sizes([self.rreq1])
+        self.assertEqual(sizes[self.rreq1.id]['total'], 15)
+
+    def test_no_files(self):
+        rreq = models.RetrievalRequest.objects.create(
+            requester=self.user, start_year=1950, end_year=2000)
+        rreq.data_request.add(self.dreq3)
+        self.assertEqual({}, get_retrieval_sizes([rreq]))
+
+    def test_num_queries(self):
+        with self.assertNumQueries(1):
+            get_retrieval_sizes(models.RetrievalRequest.objects.all())
+
+
 class TestDateFilterFiles(TestCase):
     def setUp(self):
         make_example_files(self)
@@ -645,6 +857,47 @@ class TestDateFilterFiles(TestCase):
                                                        1975, 1985)))
 
 
+    def test_boundary_excluded(self):
+        data_files =  models.DataFile.objects.all()
+        self.assertEqual(['test2', 'test4'],
+                         _assertable(date_filter_files(data_files,
+                                                       1960, 1970)))
+
+    def test_ends_at_boundary(self):
+        data_files =  models.DataFile.objects.all()
+        self.assertEqual(['test2', 'test4', 'test8'],
+                         _assertable(date_filter_files(data_files,
+                                                       1965, 1989)))
+
+    def test_no_years(self):
+        data_files =  models.DataFile.objects.all()
+        self.assertEqual(['test1', 'test2', 'test4', 'test8'],
+                         _assertable(date_filter_files(data_files,
+                                                       None, 1970)))
+
+    def test_empty(self):
+        data_files = models.DataFile.objects.filter(name='missing')
+        self.assertEqual([],
+                         _assertable(date_filter_files(data_files,
+                                                       1950, 1960)))
+
+    def test_no_times(self):
+        models.DataFile.objects.filter(name='test8').update(
+            start_time=None, end_time=None, start_year=None, end_year=None)
+        data_files = models.DataFile.objects.all()
+        self.assertEqual(['test1', 'test2', 'test8'],
+                         _assertable(date_filter_files(data_files,
+                                                       1949, 1961)))
+
+    def test_years_not_calculated(self):
+        models.DataFile.objects.filter(name='test8').update(start_year=None,
+                                                            end_year=None)
+        data_files = models.DataFile.objects.all()
+        self.assertEqual(['test1', 'test2', 'test8'],
+                         _assertable(date_filter_files(data_files,
+                                                       1949, 1961)))
+
+
 class TestGrouper(TestCase):
     def test_exact_multiple(self):
         actual = [list(chunk) for chunk in grouper(range(8), 4)]
@@ -9,6 +9,7 @@ from django.test import TestCase
 
 from pdata_app.utils import dbapi
 from pdata_app import models
+from pdata_app.tests.common import make_example_files
 from vocabs.vocabs import (STATUS_VALUES, CHECKSUM_TYPES,
     FREQUENCY_VALUES, VARIABLE_TYPES)
 
@@ -138,6 +139,35 @@ class TestIsPaused(TestCase):
         self.assertTrue(dbapi.is_paused())
 
 
+class TestBulkUpdateFiles(TestCase):
+    def setUp(self):
+        make_example_files(self)
+        self.data_files = list(models.DataFile.objects.filter(
+            data_request=self.dreq1).order_by('name'))
+        for data_file in self.data_files:
+            data_file.online = True
+            data_file.directory = '/restored'
+
+    def test_files_updated(self):
+        dbapi.bulk_update_files(self.data_files, ['directory', 'online'],
+                                batch_size=2)
+        for data_file in models.DataFile.objects.filter(
+                data_request=self.dreq1):
+            self.assertTrue(data_file.online)
+            self.assertEqual('/restored', data_file.directory)
+
+    def test_statistics_refreshed(self):
+        dbapi.bulk_update_files(self.data_files, ['directory', 'online'],
+                                batch_size=2)
+        self.dreq1.statistics.refresh_from_db()
+        self.assertEqual(3, self.dreq1.statistics.num_online)
+        self.assertEqual(0, self.dreq1.statistics.num_offline)
+
+    def test_empty(self):
+        with self.assertNumQueries(0):
+            dbapi.bulk_update_files([], ['online'])
+
+
 def _create_file_object():
     """
     Creates a file object in the database and returns the corresponding object
@@ -0,0 +1,96 @@
+"""
+test_fk_resolver.py - unit tests for pdata_app.utils.fk_resolver.py
+"""
+from __future__ import unicode_literals, division, absolute_import
+
+from django.test import TestCase
+
+from pdata_app import models
+from pdata_app.utils.fk_resolver import ForeignKeyResolver
+from vocabs.vocabs import FREQUENCY_VALUES, VARIABLE_TYPES
+from .common import make_example_files
+
+
+class TestForeignKeyResolver(TestCase):
+    def setUp(self):
+        make_example_files(self)
+        self.project = self.dreq1.project
+        self.institute = self.dreq1.institute
+        self.climate_model = self.dreq1.climate_model
+        self.experiment = self.dreq1.experiment
+        self.resolver = ForeignKeyResolver()
+
+    def _get_data_requests(self, **kwargs):
+        return self.resolver.get_data_requests(
+            self.project, self.institute, self.climate_model,
+            self.experiment, 'Amon', 'r1i1p1f1', **kwargs
+        )
+
+    def _add_plev_variables(self):
+        for dimensions in ('longitude latitude plev7h time',
+                           'longitude latitude plev27 time'):
+            var_req = models.VariableRequest.objects.create(
+                table_name='Amon', long_name='wind', units='m s-1',
+                var_name='ua', standard_name='eastward_wind',
+                cell_methods='time: mean', positive='',
+                variable_type=VARIABLE_TYPES['real'], dimensions=dimensions,
+                cmor_name='ua' + dimensions.split()[2][4:],
+                modeling_realm='atmos', frequency=FREQUENCY_VALUES['mon'],
+                cell_measures='', uid='123abc')
+            models.DataRequest.objects.create(
+                project=self.project, institute=self.institute,
+                climate_model=self.climate_model, experiment=self.experiment,
+                variable_request=var_req, rip_code='r1i1p1f1',
+                request_start_time=0.0, request_end_time=23400.0,
+                time_units='days since 1950-01-01', calendar='360_day')
+
+    def test_vocabulary(self):
+        self.assertEqual(self.institute,
+                         self.resolver.get_vocabulary('institute', 'MOHC'))
+        self.assertEqual(
+            'HighResMIP',
+            self.resolver.get_vocabulary('activity_id',
+                                         'HighResMIP').short_name
+        )
+
+    def test_vocabulary_missing(self):
+        self.assertIsNone(self.resolver.get_vocabulary('climate_model',
+                                                       'no-model'))
+
+    def test_cmor_name(self):
+        self.assertEqual([self.dreq1], self._get_data_requests(
+            cmor_name='var1'))
+
+    def test_var_name(self):
+        self.assertEqual([self.dreq2], self._get_data_requests(
+            var_name='var2'))
+
+    def test_no_match(self):
+        self.assertEqual([], self._get_data_requests(cmor_name='var3'))
+
+    def test_variant(self):
+        self.assertEqual([self.dreq4], self.resolver.get_data_requests(
+            self.project, self.institute, self.climate_model,
+            self.experiment, 'Amon', 'r1i2p3f4', cmor_name='var1'))
+
+    def test_dimension(self):
+        self._add_plev_variables()
+        self.resolver = ForeignKeyResolver()
+        self.assertEqual(2, len(self._get_data_requests(var_name='ua')))
+        plev_matches = self._get_data_requests(var_name='ua',
+                                               dimension='PLEV7H')
+        self.assertEqual(1, len(plev_matches))
+        self.assertEqual('ua7h',
+                         plev_matches[0].variable_request.cmor_name)
+
+    def test_name_required(self):
+        self.assertRaises(ValueError, self._get_data_requests)
+        self.assertRaises(ValueError, self._get_data_requests,
+                          cmor_name='var1', var_name='var1')
+
+    def test_no_queries(self):
+        with self.assertNumQueries(0):
+            data_req = self._get_data_requests(cmor_name='var1')[0]
+            self.assertEqual(str(self.dreq1), str(data_req))
+            self.assertEqual('Amon', data_req.variable_request.table_name)
+            self.resolver.get_vocabulary('experiment', 't')
@@ -20,7 +20,9 @@ from django.utils.timezone import make_aware
 from pdata_app import models
 from vocabs import (STATUS_VALUES, ONLINE_STATUS, FREQUENCY_VALUES,
     CHECKSUM_TYPES, VARIABLE_TYPES, CALENDARS)
-from pdata_app.utils.dbapi import get_or_create
+from pdata_app.signals import defer_statistics
+from pdata_app.tests.common import make_example_files
+from pdata_app.utils.dbapi import get_or_create, refresh_statistics
 from test.test_datasets import test_data_submission
 
 
@@ -251,6 +253,15 @@ class TestDataFileAggregationBaseMethods(TestCase):
 
         self.assertEqual(end_time, expected)
 
+    def test_start_time_mixed_units(self):
+        early_file = models.DataFile.objects.all()[3]
+        early_file.start_time = 0
+        early_file.time_units = 'days since 1850-01-01'
+        early_file.save()
+
+        self.assertEqual(self.dsub.start_time(), '1850-01-01')
+        self.assertEqual(self.dsub.end_time(), '1993-12-30')
+
     def test_online_status_all_online(self):
         status = self.dsub.online_status()
 
@@ -501,6 +512,23 @@ class TestDataFile(TestCase):
         self.assertEqual(str(data_file),
             'filename.nc (Directory: /other/dir)')
 
+    def test_years_without_times(self):
+        data_file = models.DataFile.objects.first()
+        self.assertIsNone(data_file.start_year)
+        self.assertIsNone(data_file.end_year)
+
+    def test_years_set_on_save(self):
+        data_file = models.DataFile.objects.first()
+        data_file.start_time = 0
+        data_file.end_time = 3600
+        data_file.time_units = 'days since 1950-01-01'
+        data_file.calendar = '360_day'
+        data_file.save(update_fields=['start_time', 'end_time', 'time_units',
+                                      'calendar'])
+        data_file.refresh_from_db()
+        self.assertEqual(data_file.start_year, 1950)
+        self.assertEqual(data_file.end_year, 1959)
+
 
 class TestDataIssue(TestCase):
     """
@@ -569,6 +597,208 @@ class TestChecksum(TestCase):
         self.assertEqual(str(chk_sum), 'ADLER32: 12345678 (filename.nc)')
 
 
+class TestFileStatistics(TestCase):
+    """
+    Test that the DataRequestStatistics and DataSubmissionStatistics are
+    kept up to date as the DataFiles change.
+    """
+    def setUp(self):
+        make_example_files(self)
+        self.dsub = self.data_file1.data_submission
+
+    def _stats(self, parent):
+        parent.refresh_from_db()
+        return parent.statistics
+
+    def _assert_matches_recalculation(self, parent):
+        stats = self._stats(parent)
+        fields = ('num_files', 'total_size', 'num_online', 'num_offline',
+                  'num_issues', 'earliest_time', 'latest_time',
+                  'earliest_date', 'latest_date', 'file_versions',
+                  'tape_urls')
+        incremental = {field: getattr(stats, field) for field in fields}
+        stats.recalculate()
+        stats.refresh_from_db()
+        recalculated = {field: getattr(stats, field) for field in fields}
+        self.assertEqual(incremental, recalculated)
+
+    def test_created(self):
+        stats = self._stats(self.dreq1)
+        self.assertEqual(stats.num_files, 3)
+        self.assertEqual(stats.total_size, 13)
+        self.assertEqual(stats.num_online, 1)
+        self.assertEqual(stats.num_offline, 2)
+        self.assertEqual(stats.online_status(), ONLINE_STATUS.partial)
+        self.assertEqual(stats.start_time(), '1950-01-01')
+        self.assertEqual(stats.end_time(), '1990-01-01')
+        self.assertEqual(stats.get_file_versions(), ['v12345678'])
+        self.assertEqual(stats.get_tape_urls(), [])
+        self._assert_matches_recalculation(self.dreq1)
+
+    def test_submission_created(self):
+        stats = self._stats(self.dsub)
+        self.assertEqual(stats.num_files, 4)
+        self.assertEqual(stats.total_size, 15)
+        self.assertEqual(stats.get_file_versions(),
+                         ['v12345678', 'v87654321'])
+        self._assert_matches_recalculation(self.dsub)
+
+    def test_matches_aggregation_base(self):
+        stats = self._stats(self.dreq1)
+        self.assertEqual(stats.start_time(), self.dreq1.start_time())
+        self.assertEqual(stats.end_time(), self.dreq1.end_time())
+        self.assertEqual(stats.online_status(), self.dreq1.online_status())
+
+    def test_online_changed(self):
+        self.data_file1.online = False
+        self.data_file1.save()
+        stats = self._stats(self.dreq1)
+        self.assertEqual(stats.num_online, 0)
+        self.assertEqual(stats.num_offline, 3)
+        self.assertEqual(stats.online_status(), ONLINE_STATUS.offline)
+        self._assert_matches_recalculation(self.dsub)
+
+    def test_loaded_file_changed(self):
+        data_file = models.DataFile.objects.get(name='test4')
+        data_file.online = True
+        data_file.size = 40
+        data_file.save()
+        stats = self._stats(self.dreq1)
+        self.assertEqual(stats.num_online, 2)
+        self.assertEqual(stats.total_size, 49)
+        self._assert_matches_recalculation(self.dreq1)
+
+    def test_deferred_fields_changed(self):
+        data_file = models.DataFile.objects.only('id', 'online').get(
+            name='test4')
+        data_file.online = True
+        data_file.save()
+        stats = self._stats(self.dreq1)
+        self.assertEqual(stats.num_online, 2)
+        self._assert_matches_recalculation(self.dreq1)
+
+    def test_deleted_latest(self):
+        self.data_file8.delete()
+        stats = self._stats(self.dreq1)
+        self.assertEqual(stats.num_files, 2)
+        self.assertEqual(stats.total_size, 5)
+        self.assertEqual(stats.end_time(), '1980-01-01')
+        self._assert_matches_recalculation(self.dreq1)
+
+    def test_version_changed(self):
+        self.data_file1.version = 'v20190101'
+        self.data_file1.save()
+        stats = self._stats(self.dreq1)
+        self.assertEqual(stats.get_file_versions(), ['v20190101'])
+        self._assert_matches_recalculation(self.dsub)
+
+    def test_tape_url_added(self):
+        self.data_file1.tape_url = 'et:1234'
+        self.data_file1.save()
+        self.data_file8.tape_url = 'et:5678'
+        self.data_file8.save()
+        stats = self._stats(self.dreq1)
+        self.assertEqual(stats.get_tape_urls(), ['et:1234', 'et:5678'])
+        self._assert_matches_recalculation(self.dreq1)
+
+    def test_time_extended(self):
+        self.data_file1.start_time = -3600
+        self.data_file1.save()
+        stats = self._stats(self.dreq1)
+        self.assertEqual(stats.start_time(), '1940-01-01')
+        self._assert_matches_recalculation(self.dreq1)
+
+    def test_different_time_units(self):
+        self.data_file1.start_time = 0
+        self.data_file1.end_time = 360
+        self.data_file1.time_units = 'days since 1940-01-01'
+        self.data_file1.save()
+        stats = self._stats(self.dreq1)
+        self.assertEqual(stats.start_time(), '1940-01-01')
+        self.assertAlmostEqual(stats.earliest_time, -3600)
+        self._assert_matches_recalculation(self.dreq1)
+
+    def test_moved_to_other_request(self):
+        self.data_file8.data_request = self.dreq2
+        self.data_file8.save()
+        stats1 = self._stats(self.dreq1)
+        self.assertEqual(stats1.num_files, 2)
+        self.assertEqual(stats1.end_time(), '1980-01-01')
+        stats2 = self._stats(self.dreq2)
+        self.assertEqual(stats2.num_files, 2)
+        self.assertEqual(stats2.total_size, 10)
+        self.assertEqual(stats2.end_time(), '1990-01-01')
+        self._assert_matches_recalculation(self.dreq1)
+        self._assert_matches_recalculation(self.dreq2)
+
+    def test_data_issues(self):
+        self.dreq1.assign_data_issue('a problem', self.user)
+        self.assertEqual(self._stats(self.dreq1).num_issues, 1)
+        self.assertEqual(self._stats(self.dsub).num_issues, 1)
+        self.assertEqual(self._stats(self.dreq2).num_issues, 0)
+        issue = models.DataIssue.objects.create(issue='another',
+                                                reporter=self.user)
+        self.data_file2.dataissue_set.add(issue)
+        self.assertEqual(self._stats(self.dreq2).num_issues, 1)
+        self.assertEqual(self._stats(self.dsub).num_issues, 2)
+        issue.data_file.clear()
+        self.assertEqual(self._stats(self.dreq2).num_issues, 0)
+        models.DataIssue.objects.filter(issue='a problem').delete()
+        self.assertEqual(self._stats(self.dreq1).num_issues, 0)
+
+    def test_defer_statistics(self):
+        with defer_statistics():
+            self.data_file1.online = False
+            self.data_file1.save()
+            self.data_file8.delete()
+            self.assertEqual(self._stats(self.dreq1).num_offline, 2)
+        stats = self._stats(self.dreq1)
+        self.assertEqual(stats.num_files, 2)
+        self.assertEqual(stats.num_offline, 2)
+        self.assertEqual(stats.online_status(), ONLINE_STATUS.offline)
+
+    def test_deferred_changes_not_calculated(self):
+        data_file = models.DataFile.objects.get(name='test8')
+        with defer_statistics():
+            data_file.online = True
+            # just the file is saved
+            with self.assertNumQueries(1):
+                data_file.save()
+        self.assertEqual(self._stats(self.dreq1).num_online, 2)
+
+    def test_deferred_delete(self):
+        data_file = models.DataFile.objects.get(name='test8')
+        with defer_statistics():
+            data_file.delete()
+        stats = self._stats(self.dreq1)
+        self.assertEqual(stats.num_files, 2)
+        self._assert_matches_recalculation(self.dreq1)
+
+    def test_refresh_statistics(self):
+        models.DataFile.objects.filter(data_request=self.dreq1).update(
+            online=True)
+        self.assertEqual(self._stats(self.dreq1).num_online, 1)
+        refresh_statistics(data_request_ids=[self.dreq1.id, 9999],
+                           data_submission_ids=[self.dsub.id])
+        self.assertEqual(self._stats(self.dreq1).num_online, 3)
+        self.assertEqual(self._stats(self.dsub).num_online, 4)
+
+    def test_refresh_statistics_creates(self):
+        models.DataRequestStatistics.objects.all().delete()
+        refresh_statistics(data_request_ids=[self.dreq2.id])
+        stats = self._stats(self.dreq2)
+        self.assertEqual(stats.num_files, 1)
+        self.assertIsNone(stats.start_time())
+
+    def test_recalculate_not_saved(self):
+        models.DataRequestStatistics.objects.all().delete()
+        stats = models.DataRequestStatistics(data_request_id=self.dreq1.id)
+        stats.recalculate(save=False)
+        self.assertEqual(stats.num_files, 3)
+        self.assertEqual(stats.start_time(), '1950-01-01')
+        self.assertFalse(models.DataRequestStatistics.objects.exists())
+
+
 def _extract_file_metadata(file_path):
     """
     Extracts metadata from file name and returns dictionary.
@@ -0,0 +1,139 @@
+"""
+test_tape_claims.py - unit tests for pdata_app.utils.tape_claims.py
+"""
+from __future__ import unicode_literals, division, absolute_import
+import os
+import shutil
+import tempfile
+import time
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from django.test import TestCase
+
+from pdata_app.utils.tape_claims import TapeUrlClaims, CLAIM_TIMEOUT
+
+
+class TestTapeUrlClaims(TestCase):
+    def setUp(self):
+        self.claim_dir = os.path.join(tempfile.mkdtemp(), 'claims')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.claim_dir))
+        self.claims = TapeUrlClaims(self.claim_dir, 1)
+        self.other_claims = TapeUrlClaims(self.claim_dir, 2)
+        self.tape_url = 'moose:/adhoc/projects/primavera/u-ab123/apm.pp'
+
+    def test_claim(self):
+        self.assertTrue(self.claims.claim(self.tape_url))
+        self.assertEqual(self.claims.owner(self.tape_url), 1)
+        self.assertEqual(len(os.listdir(self.claim_dir)), 1)
+
+    def test_unclaimed(self):
+        self.assertIsNone(self.claims.owner(self.tape_url))
+        self.assertEqual(self.claims.claimed_files(self.tape_url), set())
+
+    def test_claimed_files(self):
+        self.other_claims.claim(self.tape_url, [3, 4])
+        self.assertEqual(self.claims.claimed_files(self.tape_url), {3, 4})
+
+    def test_already_claimed(self):
+        self.other_claims.claim(self.tape_url)
+        self.assertFalse(self.claims.claim(self.tape_url))
+        self.assertEqual(self.claims.owner(self.tape_url), 2)
+
+    def test_different_urls(self):
+        self.other_claims.claim('et:1234')
+        self.assertTrue(self.claims.claim('et:12345'))
+
+    def test_release(self):
+        self.claims.claim(self.tape_url)
+        self.claims.release(self.tape_url)
+        self.assertIsNone(self.claims.owner(self.tape_url))
+        self.assertEqual(os.listdir(self.claim_dir), [])
+
+    def test_release_other(self):
+        self.other_claims.claim(self.tape_url)
+        self.claims.release(self.tape_url)
+        self.assertEqual(self.claims.owner(self.tape_url), 2)
+
+    @mock.patch('pdata_app.utils.tape_claims.pid_running')
+    def test_stale_claim(self, mock_pid_running):
+        self.other_claims.claim(self.tape_url)
+        mock_pid_running.return_value = False
+        self.assertIsNone(self.claims.owner(self.tape_url))
+        self.assertTrue(self.claims.claim(self.tape_url))
+        mock_pid_running.return_value = True
+        self.assertEqual(self.claims.owner(self.tape_url), 1)
+
+    @mock.patch('pdata_app.utils.tape_claims.pid_running')
+    def test_other_host(self, mock_pid_running):
+        mock_pid_running.return_value = False
+        self.other_claims.hostname = 'another-host'
+        self.other_claims.claim(self.tape_url)
+        self.assertFalse(self.claims.claim(self.tape_url))
+
+    def test_refresh(self):
+        self.claims.claim(self.tape_url)
+        claim_path = os.path.join(self.claim_dir,
+                                  os.listdir(self.claim_dir)[0])
+        claim_time = time.time() - CLAIM_TIMEOUT - 60
+        os.utime(claim_path, (claim_time, claim_time))
+        self.claims.refresh(self.tape_url)
+        self.other_claims.hostname = 'another-host'
+        self.assertEqual(self.other_claims.owner(self.tape_url), 1)
+
+    def test_refresh_other(self):
+        self.other_claims.claim(self.tape_url)
+        claim_path = os.path.join(self.claim_dir,
+                                  os.listdir(self.claim_dir)[0])
+        claim_time = time.time() - 60
+        os.utime(claim_path, (claim_time, claim_time))
+        self.claims.refresh(self.tape_url)
+        self.assertEqual(os.stat(claim_path).st_mtime, claim_time)
+
+    def test_refreshing(self):
+        self.claims.claim(self.tape_url)
+        with mock.patch.object(self.claims, 'refresh') as mock_refresh:
+            with self.claims.refreshing([self.tape_url], interval=0.01):
+                time.sleep(0.1)
+            num_refreshes = mock_refresh.call_count
+            time.sleep(0.05)
+        self.assertGreater(num_refreshes, 0)
+        self.assertEqual(mock_refresh.call_count, num_refreshes)
+        mock_refresh.assert_called_with(self.tape_url)
+
+    def test_old_claim(self):
+        self.other_claims.hostname = 'another-host'
+        self.other_claims.claim(self.tape_url)
+        claim_path = os.path.join(self.claim_dir,
+                                  os.listdir(self.claim_dir)[0])
+        claim_time = time.time() - CLAIM_TIMEOUT - 60
+        os.utime(claim_path, (claim_time, claim_time))
+        self.assertIsNone(self.claims.owner(self.tape_url))
+        self.assertTrue(self.claims.claim(self.tape_url))
+        self.assertEqual(self.claims.owner(self.tape_url), 1)
+        self.assertEqual(len(os.listdir(self.claim_dir)), 1)
+
+    @mock.patch('pdata_app.utils.tape_claims.pid_running')
+    def test_stale_claim_replaced_concurrently(self, mock_pid_running):
+        # another process replaces the stale claim immediately after this
+        # retrieval replaces it
+        self.other_claims.claim(self.tape_url)
+        mock_pid_running.return_value = False
+        real_replace = os.replace
+
+        def replace(src, dst):
+            real_replace(src, dst)
+            other_path = '{}.other'.format(dst)
+            with open(other_path, 'w') as fh:
+                fh.write('3 {} {}\n\n'.format(os.getpid() + 1,
+                                               self.claims.hostname))
+            real_replace(other_path, dst)
+
+        with mock.patch('pdata_app.utils.tape_claims.os.replace',
+                        side_effect=replace):
+            self.assertFalse(self.claims.claim(self.tape_url))
+        mock_pid_running.return_value = True
+        self.assertEqual(self.claims.owner(self.tape_url), 3)
+        self.assertEqual(len(os.listdir(self.claim_dir)), 1)
@@ -0,0 +1,122 @@
+"""
+test_validation_store.py - unit tests for pdata_app.utils.validation_store.py
+"""
+from __future__ import unicode_literals, division, absolute_import
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from django.test import TestCase
+
+from pdata_app.utils.validation_store import (ValidationResult,
+                                              ValidationResultStore,
+                                              default_store_path,
+                                              DEFAULT_STORE_DIR)
+
+
+class TestValidationResultStore(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.store = ValidationResultStore(os.path.join(self.temp_dir,
+                                                        'results.db'))
+        self.file_path = os.path.join(self.temp_dir, 'file.nc')
+        with open(self.file_path, 'wb') as fh:
+            fh.write(b'some data')
+        self.result = ValidationResult(True, 'ADLER32', '1', '{"a": 1}')
+
+    def test_empty(self):
+        self.assertIsNone(self.store.get(self.file_path,
+                                         os.stat(self.file_path)))
+
+    def test_set_and_get(self):
+        file_stat = os.stat(self.file_path)
+        self.store.set(self.file_path, file_stat, self.result)
+        self.assertEqual(self.result,
+                         self.store.get(self.file_path, file_stat))
+
+    def test_failed(self):
+        file_stat = os.stat(self.file_path)
+        result = ValidationResult(False, None, None, None)
+        self.store.set(self.file_path, file_stat, result)
+        self.assertEqual(result, self.store.get(self.file_path, file_stat))
+
+    def test_replaced(self):
+        file_stat = os.stat(self.file_path)
+        self.store.set(self.file_path, file_stat,
+                       ValidationResult(False, None, None, None))
+        self.store.set(self.file_path, file_stat, self.result)
+        self.assertEqual(self.result,
+                         self.store.get(self.file_path, file_stat))
+
+    def test_file_changed(self):
+        self.store.set(self.file_path, os.stat(self.file_path), self.result)
+        with open(self.file_path, 'ab') as fh:
+            fh.write(b'more data')
+        self.assertIsNone(self.store.get(self.file_path,
+                                         os.stat(self.file_path)))
+
+    def test_mtime_changed(self):
+        file_stat = os.stat(self.file_path)
+        self.store.set(self.file_path, file_stat, self.result)
+        os.utime(self.file_path, ns=(file_stat.st_atime_ns,
+                                     file_stat.st_mtime_ns + 1000))
+        self.assertIsNone(self.store.get(self.file_path,
+                                         os.stat(self.file_path)))
+
+    def test_other_path(self):
+        file_stat = os.stat(self.file_path)
+        self.store.set(self.file_path, file_stat, self.result)
+        self.assertIsNone(self.store.get('/other/file.nc', file_stat))
+
+    def test_not_prepared(self):
+        file_stat = os.stat(self.file_path)
+        db_path = os.path.join(self.temp_dir, 'results.db')
+        ValidationResultStore(db_path, prepared=False).set(
+            self.file_path, file_stat, self.result
+        )
+        self.assertIsNone(self.store.get(self.file_path, file_stat))
+        self.assertEqual(self.result,
+                         ValidationResultStore(db_path, prepared=False).
+                         get(self.file_path, file_stat))
+
+    def test_prepared_reused_without_prepare(self):
+        file_stat = os.stat(self.file_path)
+        self.store.set(self.file_path, file_stat, self.result)
+        store = ValidationResultStore(os.path.join(self.temp_dir,
+                                                   'results.db'),
+                                      prepared=False)
+        self.assertEqual(self.result, store.get(self.file_path, file_stat))
+
+    def test_old_store_discarded(self):
+        db_path = os.path.join(self.temp_dir, 'old.db')
+        conn = sqlite3.connect(db_path)
+        with conn:
+            conn.execute('CREATE TABLE results (path TEXT NOT NULL PRIMARY '
+                         'KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT '
+                         'NULL, passed INTEGER NOT NULL, checksum_type TEXT, '
+                         'checksum_value TEXT, metadata TEXT)')
+        conn.close()
+        store = ValidationResultStore(db_path)
+        file_stat = os.stat(self.file_path)
+        store.set(self.file_path, file_stat, self.result)
+        self.assertEqual(self.result, store.get(self.file_path, file_stat))
+
+    def test_directory_created(self):
+        db_path = os.path.join(self.temp_dir, 'a', 'b', 'results.db')
+        store = ValidationResultStore(db_path)
+        self.assertIsNone(store.get(self.file_path, os.stat(self.file_path)))
+        self.assertTrue(os.path.exists(db_path))
+
+
+class TestDefaultStorePath(TestCase):
+    def test_outside_submission(self):
+        store_path = default_store_path('/gws/incoming/submission')
+        self.assertEqual(os.path.dirname(store_path), DEFAULT_STORE_DIR)
+
+    def test_keyed_on_path(self):
+        self.assertEqual(default_store_path('/gws/incoming/submission'),
+                         default_store_path('/gws/incoming/submission/'))
+        self.assertNotEqual(default_store_path('/gws/incoming/submission'),
+                            default_store_path('/gws/incoming/other'))
@@ -0,0 +1,206 @@
+"""
+Unit tests for pdata_app.views
+"""
+from __future__ import unicode_literals, division, absolute_import
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from pdata_app import models
+from pdata_app.tests.common import make_example_files
+from pdata_app.utils.dbapi import get_or_create
+
+
+class ListViewQueryCountMixin(object):
+    """
+    Checks that the number of database queries used to display a page of a
+    list view does not depend on the number of rows in the page.
+    """
+    url_name = None
+
+    def _count_queries(self, query_string=''):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse(self.url_name) + query_string)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def _add_rows(self):
+        raise NotImplementedError()
+
+    def test_query_count_independent_of_rows(self):
+        num_queries = self._count_queries()
+        self._add_rows()
+        self.assertEqual(self._count_queries(), num_queries)
+
+    def test_sorted_query_count_independent_of_rows(self):
+        for column in self.sortable_columns:
+            query_string = '?sort={}'.format(column)
+            num_queries = self._count_queries(query_string)
+            self._add_rows()
+            self.assertEqual(self._count_queries(query_string), num_queries)
+
+
+class TestReceivedDataRequestList(ListViewQueryCountMixin, TestCase):
+    """
+    Test the received data requests list view
+    """
+    url_name = 'received_data'
+    sortable_columns = ('num_files', 'total_data_size', 'start_time',
+                        'online_status', '-num_issues')
+
+    def setUp(self):
+        make_example_files(self)
+
+    def _add_rows(self):
+        data_file = self.data_file1
+        for dreq in (self.dreq3, self.dreq4):
+            data_file.pk = None
+            data_file.name = 'new_{}'.format(
+                models.DataFile.objects.count())
+            data_file.data_request = dreq
+            data_file.save()
+
+    def test_num_queries(self):
+        self._add_rows()
+        self.assertEqual(self._count_queries(), 2)
+
+    def test_sort_num_files(self):
+        self._add_rows()
+        response = self.client.get(reverse(self.url_name) +
+                                   '?sort=-num_files')
+        table_rows = list(response.context['table'].page.object_list)
+        self.assertEqual(table_rows[0].record, self.dreq1)
+
+    def test_missing_statistics_not_saved(self):
+        models.DataRequestStatistics.objects.all().delete()
+        response = self.client.get(reverse(self.url_name) +
+                                   '?sort=-num_files')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '>3</a>')
+        self.assertFalse(models.DataRequestStatistics.objects.exists())
+
+
+class TestDataSubmissionList(ListViewQueryCountMixin, TestCase):
+    """
+    Test the data submissions list view
+    """
+    url_name = 'data_submissions'
+    sortable_columns = ('num_files', 'earliest_date', 'online_status')
+
+    def setUp(self):
+        make_example_files(self)
+
+    def _add_rows(self):
+        data_file = self.data_file1
+        for _index in range(2):
+            new_dir = '/new/dir{}'.format(
+                models.DataSubmission.objects.count())
+            dsub = get_or_create(models.DataSubmission,
+                                 incoming_directory=new_dir,
+                                 directory=new_dir, user=self.user)
+            data_file.pk = None
+            data_file.name = 'new_{}'.format(
+                models.DataFile.objects.count())
+            data_file.data_submission = dsub
+            data_file.save()
+
+    def test_num_queries(self):
+        self._add_rows()
+        self.assertEqual(self._count_queries(), 2)
+
+
+class TestDataFileList(ListViewQueryCountMixin, TestCase):
+    """
+    Test the data files list view
+    """
+    url_name = 'data_files'
+    sortable_columns = ('num_dataissues', 'institute')
+
+    def setUp(self):
+        make_example_files(self)
+        self.data_issue = models.DataIssue.objects.create(issue='an issue',
+                                                          reporter=self.user)
+        self.data_issue.data_file.add(self.data_file1, self.data_file2)
+
+    def _add_rows(self):
+        data_file = self.data_file1
+        for _index in range(3):
+            data_file.pk = None
+            data_file.name = 'new_{}'.format(
+                models.DataFile.objects.count())
+            data_file.save()
+            models.Checksum.objects.create(data_file=data_file,
+                                           checksum_value='12345678',
+                                           checksum_type='ADLER32')
+            self.data_issue.data_file.add(data_file)
+
+    def test_num_queries(self):
+        self._add_rows()
+        self.assertEqual(self._count_queries(), 3)
+
+    def test_num_dataissues(self):
+        second_issue = models.DataIssue.objects.create(issue='another',
+                                                       reporter=self.user)
+        second_issue.data_file.add(self.data_file1)
+        response = self.client.get(reverse(self.url_name) +
+                                   '?sort=-num_dataissues')
+        table_rows = list(response.context['table'].page.object_list)
+        self.assertEqual(table_rows[0].record, self.data_file1)
+        self.assertEqual(table_rows[0].record.num_dataissues, 2)
+
+    def test_num_dataissues_filtered_by_issue(self):
+        second_issue = models.DataIssue.objects.create(issue='another',
+                                                       reporter=self.user)
+        second_issue.data_file.add(self.data_file1)
+        response = self.client.get(reverse(self.url_name) +
+                                   '?data_issue={}'.format(second_issue.id))
+        table_rows = list(response.context['table'].page.object_list)
+        self.assertEqual(len(table_rows), 1)
+        self.assertEqual(table_rows[0].record.num_dataissues, 2)
+
+    def test_checksum(self):
+        models.Checksum.objects.create(data_file=self.data_file1,
+                                       checksum_value='12345678',
+                                       checksum_type='ADLER32')
+        response = self.client.get(reverse(self.url_name) +
+                                   '?name=test1')
+        self.assertContains(response, 'ADLER32: 12345678')
+
+
+class TestRetrievalRequestList(ListViewQueryCountMixin, TestCase):
+    """
+    Test the retrieval requests list view
+    """
+    url_name = 'retrieval_requests'
+    sortable_columns = ('date_created', '-end_year')
+
+    def setUp(self):
+        make_example_files(self)
+        self._add_rows()
+
+    def _add_rows(self):
+        for data_reqs in ((self.dreq1, self.dreq2), (self.dreq1, self.dreq3)):
+            ret_req = models.RetrievalRequest.objects.create(
+                requester=self.user, start_year=1950, end_year=1975)
+            ret_req.data_request.add(*data_reqs)
+
+    def test_num_queries(self):
+        self._add_rows()
+        self.assertEqual(self._count_queries(), 5)
+
+    def test_sizes(self):
+        self.data_file1.tape_url = 'et:1234'
+        self.data_file1.save()
+        ret_req = models.RetrievalRequest.objects.create(
+            requester=self.user, start_year=1950, end_year=1975)
+        ret_req.data_request.add(self.dreq1, self.dreq2)
+        response = self.client.get(reverse(self.url_name) +
+                                   '?id={}'.format(ret_req.id))
+        table = response.context['table']
+        row = list(table.page.object_list)[0]
+        self.assertEqual(row.record, ret_req)
+        self.assertEqual(row.get_cell('req_size'), '7\xa0bytes')
+        self.assertEqual(row.get_cell('retrieval_size'), '4\xa0bytes')
+        self.assertIn('et:1234', row.get_cell('tape_urls'))
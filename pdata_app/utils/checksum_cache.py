@@ -0,0 +1,107 @@
+"""
+checksum_cache.py - a persistent cache of the checksums calculated for files
+so that unchanged files do not have to be read again.
+"""
+from __future__ import unicode_literals, division, absolute_import
+
+from contextlib import contextmanager
+import sqlite3
+
+# The number of seconds to wait for another process to release a lock on the
+# cache database
+CACHE_TIMEOUT = 30
+
+
+class ChecksumCache(object):
+    """
+    A SQLite database of files' checksums. Each entry is identified by the
+    file's device and inode and is only used if the file's size and
+    modification time are unchanged since the checksum was calculated. Any
+    changes to the file therefore automatically invalidate its entries, which
+    are replaced the next time that the file's checksum is calculated.
+
+    A new connection is made for each operation so that the cache can be
+    shared between threads and processes.
+    """
+    def __init__(self, db_path):
+        """
+        :param str db_path: the path to the SQLite database file, which is
+            created if it doesn't exist
+        """
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS checksums ('
+                'device INTEGER NOT NULL, '
+                'inode INTEGER NOT NULL, '
+                'checksum_type TEXT NOT NULL, '
+                'size INTEGER NOT NULL, '
+                'mtime_ns INTEGER NOT NULL, '
+                'checksum_value TEXT NOT NULL, '
+                'PRIMARY KEY (device, inode, checksum_type))'
+            )
+
+    def get(self, stat_result, checksum_types):
+        """
+        Get any cached checksums for a file.
+
+        :param os.stat_result stat_result: the result of os.stat() on the file
+        :param list checksum_types: the types of checksum to find
+        :returns: the checksum types as keys and the checksums as values for
+            the types that are in the cache and are still valid
+        :rtype: dict
+        """
+        checksum_types = list(checksum_types)
+        if not checksum_types:
+            return {}
+        query = ('SELECT checksum_type, checksum_value FROM checksums '
+                 'WHERE device = ? AND inode = ? AND size = ? AND '
+                 'mtime_ns = ? AND checksum_type IN ({})'.
+                 format(', '.join('?' * len(checksum_types))))
+        with self._connect() as conn:
+            rows = conn.execute(query, file_key(stat_result) +
+                                checksum_types).fetchall()
+        return dict(rows)
+
+    def set(self, stat_result, checksums):
+        """
+        Add a file's checksums to the cache, replacing any existing values of
+        the same types.
+
+        :param os.stat_result stat_result: the result of os.stat() on the file
+            before its checksums were calculated
+        :param dict checksums: the checksum types as keys and the checksums
+            as values
+        """
+        device, inode, size, mtime_ns = file_key(stat_result)
+        with self._connect() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO checksums (device, inode, '
+                'checksum_type, size, mtime_ns, checksum_value) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(device, inode, checksum_type, size, mtime_ns, value)
+                 for checksum_type, value in checksums.items()]
+            )
+
+    @contextmanager
+    def _connect(self):
+        """
+        A context manager providing a new connection to the database. Any
+        changes are committed and the connection is closed on exit.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=CACHE_TIMEOUT)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+def file_key(stat_result):
+    """
+    :param os.stat_result stat_result: the result of os.stat() on a file
+    :returns: the values that identify the file and its contents
+    :rtype: list
+    """
+    return [stat_result.st_dev, stat_result.st_ino, stat_result.st_size,
+            stat_result.st_mtime_ns]
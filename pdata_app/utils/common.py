@@ -3,17 +3,20 @@ common.py - several functions that are used throughout the pdata_app
 """
 from __future__ import unicode_literals, division, absolute_import
 
-import datetime
+import hashlib
 import logging
+import mmap
 import os
 from pathlib import Path
 import random
 import re
+import sqlite3
 from subprocess import check_output, CalledProcessError, STDOUT
 from typing import Union
 from six.moves import zip_longest
 from six import string_types
 from tempfile import gettempdir
+import zlib
 
 # If Iris isn't available then try
 # https://github.com/PRIMAVERA-H2020/partial_date_time
@@ -24,7 +27,9 @@ except ImportError:
 import cftime
 import cf_units
 
-from django.db.models import Sum
+from django.db.models import F, Q, Sum
+
+from pdata_app.utils.checksum_cache import ChecksumCache, file_key
 
 PAUSE_FILES = {
     'et:': '/gws/nopw/j04/primavera5/.tape_pause/pause_et',
@@ -67,39 +72,213 @@ def safe_strftime(dt, format):
     return result
 
 
-def md5(fpath):
-    return _checksum('md5sum', fpath)
+def md5(fpath, use_cache=True):
+    return _checksum('md5sum', fpath, use_cache)
 
 
-def sha256(fpath):
-    return _checksum('sha256sum', fpath)
+def sha256(fpath, use_cache=True):
+    return _checksum('sha256sum', fpath, use_cache)
 
 
-def adler32(fpath):
-    return _checksum('adler32', fpath)
+def adler32(fpath, use_cache=True):
+    return _checksum('adler32', fpath, use_cache)
 
 
-def _checksum(checksum_method, file_path):
+def _checksum(checksum_method, file_path, use_cache=True):
     """
-    Runs program `checksum_method` on `file_path` and returns the result or
-    None if running the program was unsuccessful.
+    Calculates the checksum of `file_path` with the method that the program
+    `checksum_method` uses and returns the result or None if the file could
+    not be read. The checksum is calculated in this process rather than by
+    running the program.
 
-    :param str checksum_method:
+    :param str checksum_method: the name of the program, or the checksum type
     :param str file_path:
+    :param bool use_cache: use and update the group workspace's checksum
+        cache
     :return: the checksum or None if it cannot be calculated
     """
+    checksum_type = CHECKSUM_PROGRAMS.get(checksum_method, checksum_method)
     try:
-        # shell=True is not a security risk here. The input has previously been
-        # checked and this is only called if file_path has been confirmed as
-        # being a valid file
-        ret_val = check_output("{} '{}'".format(checksum_method, file_path),
-                               shell=True).decode('utf-8')
-        # split on white space and return the first part
-        checksum = ret_val.split()[0]
-    except (CalledProcessError, OSError):
-        checksum = None
+        checksums = get_checksums(file_path, [checksum_type], use_cache)
+    except (IOError, OSError):
+        return None
+
+    return checksums[checksum_type]
+
+
+def get_checksums(file_path, checksum_types, use_cache=True):
+    """
+    Get one or more checksums of a file. If the file is in a group workspace
+    then any values in the workspace's checksum cache are used if the file
+    hasn't changed since they were calculated. Any checksums that have to be
+    calculated are added to the cache.
+
+    :param str file_path: the path of the file to checksum
+    :param list checksum_types: the types of checksum to get, from
+        vocabs.CHECKSUM_TYPES
+    :param bool use_cache: use and update the group workspace's checksum
+        cache
+    :returns: the checksum types as keys and the checksums as values
+    :rtype: dict
+    :raises ValueError: if an unknown checksum type is requested
+    :raises OSError: if the file can't be read
+    """
+    cache = _get_checksum_cache(file_path) if use_cache else None
+    if cache is None:
+        return calculate_checksums(file_path, checksum_types)
+
+    file_stat = os.stat(file_path)
+    try:
+        checksums = cache.get(file_stat, checksum_types)
+    except sqlite3.Error as exc:
+        logger.debug('Unable to read checksum cache {}: {}'.
+                     format(cache.db_path, exc))
+        checksums = {}
+
+    missing_types = [checksum_type for checksum_type in checksum_types
+                     if checksum_type not in checksums]
+    if not missing_types:
+        return checksums
+
+    calculated = calculate_checksums(file_path, missing_types)
+    checksums.update(calculated)
+
+    # don't cache values calculated while the file was being changed
+    if file_key(os.stat(file_path)) == file_key(file_stat):
+        try:
+            cache.set(file_stat, calculated)
+        except sqlite3.Error as exc:
+            logger.debug('Unable to update checksum cache {}: {}'.
+                         format(cache.db_path, exc))
+
+    return checksums
+
+
+def _get_checksum_cache(file_path):
+    """
+    Get the checksum cache for the group workspace that a file is in.
+
+    :param str file_path: the path of the file
+    :returns: the cache or None if the file isn't in a group workspace or
+        the cache can't be opened
+    :rtype: pdata_app.utils.checksum_cache.ChecksumCache
+    """
+    try:
+        gws = get_gws_any_dir(os.path.abspath(file_path))
+    except RuntimeError:
+        return None
 
-    return checksum
+    cache_path = os.path.join(gws, CHECKSUM_CACHE_NAME)
+    if cache_path not in _checksum_caches:
+        try:
+            _checksum_caches[cache_path] = ChecksumCache(cache_path)
+        except sqlite3.Error as exc:
+            logger.debug('Unable to open checksum cache {}: {}'.
+                         format(cache_path, exc))
+            _checksum_caches[cache_path] = None
+
+    return _checksum_caches[cache_path]
+
+
+class _Adler32(object):
+    """
+    Calculates an Adler-32 checksum with the same interface as the hashlib
+    objects.
+    """
+    def __init__(self):
+        self._value = zlib.adler32(b'')
+
+    def update(self, data):
+        self._value = zlib.adler32(data, self._value)
+
+    def hexdigest(self):
+        """
+        The adler32 program outputs the checksum as an unsigned decimal
+        number and so, despite this method's name, this is what is returned
+        to match the values in the database.
+        """
+        return str(self._value & 0xffffffff)
+
+
+CHECKSUM_ALGORITHMS = {
+    'ADLER32': _Adler32,
+    'MD5': hashlib.md5,
+    'SHA256': hashlib.sha256,
+}
+
+# The checksum types that each of the external programs calculated
+CHECKSUM_PROGRAMS = {
+    'adler32': 'ADLER32',
+    'md5sum': 'MD5',
+    'sha256sum': 'SHA256',
+}
+
+# The name of the checksum cache in the top directory of each group workspace
+CHECKSUM_CACHE_NAME = '.checksum_cache.sqlite3'
+
+# The checksum caches that have been opened, with their paths as keys
+_checksum_caches = {}
+
+# The size of the blocks that files are read in when calculating checksums.
+# This is a multiple of the block sizes of the file systems used.
+CHECKSUM_BLOCK_SIZE = 8 * 2 ** 20
+
+
+def calculate_checksums(file_path, checksum_types,
+                        block_size=CHECKSUM_BLOCK_SIZE, use_mmap=False):
+    """
+    Calculate one or more checksums of a file in a single pass through it.
+    The values returned are identical to those from the adler32, md5sum and
+    sha256sum programs.
+
+    :param str file_path: the path of the file to checksum
+    :param list checksum_types: the types of checksum to calculate, from
+        vocabs.CHECKSUM_TYPES
+    :param int block_size: the number of bytes to read at a time
+    :param bool use_mmap: memory map the file rather than reading it into a
+        buffer
+    :returns: the checksum types as keys and the checksums as values
+    :rtype: dict
+    :raises ValueError: if an unknown checksum type is requested
+    :raises OSError: if the file can't be read
+    """
+    try:
+        checksums = {checksum_type: CHECKSUM_ALGORITHMS[checksum_type]()
+                     for checksum_type in checksum_types}
+    except KeyError as exc:
+        raise ValueError('Unknown checksum type {}'.format(exc.args[0]))
+    updates = [checksum.update for checksum in checksums.values()]
+
+    with open(file_path, 'rb', buffering=0) as fh:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        if use_mmap and os.fstat(fh.fileno()).st_size:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    for offset in range(0, len(view), block_size):
+                        block = view[offset:offset + block_size]
+                        for update in updates:
+                            update(block)
+                        block.release()
+                finally:
+                    view.release()
+        else:
+            buf = bytearray(block_size)
+            view = memoryview(buf)
+            while True:
+                num_bytes = fh.readinto(buf)
+                if not num_bytes:
+                    break
+                block = view[:num_bytes]
+                for update in updates:
+                    update(block)
+                block.release()
+            view.release()
+
+    return {checksum_type: checksum.hexdigest()
+            for checksum_type, checksum in checksums.items()}
 
 
 def make_partial_date_time(date_string):
@@ -320,6 +499,38 @@ def standardise_time_unit(time_float, time_unit, standard_unit, calendar):
     return corrected_time
 
 
+def calculate_file_years(start_time, end_time, time_units, calendar):
+    """
+    Calculate the years that a file's data starts and ends in. A file that
+    ends at exactly midnight at the start of a year is treated as ending in
+    the previous year as it doesn't contain any data from that year.
+
+    :param float start_time: the file's start time
+    :param float end_time: the file's end time
+    :param str time_units: the units of the times
+    :param str calendar: the cftime calendar
+    :returns: a tuple of the start year and end year, either of which is None
+        if it can't be calculated
+    """
+    if not time_units or not calendar:
+        return None, None
+
+    start_year = None
+    end_year = None
+    if start_time is not None:
+        start_year = cf_units.num2date(start_time, time_units, calendar).year
+    if end_time is not None:
+        end_date = cf_units.num2date(end_time, time_units, calendar)
+        end_year = end_date.year
+        at_year_start = ((end_date.month, end_date.day, end_date.hour,
+                          end_date.minute, end_date.second) ==
+                         (1, 1, 0, 0, 0))
+        if at_year_start and start_time is not None and end_time > start_time:
+            end_year -= 1
+
+    return start_year, end_year
+
+
 def is_same_gws(path1, path2):
     """
     Check that two paths both start with the same group workspace name.
@@ -522,33 +733,105 @@ def get_request_size(data_reqs, start_year, end_year,
         msg = 'online and offline arguments cannot both be True'
         raise ValueError(msg)
 
-    request_sizes = []
-    for req in data_reqs:
-        if online:
-            all_files = req.datafile_set.filter(online=True)
-        elif offline:
-            all_files = req.datafile_set.filter(online=False)
-        else:
-            all_files = req.datafile_set.all()
+    if online:
+        size_type = 'online'
+    elif offline:
+        size_type = 'offline'
+    else:
+        size_type = 'total'
 
-        filtered_files = date_filter_files(all_files, start_year, end_year)
-        if filtered_files:
-            req_size = filtered_files.aggregate(Sum('size'))['size__sum']
-            if req_size is None:
-                req_size = 0
-        else:
-            req_size = 0
-        request_sizes.append(req_size)
+    request_sizes = get_request_sizes(data_reqs, start_year, end_year)
+
+    return sum([sizes[size_type] for sizes in request_sizes.values()])
+
+
+def get_request_sizes(data_reqs, start_year, end_year):
+    """
+    Find the total, online and offline sizes in bytes of the files in each of
+    the data requests between the years specified using a single query.
+
+    :param Iterable data_reqs: an iterable of data requests to get the sizes
+        of. This is typically a Django queryset or a list.
+    :param int start_year: the first year of the range to find.
+    :param int end_year: the final year of the range to find.
+    :returns: the data request ids as keys and dictionaries containing the
+        `total`, `online` and `offline` sizes as values. Data requests without
+        any files in the range are not included.
+    :rtype: dict
+    """
+    from pdata_app.models import DataFile
 
-    return sum(request_sizes)
+    data_files = date_filter_files(
+        DataFile.objects.filter(data_request__in=data_reqs),
+        start_year, end_year
+    )
+
+    return _sum_sizes(data_files, 'data_request')
+
+
+def get_retrieval_sizes(retrieval_reqs):
+    """
+    Find the total, online and offline sizes in bytes of the files in each of
+    the retrieval requests using a single query. Each retrieval request's own
+    start and end years are used to select its files in the same way as
+    `date_filter_files()`.
+
+    :param Iterable retrieval_reqs: an iterable of retrieval requests to get
+        the sizes of. This is typically a Django queryset or a list.
+    :returns: the retrieval request ids as keys and dictionaries containing
+        the `total`, `online` and `offline` sizes as values. Retrieval requests
+        without any files are not included.
+    :rtype: dict
+    """
+    from pdata_app.models import DataFile
+
+    # All of the conditions must be in the same call to filter() so that they
+    # all refer to the same join to the retrieval requests
+    data_files = DataFile.objects.filter(
+        Q(data_request__retrievalrequest__start_year__isnull=True) |
+        Q(data_request__retrievalrequest__end_year__isnull=True) |
+        Q(start_year__isnull=True) |
+        Q(start_year__lte=F('data_request__retrievalrequest__end_year'),
+          end_year__gte=F('data_request__retrievalrequest__start_year')),
+        data_request__retrievalrequest__in=retrieval_reqs
+    )
+
+    return _sum_sizes(data_files, 'data_request__retrievalrequest')
+
+
+def _sum_sizes(data_files, group_by):
+    """
+    Sum the total, online and offline sizes of the data files grouped by the
+    specified field.
+
+    :param django.db.models.query.QuerySet data_files: the files to sum
+    :param str group_by: the name of the field to group the files by
+    :returns: the values of `group_by` as keys and dictionaries containing
+        the `total`, `online` and `offline` sizes as values
+    :rtype: dict
+    """
+    sizes = {}
+    for group in (data_files.order_by().values(group_by).
+                  annotate(total=Sum('size'),
+                           online=Sum('size', filter=Q(online=True)))):
+        total = group['total'] or 0
+        online = group['online'] or 0
+        sizes[group[group_by]] = {
+            'total': total,
+            'online': online,
+            'offline': total - online
+        }
+
+    return sizes
 
 
 def date_filter_files(data_files, start_year, end_year):
     """
-    Filter a set of data file model objects and return those that lie between
-    or include the 1st January in the start year and the last day of the end
-    year. The data files are assumed to be from a common source and so they all
-    have the same time_units and calendar.
+    Filter a set of data file model objects and return those that contain any
+    data between the 1st January in the start year and the last day of the
+    end year. Files without a start year are always included, whether they
+    don't have any times or their years haven't been calculated yet, and no
+    filtering is done unless both years are specified.
 
     :param django.db.models.query.QuerySet data_files: the data files to
         filter by date
@@ -557,44 +840,13 @@ def date_filter_files(data_files, start_year, end_year):
     :returns: the filtered files
     :rtype: django.db.models.query.QuerySet
     """
-    if data_files:
-        time_units = data_files[0].time_units
-        calendar = data_files[0].calendar
-    else:
-        return None
+    if start_year is None or end_year is None:
+        return data_files
 
-    if start_year is not None and time_units and calendar:
-        start_float = cf_units.date2num(
-            datetime.datetime(start_year, 1, 1), time_units,
-            calendar
-        )
-    else:
-        start_float = None
-    if end_year is not None and time_units and calendar:
-        end_float = cf_units.date2num(
-            datetime.datetime(end_year + 1, 1, 1), time_units,
-            calendar
-        )
-    else:
-        end_float = None
-
-    timeless_files = data_files.filter(start_time__isnull=True)
-
-    if start_float is not None and end_float is not None:
-        between_files = (data_files.exclude(start_time__isnull=True).
-                         filter(start_time__gte=start_float,
-                                end_time__lt=end_float))
-        start_straddle = (data_files.exclude(start_time__isnull=True).
-                          filter(start_time__lt=start_float,
-                                 end_time__gt=start_float))
-        end_straddle = (data_files.exclude(start_time__isnull=True).
-                        filter(start_time__lt=end_float,
-                               end_time__gt=end_float))
-        data_files = between_files | start_straddle | end_straddle
-    else:
-        data_files = data_files.exclude(start_time__isnull=True)
-
-    return (timeless_files | data_files).distinct()
+    return data_files.filter(
+        Q(start_year__isnull=True) |
+        Q(start_year__lte=end_year, end_year__gte=start_year)
+    )
 
 
 def delete_drs_dir(directory, mip_eras=('PRIMAVERA', 'CMIP6')):
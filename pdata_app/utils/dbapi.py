@@ -4,8 +4,13 @@ Various utility functions that work with pdata_app data objects
 from __future__ import unicode_literals, division, absolute_import
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 
-from pdata_app.models import Settings
+from pdata_app.models import (Settings, DataRequest, DataSubmission, DataFile,
+                              DataRequestStatistics, DataSubmissionStatistics)
+
+# The number of objects to save in each query when updating in bulk
+BULK_BATCH_SIZE = 1000
 
 
 def insert(cls, **props):
@@ -73,3 +78,62 @@ def is_paused():
         is_paused_val = False
 
     return is_paused_val
+
+
+def refresh_statistics(data_request_ids=None, data_submission_ids=None):
+    """
+    Recalculate the DataRequestStatistics and DataSubmissionStatistics for
+    the specified parent objects, creating them if they don't already exist.
+    Any ids that no longer exist in the database are ignored. This must be
+    called after any bulk operations that change DataFiles without sending
+    signals, for example QuerySet.update() or bulk_create().
+
+    :param data_request_ids: an iterable of DataRequest ids
+    :param data_submission_ids: an iterable of DataSubmission ids
+    """
+    std_units = Settings.get_solo().standard_time_units
+
+    for parent_class, stats_class, parent_ids in (
+            (DataRequest, DataRequestStatistics, data_request_ids),
+            (DataSubmission, DataSubmissionStatistics, data_submission_ids)):
+        if not parent_ids:
+            continue
+        for parent_id in set(parent_ids):
+            if not parent_class.objects.filter(pk=parent_id).exists():
+                continue
+            stats, _created = stats_class.objects.get_or_create(
+                **{stats_class.parent_field + '_id': parent_id}
+            )
+            stats.recalculate(std_units)
+
+
+def bulk_update_files(data_files, fields, batch_size=BULK_BATCH_SIZE):
+    """
+    Save the changes to the specified fields of many DataFiles using a few
+    queries rather than one per file. Each batch of files is saved in its own
+    transaction so that the rows of a large retrieval aren't all locked
+    until the final batch is saved. Signals are not sent and so the
+    statistics of the files' DataRequests and DataSubmissions are
+    recalculated afterwards.
+
+    :param list data_files: the DataFiles that have been changed
+    :param list fields: the names of the fields to save
+    :param int batch_size: the number of files to save in each transaction
+    """
+    data_files = list(data_files)
+    if not data_files:
+        return
+
+    for start in range(0, len(data_files), batch_size):
+        with transaction.atomic():
+            DataFile.objects.bulk_update(
+                data_files[start:start + batch_size], fields
+            )
+
+    refresh_statistics(
+        [data_file.data_request_id for data_file in data_files],
+        [data_file.data_submission_id for data_file in data_files]
+    )
+
+    for data_file in data_files:
+        data_file._loaded_values = data_file.get_statistics_values()
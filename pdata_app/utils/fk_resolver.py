@@ -0,0 +1,119 @@
+"""
+fk_resolver.py - find the objects that data files' foreign keys refer to from
+tables that are loaded into memory once, rather than querying the database
+for every file.
+"""
+from __future__ import unicode_literals, division, absolute_import
+
+from pdata_app.models import (ActivityId, ClimateModel, DataRequest,
+                              Experiment, Institute, Project, VariableRequest)
+
+
+class ForeignKeyResolver(object):
+    """
+    Loads the vocabulary tables and all of the DataRequests and their
+    VariableRequests in a few queries. The objects that a file's metadata
+    refers to can then be found without any further database queries. Each
+    related object is only loaded once and is shared by all of the
+    DataRequests that refer to it.
+    """
+    # The metadata names of the vocabulary tables, which are all identified
+    # by their short_name
+    VOCABULARIES = (
+        ('project', Project),
+        ('climate_model', ClimateModel),
+        ('experiment', Experiment),
+        ('institute', Institute),
+        ('activity_id', ActivityId),
+    )
+
+    def __init__(self):
+        self._vocabularies = {}
+        vocab_ids = {}
+        for object_str, object_type in self.VOCABULARIES:
+            objects = list(object_type.objects.all())
+            vocab_ids[object_str] = {obj.id: obj for obj in objects}
+            self._vocabularies[object_str] = {obj.short_name: obj
+                                              for obj in objects}
+
+        variables = VariableRequest.objects.in_bulk()
+
+        self._by_cmor_name = {}
+        self._by_var_name = {}
+        for data_req in DataRequest.objects.all():
+            data_req.project = vocab_ids['project'][data_req.project_id]
+            data_req.institute = vocab_ids['institute'][data_req.institute_id]
+            data_req.climate_model = (
+                vocab_ids['climate_model'][data_req.climate_model_id]
+            )
+            data_req.experiment = (
+                vocab_ids['experiment'][data_req.experiment_id]
+            )
+            data_req.variable_request = (
+                variables[data_req.variable_request_id]
+            )
+
+            var_req = data_req.variable_request
+            common_key = (data_req.project_id, data_req.institute_id,
+                          data_req.climate_model_id, data_req.experiment_id,
+                          var_req.table_name, data_req.rip_code)
+            self._by_cmor_name.setdefault(
+                common_key + (var_req.cmor_name,), []
+            ).append(data_req)
+            self._by_var_name.setdefault(
+                common_key + (var_req.var_name,), []
+            ).append(data_req)
+
+    def get_vocabulary(self, object_str, short_name):
+        """
+        Find a vocabulary object from its short name.
+
+        :param str object_str: the vocabulary's name in the metadata, for
+            example `climate_model`
+        :param str short_name: the short name of the object to find
+        :returns: the object or None if it doesn't exist
+        """
+        return self._vocabularies[object_str].get(short_name)
+
+    def get_data_requests(self, project, institute, climate_model,
+                          experiment, table_name, rip_code, cmor_name=None,
+                          var_name=None, dimension=None):
+        """
+        Find the DataRequests that match the values specified. Exactly one of
+        `cmor_name` or `var_name` must be specified.
+
+        :param pdata_app.models.Project project: the project
+        :param pdata_app.models.Institute institute: the institute
+        :param pdata_app.models.ClimateModel climate_model: the model
+        :param pdata_app.models.Experiment experiment: the experiment
+        :param str table_name: the variable's MIP table
+        :param str rip_code: the variant label
+        :param str cmor_name: the variable's CMOR name
+        :param str var_name: the variable's output name
+        :param str dimension: if specified then only DataRequests whose
+            variable's dimensions contain this string, ignoring case, are
+            returned
+        :returns: the matching DataRequests
+        :rtype: list
+        :raises ValueError: if not exactly one of `cmor_name` and `var_name`
+            is specified
+        """
+        if (cmor_name is None) == (var_name is None):
+            raise ValueError('Exactly one of cmor_name and var_name must be '
+                             'specified')
+
+        common_key = (project.id, institute.id, climate_model.id,
+                      experiment.id, table_name, rip_code)
+        if cmor_name is not None:
+            data_reqs = self._by_cmor_name.get(common_key + (cmor_name,), [])
+        else:
+            data_reqs = self._by_var_name.get(common_key + (var_name,), [])
+
+        if dimension is not None:
+            data_reqs = [
+                data_req for data_req in data_reqs
+                if dimension.lower() in
+                data_req.variable_request.dimensions.lower()
+            ]
+
+        return list(data_reqs)
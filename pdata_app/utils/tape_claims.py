@@ -0,0 +1,235 @@
+"""
+tape_claims.py - files that record which retrieval is restoring each tape
+URL so that when several retrievals need data from the same tape URL it is
+only read from tape once.
+"""
+from __future__ import unicode_literals, division, absolute_import
+
+from contextlib import contextmanager
+import errno
+import os
+import socket
+import threading
+import time
+from urllib.parse import quote
+
+# The exit status used by retrieve_request.py when all of the files that it
+# restored itself are online but some of the files that it needs are still
+# being restored by other retrievals
+RETRIEVAL_WAITING_EXIT_STATUS = 75
+
+# The default directory to keep the claim files in
+DEFAULT_CLAIM_DIR = os.path.expanduser('~/.tape_url_claims')
+
+# The number of seconds between refreshes of the claims that a retrieval
+# holds
+CLAIM_REFRESH_INTERVAL = 5 * 60
+
+# The number of seconds since a claim was last refreshed after which it is
+# ignored, so that claims left by processes that stopped on other hosts
+# expire soon after they stop
+CLAIM_TIMEOUT = 30 * 60
+
+
+class TapeUrlClaims(object):
+    """
+    A directory of claim files, one for each tape URL that is being restored.
+    Each claim file contains the id of the retrieval that is restoring the
+    URL, the id and host of its process and the ids of the files from the
+    URL that it is restoring. The retrieval refreshes the modification time
+    of its claim files while it is restoring the URLs. A claim is ignored
+    and replaced if its process has stopped running without releasing it or
+    if it hasn't been refreshed for `CLAIM_TIMEOUT`. Claims made on other
+    hosts can't be checked and so are assumed to be live until they time
+    out.
+    """
+    def __init__(self, claim_dir, retrieval_id):
+        """
+        :param str claim_dir: the directory to keep the claim files in, which
+            is created if it doesn't exist
+        :param int retrieval_id: the id of the retrieval making the claims
+        """
+        self.claim_dir = claim_dir
+        self.retrieval_id = retrieval_id
+        self.hostname = socket.gethostname()
+        if not os.path.exists(claim_dir):
+            os.makedirs(claim_dir)
+
+    def claim(self, tape_url, file_ids=()):
+        """
+        Claim a tape URL for this retrieval.
+
+        :param str tape_url: the tape URL to claim
+        :param list file_ids: the ids of the files that this retrieval will
+            restore from the URL
+        :returns: True if the URL was claimed or False if another retrieval
+            is already restoring it
+        :rtype: bool
+        """
+        claim_path = self._claim_path(tape_url)
+        # the claim is written to a temporary file and then linked into
+        # place so that the claim file is never seen without its contents
+        temp_path = '{}.{}.tmp'.format(claim_path, os.getpid())
+        with open(temp_path, 'w') as fh:
+            fh.write('{} {} {}\n'.format(self.retrieval_id, os.getpid(),
+                                         self.hostname))
+            fh.write(' '.join(str(file_id) for file_id in file_ids) + '\n')
+        try:
+            try:
+                os.link(temp_path, claim_path)
+                return True
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            if self._read_claim(tape_url) is not None:
+                return False
+            # the existing claim is stale and so is atomically replaced, so
+            # that it is never removed after another retrieval has replaced
+            # it. If another retrieval replaced it at the same time then
+            # only the retrieval whose claim remains has claimed the URL.
+            os.replace(temp_path, claim_path)
+            return self._is_own_claim(tape_url)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def owner(self, tape_url):
+        """
+        Find the retrieval that is restoring a tape URL.
+
+        :param str tape_url: the tape URL
+        :returns: the id of the retrieval that has a live claim on the URL or
+            None if the URL isn't claimed
+        :rtype: int
+        """
+        claim = self._read_claim(tape_url)
+        return claim[0] if claim else None
+
+    def claimed_files(self, tape_url):
+        """
+        Find the files from a tape URL that are being restored.
+
+        :param str tape_url: the tape URL
+        :returns: the ids of the files that the retrieval with a live claim
+            on the URL is restoring, which is empty if the URL isn't claimed
+        :rtype: set
+        """
+        claim = self._read_claim(tape_url)
+        return claim[3] if claim else set()
+
+    def refresh(self, tape_url):
+        """
+        Refresh this retrieval's claim on a tape URL so that it doesn't time
+        out.
+
+        :param str tape_url: the tape URL to refresh
+        """
+        if self._is_own_claim(tape_url):
+            try:
+                os.utime(self._claim_path(tape_url), None)
+            except OSError:
+                pass
+
+    @contextmanager
+    def refreshing(self, tape_urls, interval=CLAIM_REFRESH_INTERVAL):
+        """
+        A context manager that refreshes this retrieval's claims on tape
+        URLs in a background thread until it exits.
+
+        :param list tape_urls: the tape URLs to refresh
+        :param int interval: the number of seconds between refreshes
+        """
+        tape_urls = list(tape_urls)
+        stopped = threading.Event()
+
+        def refresh_claims():
+            while not stopped.wait(interval):
+                for tape_url in tape_urls:
+                    self.refresh(tape_url)
+
+        thread = threading.Thread(target=refresh_claims, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def release(self, tape_url):
+        """
+        Release this retrieval's claim on a tape URL.
+
+        :param str tape_url: the tape URL to release
+        """
+        if self._is_own_claim(tape_url):
+            try:
+                os.remove(self._claim_path(tape_url))
+            except OSError:
+                pass
+
+    def _is_own_claim(self, tape_url):
+        """
+        :param str tape_url: the tape URL
+        :returns: True if the claim on the URL was made by this process
+        """
+        claim = self._read_claim_file(tape_url)
+        return (claim is not None and
+                claim[:3] == (self.retrieval_id, os.getpid(), self.hostname))
+
+    def _read_claim(self, tape_url):
+        """
+        :param str tape_url: the tape URL
+        :returns: the retrieval id, process id, hostname and the set of file
+            ids in the live claim on the URL or None if it isn't claimed
+        :rtype: tuple
+        """
+        claim = self._read_claim_file(tape_url)
+        if claim is None:
+            return None
+
+        retrieval_id, pid, hostname, file_ids, claim_age = claim
+        if claim_age > CLAIM_TIMEOUT:
+            return None
+        if hostname == self.hostname and not pid_running(pid):
+            return None
+        return retrieval_id, pid, hostname, file_ids
+
+    def _read_claim_file(self, tape_url):
+        """
+        :param str tape_url: the tape URL
+        :returns: the retrieval id, process id, hostname, the set of file
+            ids and the age in seconds of the claim on the URL, whether it's
+            live or not, or None if there isn't a claim file
+        :rtype: tuple
+        """
+        claim_path = self._claim_path(tape_url)
+        try:
+            claim_age = time.time() - os.stat(claim_path).st_mtime
+            with open(claim_path) as fh:
+                retrieval_id, pid, hostname = fh.readline().split()
+                file_ids = {int(file_id) for file_id in fh.readline().split()}
+            return int(retrieval_id), int(pid), hostname, file_ids, claim_age
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _claim_path(self, tape_url):
+        """
+        :param str tape_url: the tape URL
+        :returns: the path of the URL's claim file
+        """
+        return os.path.join(self.claim_dir,
+                            '{}.claim'.format(quote(tape_url, safe='')))
+
+
+def pid_running(pid):
+    """
+    :param int pid: a process id
+    :returns: True if a process with this id is running on this host
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,146 @@
+"""
+validation_store.py - a persistent record of the outcome of validating each
+file in a submission so that unchanged files do not have to be validated
+again if the validation is re-run.
+"""
+from __future__ import unicode_literals, division, absolute_import
+
+from collections import namedtuple
+from contextlib import contextmanager
+import hashlib
+import os
+import sqlite3
+
+from pdata_app.utils.checksum_cache import CACHE_TIMEOUT
+
+# The directory to keep the results of validating each submission in, which
+# is outside of the submissions so that the stores aren't archived with the
+# data
+DEFAULT_STORE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'primavera_dmt', 'validation_results'
+)
+
+ValidationResult = namedtuple('ValidationResult', ['passed', 'checksum_type',
+                                                   'checksum_value',
+                                                   'metadata'])
+
+
+def default_store_path(submission_dir):
+    """
+    Find the default path of the store for a submission, which is named
+    after a hash of the submission's absolute path.
+
+    :param str submission_dir: the submission's top-level directory
+    :returns: the path of the store
+    :rtype: str
+    """
+    path_hash = hashlib.sha256(
+        os.path.abspath(submission_dir).encode('utf-8')
+    ).hexdigest()
+    return os.path.join(DEFAULT_STORE_DIR, '{}.sqlite3'.format(path_hash))
+
+
+class ValidationResultStore(object):
+    """
+    A SQLite database of the outcome of validating files. Each entry is
+    identified by the file's path and is only returned if the file's size and
+    modification time are unchanged since it was validated. The file's
+    checksum is also stored so that callers can confirm that the contents
+    are identical before reusing a result. Whether the file was also checked
+    with PrePARE is recorded so that results from runs that didn't use
+    PrePARE aren't returned to runs that do.
+
+    A new connection is made for each operation so that the store can be
+    shared between threads and processes.
+    """
+    def __init__(self, db_path, prepared=True):
+        """
+        :param str db_path: the path to the SQLite database file, which is
+            created along with its directory if it doesn't exist
+        :param bool prepared: True if the files are checked with PrePARE, in
+            which case only results that were also checked with PrePARE are
+            returned
+        """
+        self.db_path = db_path
+        self.prepared = prepared
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        with self._connect() as conn:
+            columns = [row[1] for row in
+                       conn.execute('PRAGMA table_info(results)')]
+            if columns and 'prepared' not in columns:
+                # stores written before PrePARE was recorded can't be
+                # trusted and so are discarded
+                conn.execute('DROP TABLE results')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'path TEXT NOT NULL PRIMARY KEY, '
+                'size INTEGER NOT NULL, '
+                'mtime_ns INTEGER NOT NULL, '
+                'prepared INTEGER NOT NULL, '
+                'passed INTEGER NOT NULL, '
+                'checksum_type TEXT, '
+                'checksum_value TEXT, '
+                'metadata TEXT)'
+            )
+
+    def get(self, file_path, stat_result):
+        """
+        Get the result of validating a file.
+
+        :param str file_path: the path of the file
+        :param os.stat_result stat_result: the result of os.stat() on the file
+        :returns: the result or None if the file hasn't been validated, has
+            changed since it was or wasn't checked with PrePARE when this
+            store requires it
+        :rtype: ValidationResult
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT passed, checksum_type, checksum_value, metadata '
+                'FROM results WHERE path = ? AND size = ? AND mtime_ns = ? '
+                'AND prepared >= ?',
+                (file_path, stat_result.st_size, stat_result.st_mtime_ns,
+                 int(self.prepared))
+            ).fetchone()
+        if row is None:
+            return None
+        passed, checksum_type, checksum_value, metadata = row
+        return ValidationResult(bool(passed), checksum_type, checksum_value,
+                                metadata)
+
+    def set(self, file_path, stat_result, result):
+        """
+        Record the result of validating a file, replacing any existing result
+        for the same path.
+
+        :param str file_path: the path of the file
+        :param os.stat_result stat_result: the result of os.stat() on the file
+            before it was validated
+        :param ValidationResult result: the outcome of the validation
+        """
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO results (path, size, mtime_ns, '
+                'prepared, passed, checksum_type, checksum_value, metadata) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (file_path, stat_result.st_size, stat_result.st_mtime_ns,
+                 int(self.prepared), int(result.passed),
+                 result.checksum_type, result.checksum_value,
+                 result.metadata)
+            )
+
+    @contextmanager
+    def _connect(self):
+        """
+        A context manager providing a new connection to the database. Any
+        changes are committed and the connection is closed on exit.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=CACHE_TIMEOUT)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
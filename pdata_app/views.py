@@ -7,22 +7,22 @@ try:
 except ImportError:
     from urllib import urlencode  # Python 2.7
 
-import cf_units
-
 from django.contrib.auth import (authenticate, login, logout,
                                  update_session_auth_hash)
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import PasswordResetForm
 from django.contrib.auth.models import User
 from django.urls import reverse
-from django.db.models import Max, Min, Sum, Case, When
+from django.db.models import (Max, Min, Sum, Case, When, Count, IntegerField,
+                              OuterRef, Prefetch, Subquery)
+from django.db.models.functions import Coalesce
 from django.http import HttpResponseRedirect
 from django.shortcuts import render, redirect
 
 from .models import (DataFile, DataSubmission, ESGFDataset, CEDADataset,
                      DataRequest, DataIssue, VariableRequest, RetrievalRequest,
                      EmailQueue, Settings, ReplacedFile, ObservationDataset,
-                     ObservationFile)
+                     ObservationFile, Checksum)
 from .forms import (CreateSubmissionForm, PasswordChangeBootstrapForm,
                     UserBootstrapForm)
 from .tables import (DataRequestTable, DataFileTable, DataSubmissionTable,
@@ -35,7 +35,7 @@ from .filters import (DataRequestFilter, DataFileFilter, DataSubmissionFilter,
                       VariableRequestQueryFilter, RetrievalRequestFilter,
                       ReplacedFileFilter, ObservationDatasetFilter,
                       ObservationFileFilter)
-from .utils.common import get_request_size
+from .utils.common import get_request_size, get_retrieval_sizes
 from .utils.table_views import PagedFilteredTableView, DataRequestsFilteredView
 from vocabs.vocabs import STATUS_VALUES
 
@@ -69,6 +69,10 @@ class OutstandingDataRequestList(DataRequestsFilteredView):
 
 class ReceivedDataRequestList(DataRequestsFilteredView):
     model = DataRequest
+    queryset = DataRequest.objects.select_related(
+        'project', 'institute', 'climate_model', 'experiment',
+        'variable_request', 'statistics'
+    )
     table_class = DataReceivedTable
     filter_class = DataRequestFilter
     page_title = 'Variables Received'
@@ -89,6 +93,25 @@ class DataFileList(PagedFilteredTableView):
     filter_class = DataFileFilter
     page_title = 'Data Files'
 
+    def get_queryset(self, **kwargs):
+        qs = super(PagedFilteredTableView, self).get_queryset()
+        # A subquery is used to count the issues so that the count isn't
+        # affected by the join added when filtering by data issue
+        num_issues = (DataIssue.data_file.through.objects.
+                      filter(datafile=OuterRef('pk')).
+                      order_by().
+                      values('datafile').
+                      annotate(num_issues=Count('dataissue')).
+                      values('num_issues'))
+        qs = (qs.select_related('institute', 'climate_model', 'experiment',
+                                'variable_request').
+              prefetch_related(Prefetch('checksum_set',
+                                        Checksum.objects.order_by('id'))).
+              annotate(num_dataissues=Coalesce(
+                  Subquery(num_issues, output_field=IntegerField()), 0)))
+        self.filter = self.filter_class(self.request.GET, queryset=qs)
+        return self.filter.qs.distinct()
+
 
 class ReplacedFileList(PagedFilteredTableView):
     model = ReplacedFile
@@ -99,6 +122,7 @@ class ReplacedFileList(PagedFilteredTableView):
 
 class DataSubmissionList(PagedFilteredTableView):
     model = DataSubmission
+    queryset = DataSubmission.objects.select_related('user', 'statistics')
     table_class = DataSubmissionTable
     filter_class = DataSubmissionFilter
     page_title = 'Data Submissions'
@@ -127,6 +151,13 @@ class DataIssueList(PagedFilteredTableView):
 
 class RetrievalRequestList(PagedFilteredTableView):
     model = RetrievalRequest
+    queryset = RetrievalRequest.objects.select_related(
+        'requester'
+    ).prefetch_related(
+        Prefetch('data_request', DataRequest.objects.select_related(
+            'institute', 'climate_model', 'experiment', 'variable_request'
+        ))
+    )
     table_class = RetrievalRequestTable
     filter_class = RetrievalRequestFilter
     page_title = 'Retrieval Requests'
@@ -319,49 +350,11 @@ def retrieval_years(request):
         data_req_strs = [str(DataRequest.objects.filter(id=req).first())
                          for req in data_req_ids]
 
-        start_year_objects = [
-            (DataRequest.objects.get(id=req).datafile_set.aggregate(
-                Min('start_time'))['start_time__min'],
-              DataRequest.objects.get(id=req).datafile_set.first().time_units,
-              DataRequest.objects.get(id=req).datafile_set.first().calendar)
-             for req in data_req_ids
-        ]
-        start_year_objects_no_nones = [
-            (start_time, time_units, calendar)
-            for start_time, time_units, calendar in start_year_objects
-            if start_time is not None
-        ]
-
-        if start_year_objects_no_nones:
-            earliest_year_float, time_units, calendar = min(
-                start_year_objects_no_nones, key=lambda x: x[0]
-            )
-            earliest_year = cf_units.num2date(earliest_year_float, time_units,
-                                              calendar).strftime('%Y')
-        else:
-            earliest_year = None
-
-        end_year_objects = [
-            (DataRequest.objects.get(id=req).datafile_set.aggregate(
-                Max('end_time'))['end_time__max'],
-              DataRequest.objects.get(id=req).datafile_set.first().time_units,
-              DataRequest.objects.get(id=req).datafile_set.first().calendar)
-             for req in data_req_ids
-        ]
-        end_year_objects_no_nones = [
-            (end_time, time_units, calendar)
-            for end_time, time_units, calendar in end_year_objects
-            if end_time is not None
-        ]
-
-        if end_year_objects_no_nones:
-            latest_year_float, time_units, calendar = max(
-                end_year_objects_no_nones, key=lambda x: x[0]
-            )
-            end_year = cf_units.num2date(latest_year_float, time_units,
-                                              calendar).strftime('%Y')
-        else:
-            end_year = None
+        year_limits = DataFile.objects.filter(
+            data_request__id__in=data_req_ids
+        ).aggregate(Min('start_year'), Max('end_year'))
+        earliest_year = year_limits['start_year__min']
+        end_year = year_limits['end_year__max']
 
         # generate the confirmation page
         return render(request, 'pdata_app/retrieval_request_choose_years.html',
@@ -461,16 +454,23 @@ def confirm_mark_finished(request):
                 ret_req_ids.append(int(components.group(1)))
 
         # get a summary of each return request
+        ret_reqs = (RetrievalRequest.objects.filter(id__in=ret_req_ids).
+                    prefetch_related(Prefetch(
+                        'data_request',
+                        DataRequest.objects.select_related(
+                            'institute', 'climate_model', 'experiment',
+                            'variable_request'
+                        )
+                    )).in_bulk())
+        ret_req_sizes = get_retrieval_sizes(ret_req_ids)
         ret_req_summaries = []
         for req in ret_req_ids:
             summary = {}
             summary['id'] = req
-            ret_req = RetrievalRequest.objects.get(id=req)
+            ret_req = ret_reqs[req]
             summary['data_reqs'] = [str(data_req) for data_req in
                                     ret_req.data_request.all()]
-            summary['size'] = get_request_size(ret_req.data_request.all(),
-                                               ret_req.start_year,
-                                               ret_req.end_year, online=True)
+            summary['size'] = ret_req_sizes.get(req, {}).get('online', 0)
             ret_req_summaries.append(summary)
 
         # generate the confirmation page
@@ -3,25 +3,45 @@
 auto_retrieve.py
 
 This script is designed to run in a persistent screen session and to
-periodically restore any data that needs to be restored from either elastic
-tape or MASS.
+continuously restore any data that needs to be restored from either elastic
+tape or MASS. New retrieval requests are found every few minutes and
+several retrievals are run concurrently, within limits on the number that
+can use each tape system at once.
+
+A lock file containing the process id of each running retrieval is kept so
+that if this script is restarted then it doesn't start a second copy of any
+retrieval that is still running.
+
+Retrievals that need files that are being restored by another retrieval
+wait for that retrieval rather than reading the same data from tape again.
+They are run again every `WAITING_RETRY_INTERVAL` seconds to restore any
+files that the other retrieval didn't and they are marked as complete once
+all of their files are online.
+
+The MOOSE and ET clients are installed on different servers and so the tape
+system to restore data from must be chosen with either `--mass` or `--et`.
 """
 from __future__ import unicode_literals, division, absolute_import
 
 import argparse
-import datetime
+from collections import Counter, namedtuple
+import glob
 import logging.config
 import os
 import subprocess
 import sys
-from time import sleep
+import time
 
 import django
 django.setup()
 
+from django.contrib.auth.models import User
 from django.template.defaultfilters import filesizeformat
-from pdata_app.models import RetrievalRequest, Settings
-from pdata_app.utils.common import get_request_size, PAUSE_FILES
+from django.utils import timezone
+from pdata_app.models import EmailQueue, RetrievalRequest, Settings
+from pdata_app.utils.common import get_retrieval_sizes, PAUSE_FILES
+from pdata_app.utils.tape_claims import (pid_running,
+                                         RETRIEVAL_WAITING_EXIT_STATUS)
 
 __version__ = '0.1.0b1'
 
@@ -36,44 +56,331 @@ TWO_TEBIBYTES = 2 * 2 ** 40
 # The institution_ids that should be retrieved from MASS
 MASS_INSTITUTIONS = ['MOHC', 'NERC']
 
+# The tape systems, which are identified by the prefix of their tape URLs
+MASS = 'moose'
+ELASTIC_TAPE = 'et'
+
+# The top-level directory that restored data appears in
+BASE_OUTPUT_DIR = Settings.get_solo().base_output_dir
 # The top-level directory to write output data to
 STREAM1_DIR = Settings.get_solo().current_stream1_dir
 
+# The default number of seconds between checks for new retrievals
+POLL_INTERVAL = 5 * 60
+
+# The number of seconds to wait before retrying a retrieval that finished
+# without being completed
+RETRY_INTERVAL = ONE_HOUR
+
+# The number of seconds to wait before running a retrieval again that is
+# waiting for files being restored by other retrievals
+WAITING_RETRY_INTERVAL = 15 * 60
+
+# The default directory to keep the lock files and logs of running retrievals
+DEFAULT_LOCK_DIR = os.path.expanduser('~/.auto_retrieve')
+
+PendingRetrieval = namedtuple('PendingRetrieval', ['retrieval_id',
+                                                   'requester_id', 'priority',
+                                                   'date_created', 'size',
+                                                   'tape_system'])
+
+RunningRetrieval = namedtuple('RunningRetrieval', ['retrieval_id',
+                                                   'requester_id',
+                                                   'tape_system', 'pid',
+                                                   'process'])
+
+
+def find_pending_retrievals(tape_systems, exclude_ids):
+    """
+    Find the incomplete retrievals that can be run on the tape systems
+    specified. Retrievals that contain data from both tape systems or that
+    are too large are not included.
+
+    :param list tape_systems: the tape systems to find retrievals for
+    :param set exclude_ids: the ids of retrievals not to include, for
+        example because they're already running
+    :returns: the retrievals that can be run
+    :rtype: list
+    """
+    ret_reqs = list(RetrievalRequest.objects.filter(
+        date_complete__isnull=True, date_deleted__isnull=True
+    ).exclude(id__in=exclude_ids).values_list(
+        'id', 'requester_id', 'priority', 'date_created'
+    ))
+    if not ret_reqs:
+        return []
+    retrieval_ids = [ret_req[0] for ret_req in ret_reqs]
+
+    institutes = {}
+    through = RetrievalRequest.data_request.through
+    for retrieval_id, institute in through.objects.filter(
+            retrievalrequest_id__in=retrieval_ids
+    ).values_list('retrievalrequest_id', 'datarequest__institute__short_name'):
+        institutes.setdefault(retrieval_id, set()).add(institute)
+
+    sizes = get_retrieval_sizes(retrieval_ids)
+
+    pending = []
+    for retrieval_id, requester_id, priority, date_created in ret_reqs:
+        ret_institutes = institutes.get(retrieval_id, set())
+        if not ret_institutes:
+            continue
+        elif ret_institutes.issubset(MASS_INSTITUTIONS):
+            tape_system = MASS
+        elif ret_institutes.isdisjoint(MASS_INSTITUTIONS):
+            tape_system = ELASTIC_TAPE
+        else:
+            logger.debug('Skipping retrieval {} as it contains data from '
+                         'both MASS and elastic tape.'.format(retrieval_id))
+            continue
+        if tape_system not in tape_systems:
+            continue
+
+        retrieval_sizes = sizes.get(retrieval_id, {})
+        if retrieval_sizes.get('total', 0) > TWO_TEBIBYTES:
+            logger.debug('Skipping retrieval {} as it is bigger than {}.'.
+                         format(retrieval_id, filesizeformat(TWO_TEBIBYTES)))
+            continue
+
+        pending.append(PendingRetrieval(retrieval_id, requester_id, priority,
+                                        date_created,
+                                        retrieval_sizes.get('offline', 0),
+                                        tape_system))
+    return pending
 
-def run_retrieve_request(retrieval_id):
+
+def choose_retrievals(pending, running, tape_limits, max_retrievals):
+    """
+    Choose which of the pending retrievals to start now. Retrievals with the
+    highest priority are started first. Between retrievals with the same
+    priority, the retrievals of the requesters with the fewest running
+    retrievals are chosen first so that one user can't block everyone
+    else's retrievals, and then the smallest and the oldest retrievals are
+    chosen first.
+
+    :param list pending: the retrievals waiting to be run
+    :param dict running: the retrievals that are already running
+    :param dict tape_limits: the maximum number of retrievals that can run
+        on each tape system at once
+    :param int max_retrievals: the maximum number of retrievals to run at
+        once in total
+    :returns: the retrievals to start
+    :rtype: list
+    """
+    tape_counts = Counter([ret.tape_system for ret in running.values()])
+    requester_counts = Counter([ret.requester_id for ret in running.values()])
+    num_free = max_retrievals - len(running)
+
+    remaining = sorted(pending, key=lambda ret: (-ret.priority, ret.size,
+                                                 ret.date_created))
+    chosen = []
+    while num_free > 0:
+        startable = [ret for ret in remaining
+                     if tape_counts[ret.tape_system] <
+                     tape_limits.get(ret.tape_system, 0)]
+        if not startable:
+            break
+        highest_priority = [ret for ret in startable
+                            if ret.priority == startable[0].priority]
+        next_ret = min(highest_priority,
+                       key=lambda ret: requester_counts[ret.requester_id])
+        chosen.append(next_ret)
+        remaining.remove(next_ret)
+        tape_counts[next_ret.tape_system] += 1
+        requester_counts[next_ret.requester_id] += 1
+        num_free -= 1
+
+    return chosen
+
+
+def start_retrieval(pending_ret, lock_dir):
     """
     Run retrieve_request.py in a subprocess to fetch the appropriate data
-    from tape to disk
-
-    :param int retrieval_id:
-    """
-    retrieval_request = RetrievalRequest.objects.get(id=retrieval_id)
-
-    if get_request_size(retrieval_request.data_request.all(),
-                        retrieval_request.start_year,
-                        retrieval_request.end_year) > TWO_TEBIBYTES:
-        logger.warning('Skipping retrieval {} as it is bigger than {}.'.format(
-            retrieval_id, filesizeformat(TWO_TEBIBYTES).encode('utf-8')
-        ))
-        return
-
-    cmd = ('{} {} -l debug --skip_checksums -a {} {}'.format(sys.executable,
-                                            os.path.abspath(
-                                                os.path.join(
-                                                    os.path.dirname(__file__),
-                                                    'retrieve_request.py')),
-                                            STREAM1_DIR,
-                                            retrieval_id))
+    from tape to disk. The process is started in its own session so that it
+    continues if this script is stopped.
+
+    :param PendingRetrieval pending_ret: the retrieval to start
+    :param str lock_dir: the directory to write the lock file and the log in
+    :returns: the running retrieval or None if it couldn't be started
+    :rtype: RunningRetrieval
+    """
+    retrieval_id = pending_ret.retrieval_id
+    lock_path = _lock_path(lock_dir, retrieval_id)
     try:
-        subprocess.check_output(cmd, shell=True).decode('utf-8')
+        lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        logger.debug('Retrieval {} is already running'.format(retrieval_id))
+        return None
+
+    cmd = [sys.executable,
+           os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                        'retrieve_request.py')),
+           '-l', 'debug', '--skip_checksums', '-a', STREAM1_DIR,
+           str(retrieval_id)]
+    log_path = os.path.join(lock_dir, 'retrieval_{}.log'.format(retrieval_id))
+    try:
+        with open(log_path, 'a') as log_fh:
+            process = subprocess.Popen(cmd, stdout=log_fh,
+                                       stderr=subprocess.STDOUT,
+                                       start_new_session=True)
     except OSError as exc:
-        logger.error('Unable to run command:\n{}\n{}'.format(cmd,
-                                                             exc.strerror))
-        sys.exit(1)
-    except subprocess.CalledProcessError as exc:
-        logger.error('Retrieval failed: {}\n{}'.format(cmd, exc.output))
-    else:
-        logger.debug('Retrieved id {}'.format(retrieval_id))
+        os.close(lock_fd)
+        os.remove(lock_path)
+        logger.error('Unable to run command:\n{}\n{}'.format(
+            ' '.join(cmd), exc.strerror))
+        return None
+
+    with os.fdopen(lock_fd, 'w') as fh:
+        fh.write('{} {} {}\n'.format(process.pid, pending_ret.tape_system,
+                                     pending_ret.requester_id))
+
+    logger.debug('Started retrieval {} from {} ({}) with process id {}'.
+                 format(retrieval_id, pending_ret.tape_system,
+                        filesizeformat(pending_ret.size), process.pid))
+    return RunningRetrieval(retrieval_id, pending_ret.requester_id,
+                            pending_ret.tape_system, process.pid, process)
+
+
+def adopt_running_retrievals(lock_dir):
+    """
+    Find the retrievals that were started by a previous run of this script
+    and are still running. The lock files of any that have finished are
+    deleted so that they can be run again if they weren't completed.
+
+    :param str lock_dir: the directory containing the lock files
+    :returns: the retrieval ids as keys and the running retrievals as values
+    :rtype: dict
+    """
+    running = {}
+    for lock_path in glob.glob(os.path.join(lock_dir, 'retrieval_*.lock')):
+        retrieval_id = int(os.path.basename(lock_path)[10:-5])
+        try:
+            with open(lock_path) as fh:
+                pid, tape_system, requester_id = fh.read().split()
+            pid = int(pid)
+            requester_id = int(requester_id)
+        except (IOError, OSError, ValueError):
+            pid = None
+
+        if pid is not None and pid_running(pid):
+            logger.debug('Retrieval {} is still running with process id {}'.
+                         format(retrieval_id, pid))
+            running[retrieval_id] = RunningRetrieval(
+                retrieval_id, requester_id, tape_system, pid, None
+            )
+        else:
+            logger.debug('Removing stale lock file {}'.format(lock_path))
+            os.remove(lock_path)
+    return running
+
+
+def reap_finished_retrievals(running, lock_dir, retry_times):
+    """
+    Remove the retrievals that have finished from `running` and delete their
+    lock files.
+
+    :param dict running: the retrieval ids as keys and the running
+        retrievals as values
+    :param str lock_dir: the directory containing the lock files
+    :param dict retry_times: the ids of retrievals that have finished as
+        keys and the time after which they can be run again as values,
+        which is updated so that retrievals that weren't completed or that
+        are waiting for other retrievals aren't run again immediately
+    """
+    for retrieval_id, running_ret in list(running.items()):
+        if running_ret.process is not None:
+            return_code = running_ret.process.poll()
+            if return_code is None:
+                continue
+        elif pid_running(running_ret.pid):
+            continue
+        else:
+            # the exit status of processes started by a previous run of
+            # this script isn't known
+            return_code = None
+
+        del running[retrieval_id]
+        try:
+            os.remove(_lock_path(lock_dir, retrieval_id))
+        except OSError:
+            pass
+
+        if return_code == RETRIEVAL_WAITING_EXIT_STATUS:
+            logger.debug('Retrieval {} is waiting for files being restored '
+                         'by other retrievals'.format(retrieval_id))
+            retry_times[retrieval_id] = time.time() + WAITING_RETRY_INTERVAL
+            continue
+
+        retry_times[retrieval_id] = time.time() + RETRY_INTERVAL
+        if return_code:
+            logger.error('Retrieval {} failed with return code {}. See {}'.
+                         format(retrieval_id, return_code,
+                                os.path.join(lock_dir, 'retrieval_{}.log'.
+                                             format(retrieval_id))))
+        else:
+            logger.debug('Retrieval {} finished'.format(retrieval_id))
+
+
+def complete_restored_retrievals(retrieval_ids):
+    """
+    Mark retrievals whose files are all online as complete and let their
+    requesters know. This completes retrievals whose files were restored by
+    other retrievals.
+
+    :param list retrieval_ids: the ids of the retrievals that don't have any
+        offline files
+    """
+    for retrieval in RetrievalRequest.objects.filter(
+            id__in=retrieval_ids, date_complete__isnull=True):
+        retrieval.date_complete = timezone.now()
+        retrieval.save()
+        _email_user_success(retrieval)
+        logger.debug('Retrieval {} is complete'.format(retrieval.id))
+
+
+def _email_user_success(retrieval):
+    """
+    Send an email to request's creator advising them that their data's been
+    successfully restored.
+
+    :param pdata_app.models.RetrievalRequest retrieval: the retrieval object
+    """
+    contact_user_id = Settings.get_solo().contact_user_id
+    contact_user = User.objects.get(username=contact_user_id)
+
+    msg = (
+        'Dear {},\n'
+        '\n'
+        'Your retrieval request number {} has now been restored from '
+        'tape to group workspace. The data will be available in the DRS '
+        'directory structure at {}.\n'
+        '\n'
+        'To free up disk space on the group workspaces we would be grateful '
+        'if this data could be marked as finished at '
+        'https://prima-dm.ceda.ac.uk/retrieval_requests/ as soon as you have '
+        'finished analysing it.\n'
+        '\n'
+        'Thanks,\n'
+        '\n'
+        '{}'.format(retrieval.requester.first_name, retrieval.id,
+                    BASE_OUTPUT_DIR, contact_user.first_name)
+    )
+
+    _email = EmailQueue.objects.create(
+        recipient=retrieval.requester,
+        subject=('[PRIMAVERA_DMT] Retrieval Request {} Complete'.
+                 format(retrieval.id)),
+        message=msg
+    )
+
+
+def _lock_path(lock_dir, retrieval_id):
+    """
+    :param str lock_dir: the directory containing the lock files
+    :param int retrieval_id: the retrieval's id
+    :returns: the path of the retrieval's lock file
+    """
+    return os.path.join(lock_dir, 'retrieval_{}.lock'.format(retrieval_id))
 
 
 def parse_args():
@@ -84,10 +391,32 @@ def parse_args():
                                                  'PRIMAVERA retrieval '
                                                  'requests.')
     tape_sys = parser.add_mutually_exclusive_group(required=True)
-    tape_sys.add_argument("-m", "--mass", help="Restore data from MASS",
-                          action='store_true')
-    tape_sys.add_argument("-e", "--et", help="Restore data from elastic tape",
+    tape_sys.add_argument("-m", "--mass", help="restore data from MASS",
                           action='store_true')
+    tape_sys.add_argument("-e", "--et", help="restore data from elastic "
+                                             "tape", action='store_true')
+    parser.add_argument('--max-mass', help='the maximum number of '
+                                           'retrievals to run from MASS at '
+                                           'once (default: %(default)s)',
+                        type=int, default=2)
+    parser.add_argument('--max-et', help='the maximum number of retrievals '
+                                         'to run from elastic tape at once '
+                                         '(default: %(default)s)',
+                        type=int, default=2)
+    parser.add_argument('-p', '--processes', help='the maximum number of '
+                                                  'retrievals to run at once '
+                                                  '(default: %(default)s)',
+                        type=int, default=4)
+    parser.add_argument('-i', '--poll-interval', help='the number of seconds '
+                                                      'between checks for '
+                                                      'new retrievals '
+                                                      '(default: %(default)s)',
+                        type=int, default=POLL_INTERVAL)
+    parser.add_argument('-d', '--lock-dir', help='the directory to keep the '
+                                                 'lock files and logs of '
+                                                 'running retrievals in '
+                                                 '(default: %(default)s)',
+                        default=DEFAULT_LOCK_DIR)
     parser.add_argument('-l', '--log-level', help='set logging level to one of '
         'debug, info, warn (the default), or error')
     parser.add_argument('--version', action='version',
@@ -103,41 +432,49 @@ def main(args):
     """
     logger.debug('Starting auto_retrieve.py')
 
+    if args.mass:
+        tape_systems = [MASS]
+    else:
+        tape_systems = [ELASTIC_TAPE]
+
+    if not os.path.exists(args.lock_dir):
+        os.makedirs(args.lock_dir)
+
+    running = adopt_running_retrievals(args.lock_dir)
+    retry_times = {}
+
     while True:
-        ret_reqs = (RetrievalRequest.objects.filter(date_complete__isnull=True,
-                                                    date_deleted__isnull=True).
-                    order_by('date_created'))
-
-        for ret_req in ret_reqs:
-            # check for retrievals that are purely elastic tape or pure MASS
-            if args.mass:
-                # however, if pausing the system jump to the wait
-                if os.path.exists(PAUSE_FILES['moose:']):
-                    logger.debug('Waiting due to {}'.
-                                 format(PAUSE_FILES['moose:']))
-                    break
-                if (ret_req.data_request.filter
-                        (institute__short_name__in=MASS_INSTITUTIONS).count()
-                        and not ret_req.data_request.exclude
-                        (institute__short_name__in=MASS_INSTITUTIONS).count()):
-                    run_retrieve_request(ret_req.id)
-            elif args.et:
-                # however, if pausing the system jump to the wait
-                if os.path.exists(PAUSE_FILES['et:']):
-                    logger.debug('Waiting due to {}'.
-                                 format(PAUSE_FILES['et:']))
-                    break
-                if (ret_req.data_request.exclude
-                        (institute__short_name__in=MASS_INSTITUTIONS).count()
-                        and not ret_req.data_request.filter
-                        (institute__short_name__in=MASS_INSTITUTIONS).count()):
-                    run_retrieve_request(ret_req.id)
-            else:
-                raise NotImplementedError('Unknown tape system specified.')
-
-        logger.debug('Waiting for one hour at {}'.format(
-            datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')))
-        sleep(ONE_HOUR)
+        django.db.close_old_connections()
+
+        reap_finished_retrievals(running, args.lock_dir, retry_times)
+
+        now = time.time()
+        for retrieval_id in [ret_id for ret_id in retry_times
+                             if now >= retry_times[ret_id]]:
+            del retry_times[retrieval_id]
+
+        tape_limits = {MASS: args.max_mass, ELASTIC_TAPE: args.max_et}
+        for tape_system in tape_systems:
+            # if pausing the system then don't start any new retrievals
+            if os.path.exists(PAUSE_FILES[tape_system + ':']):
+                logger.debug('Waiting due to {}'.
+                             format(PAUSE_FILES[tape_system + ':']))
+                tape_limits[tape_system] = 0
+
+        # retrievals that are backing off are still completed as soon as
+        # all of their files are online
+        pending = find_pending_retrievals(tape_systems, set(running))
+        complete_restored_retrievals([ret.retrieval_id for ret in pending
+                                      if not ret.size])
+        pending = [ret for ret in pending
+                   if ret.size and ret.retrieval_id not in retry_times]
+        for pending_ret in choose_retrievals(pending, running, tape_limits,
+                                             args.processes):
+            running_ret = start_retrieval(pending_ret, args.lock_dir)
+            if running_ret:
+                running[running_ret.retrieval_id] = running_ret
+
+        time.sleep(args.poll_interval)
 
 
 if __name__ == "__main__":
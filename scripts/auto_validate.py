@@ -136,8 +136,6 @@ def submit_validation(submission_directory):
         '{}'.format(NUM_PROCS_USE_LOTUS),
         '--version-string',
         VERSION_STRING,
-        '--data-limit',
-        '4000000000',
         submission_directory
     ]
 
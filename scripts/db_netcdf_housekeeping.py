@@ -10,8 +10,15 @@ online flag and directory.
 
 2. it scans through the specified directory structure and checks that each
 netCDF file found is marked as online and has the correct directory.
+
+The details of all files are loaded from the database in a single query
+before scanning, directories are listed in parallel rather than checking
+each file individually, and all of the changes are saved using bulk
+updates.
 """
 import argparse
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import logging.config
 import os
 import sys
@@ -20,8 +27,9 @@ import django
 django.setup()
 
 from pdata_app.models import DataFile, Settings  # nopep8
-from pdata_app.utils.common import (ilist_files, construct_drs_path,
+from pdata_app.utils.common import (construct_drs_path, grouper,
                                     is_same_gws)  # nopep8
+from pdata_app.utils.dbapi import bulk_update_files  # nopep8
 
 DEFAULT_LOG_LEVEL = logging.WARNING
 DEFAULT_LOG_FORMAT = '%(levelname)s: %(message)s'
@@ -34,109 +42,323 @@ BASE_OUTPUT_DIR = Settings.get_solo().base_output_dir
 
 CEDA_BASE = '/badc/cmip6/data'
 
+# The default number of threads to list directories with
+MAX_SCAN_THREADS = 8
+# The number of rows to fetch from the database at a time when loading the
+# files into memory
+FILE_MAP_CHUNK_SIZE = 10000
+# The number of files to load the DRS metadata of in each query
+MAX_IDS_PER_QUERY = 1000
+
+# The details of a DataFile that are needed to check it against the disk
+FileRecord = namedtuple('FileRecord', ['id', 'directory', 'online',
+                                       'data_request_id',
+                                       'data_submission_id'])
+
+
+def load_file_map():
+    """
+    Load the details of all of the files in the database in a single query
+    that is streamed from the database.
+
+    :returns: the file names as keys and lists of the FileRecords for the
+        files with that name as values
+    :rtype: dict
+    """
+    logger.debug('Loading files from the database.')
+
+    file_map = {}
+    for name, *record in DataFile.objects.values_list(
+            'name', 'id', 'directory', 'online', 'data_request_id',
+            'data_submission_id'
+    ).iterator(chunk_size=FILE_MAP_CHUNK_SIZE):
+        file_map.setdefault(name, []).append(FileRecord(*record))
+
+    logger.debug('Loaded {} file names from the database.'.
+                 format(len(file_map)))
+    return file_map
+
+
+def save_changes(changes):
+    """
+    Save the changed files to the database using bulk updates.
 
-def scan_database():
+    :param dict changes: the ids of the files that have changed as keys and
+        their updated FileRecords as values
     """
-    Start the scan of the database.
+    bulk_update_files(
+        [DataFile(id=record.id, directory=record.directory,
+                  online=record.online,
+                  data_request_id=record.data_request_id,
+                  data_submission_id=record.data_submission_id)
+         for record in changes.values()],
+        ['directory', 'online']
+    )
+    logger.debug('Saved changes to {} files.'.format(len(changes)))
+
+
+def scan_database(file_map, changes, num_threads=MAX_SCAN_THREADS):
+    """
+    Start the scan of the database. Each directory that contains online
+    files is listed once rather than checking each file individually.
+
+    :param dict file_map: the files loaded by `load_file_map()`, which are
+        updated with any changes
+    :param dict changes: the ids of files that have changed as keys and
+        their updated FileRecords as values, which is added to
+        any files that are found to have changed
+    :param int num_threads: the number of directories to list at once
     """
     logger.debug('Starting database scan.')
 
-    for data_file in DataFile.objects.filter(online=True).iterator():
-        full_path = os.path.join(data_file.directory, data_file.name)
-        if not os.path.exists(full_path):
+    online_files = [(name, index, record)
+                    for name, records in file_map.items()
+                    for index, record in enumerate(records)
+                    if record.online]
+    listings = _list_directories(
+        {record.directory for _name, _index, record in online_files
+         if record.directory}, num_threads
+    )
+
+    same_gws = {}
+    link_ids = {}
+    for name, index, record in online_files:
+        if name not in (listings.get(record.directory) or ()):
+            full_path = (os.path.join(record.directory, name)
+                         if record.directory else name)
             logger.warning('File cannot be found on disk, status changed to '
                            'offline: {}'.format(full_path))
-            data_file.online = False
-            data_file.directory = None
-            data_file.save()
+            _update_record(file_map, changes, name, index, online=False,
+                           directory=None)
             continue
 
-        if not is_same_gws(data_file.directory, BASE_OUTPUT_DIR):
-            sym_link_dir = os.path.join(BASE_OUTPUT_DIR,
-                                        construct_drs_path(data_file))
-            sym_link_path = os.path.join(sym_link_dir,
-                                         data_file.name)
-            if not os.path.exists(sym_link_path):
-                if not os.path.exists(sym_link_dir):
-                    os.makedirs(sym_link_dir)
-                os.symlink(full_path, sym_link_path)
-                logger.warning('Created symlink for file {} from {}'.
-                               format(data_file.name, sym_link_path))
+        if record.directory not in same_gws:
+            same_gws[record.directory] = is_same_gws(record.directory,
+                                                     BASE_OUTPUT_DIR)
+        if not same_gws[record.directory]:
+            link_ids[record.id] = os.path.join(record.directory, name)
+
+    _create_symlinks(link_ids, num_threads)
 
     logger.debug('Completed database scan.')
 
 
-def scan_file_structure(directory):
+def _create_symlinks(link_ids, num_threads):
+    """
+    Create a symbolic link in the main directory structure for each of the
+    files that are stored on a different group workspace, if one doesn't
+    already exist.
+
+    :param dict link_ids: the ids of the files as keys and the paths to the
+        files as values
+    :param int num_threads: the number of directories to list at once
+    """
+    symlinks = []
+    for id_chunk in grouper(link_ids, MAX_IDS_PER_QUERY):
+        for data_file in DataFile.objects.filter(
+                id__in=list(id_chunk)
+        ).select_related(
+            'project', 'activity_id', 'institute', 'climate_model',
+            'experiment', 'variable_request'
+        ):
+            sym_link_dir = os.path.join(BASE_OUTPUT_DIR,
+                                        construct_drs_path(data_file))
+            symlinks.append((link_ids[data_file.id], sym_link_dir,
+                             data_file.name))
+
+    listings = _list_directories({sym_link_dir for _full_path, sym_link_dir,
+                                  _name in symlinks}, num_threads)
+    for full_path, sym_link_dir, name in symlinks:
+        listing = listings.get(sym_link_dir)
+        if listing is not None and name in listing:
+            continue
+        if listing is None and not os.path.exists(sym_link_dir):
+            os.makedirs(sym_link_dir)
+        sym_link_path = os.path.join(sym_link_dir, name)
+        os.symlink(full_path, sym_link_path)
+        logger.warning('Created symlink for file {} from {}'.
+                       format(name, sym_link_path))
+
+
+def scan_file_structure(directory, file_map, changes,
+                        num_threads=MAX_SCAN_THREADS):
     """
-    Start the scan of the file structure.
+    Start the scan of the file structure. The directories below
+    `directory` are listed in parallel.
 
     :param str directory: the top level directory to scan
+    :param dict file_map: the files loaded by `load_file_map()`, which are
+        updated with any changes
+    :param dict changes: the ids of files that have changed as keys and
+        their updated FileRecords as values, which is added to
+        any files that are found to have changed
+    :param int num_threads: the number of directories to list at once
     """
     logger.debug('Starting file structure scan.')
 
-    for nc_file in ilist_files(directory):
+    nc_files = _scan_tree(directory, num_threads)
+
+    for nc_file, is_broken, actual_dir in nc_files:
         nc_file_name = os.path.basename(nc_file)
-        db_files = DataFile.objects.filter(name=nc_file_name)
+        records = file_map.get(nc_file_name, [])
 
-        if db_files.count() == 0:
+        if len(records) == 0:
             logger.error('File not found in database: {}'.format(nc_file))
-        elif db_files.count() > 1:
+            continue
+        elif len(records) > 1:
             logger.error('{} entries found in database for file: {}'.
-                         format(db_files.count(), nc_file))
-        else:
-            db_file = db_files.first()
-
-            # Check for broken symbolic links
-            # os.path.exists() returns False for broken links
-            if not os.path.exists(nc_file):
-                os.remove(nc_file)
-                if db_file.directory:
-                    db_path = os.path.join(db_file.directory, db_file.name)
-                    if os.path.exists(db_path):
-                        logger.warning('Replacing broken link for file {}'.
-                                       format(db_file.name))
-                        os.symlink(os.path.join(db_file.directory,
-                                                db_file.name),
-                                   nc_file)
-                else:
-                    logger.warning('Removing broken link for file {}'.
-                                   format(db_file.name))
-                    if db_file.online:
-                        db_file.online = False
-                        db_file.save()
-                    continue
-
-            actual_path = os.path.realpath(nc_file)
-            actual_dir = os.path.dirname(actual_path)
-
-            db_file.refresh_from_db()
-            if not db_file.online:
-                logger.warning('File status changed to online: {}'.
-                               format(nc_file))
-                db_file.online = True
-                db_file.directory = actual_dir
-                db_file.save()
-
-            if db_file.directory is None:
-                db_file.directory = actual_dir
-                db_file.save()
-
-            if db_file.directory != actual_dir:
-                if db_file.directory.startswith(CEDA_BASE):
-                    # This file is believed to be in the archive
-                    logger.warning('File {} is in the CEDA archive according '
-                                   'to the database.'.format(nc_file))
-                else:
-                    logger.warning('Directory for file {} changed from {} '
-                                   'to {}'.format(nc_file_name,
-                                                  db_file.directory,
-                                                  actual_dir))
-                    db_file.directory = actual_dir
-                    db_file.save()
+                         format(len(records), nc_file))
+            continue
+
+        db_file = records[0]
+
+        # Check for broken symbolic links
+        if is_broken:
+            os.remove(nc_file)
+            db_path = (os.path.join(db_file.directory, nc_file_name)
+                       if db_file.directory else None)
+            if db_path and os.path.exists(db_path):
+                logger.warning('Replacing broken link for file {}'.
+                               format(nc_file_name))
+                os.symlink(db_path, nc_file)
+                actual_dir = os.path.dirname(os.path.realpath(db_path))
+            else:
+                logger.warning('Removing broken link for file {}'.
+                               format(nc_file_name))
+                if db_file.online:
+                    _update_record(file_map, changes, nc_file_name, 0,
+                                   online=False)
+                continue
+
+        if not db_file.online:
+            logger.warning('File status changed to online: {}'.
+                           format(nc_file))
+            db_file = _update_record(file_map, changes, nc_file_name, 0,
+                                     online=True, directory=actual_dir)
+
+        if db_file.directory is None:
+            db_file = _update_record(file_map, changes, nc_file_name, 0,
+                                     directory=actual_dir)
+
+        if db_file.directory != actual_dir:
+            if db_file.directory.startswith(CEDA_BASE):
+                # This file is believed to be in the archive
+                logger.warning('File {} is in the CEDA archive according '
+                               'to the database.'.format(nc_file))
+            else:
+                logger.warning('Directory for file {} changed from {} '
+                               'to {}'.format(nc_file_name,
+                                              db_file.directory,
+                                              actual_dir))
+                _update_record(file_map, changes, nc_file_name, 0,
+                               directory=actual_dir)
 
     logger.debug('Completed file structure scan.')
 
 
+def _update_record(file_map, changes, name, index, **kwargs):
+    """
+    Change the values of a file in the map of files and record the change.
+
+    :param dict file_map: the files loaded by `load_file_map()`
+    :param dict changes: the changed files
+    :param str name: the file's name
+    :param int index: the file's position in the list of files with this name
+    :param kwargs: the new values
+    :returns: the updated file
+    :rtype: FileRecord
+    """
+    record = file_map[name][index]._replace(**kwargs)
+    file_map[name][index] = record
+    changes[record.id] = record
+    return record
+
+
+def _scan_directory(directory):
+    """
+    List a single directory.
+
+    :param str directory: the directory to list
+    :returns: the details of each netCDF file in the directory as a tuple of
+        its path, whether it's a broken symbolic link and the real path of
+        the directory that it's in, and a list of the sub-directories
+    :rtype: tuple
+    """
+    nc_files = []
+    sub_dirs = []
+    real_dir = os.path.realpath(directory)
+    for entry in os.scandir(directory):
+        if entry.is_dir():
+            sub_dirs.append(entry.path)
+        elif entry.name.endswith('.nc'):
+            if entry.is_symlink():
+                # is_file() returns False for broken links
+                nc_files.append((entry.path, not entry.is_file(),
+                                 os.path.dirname(os.path.realpath(
+                                     entry.path))))
+            else:
+                nc_files.append((entry.path, False, real_dir))
+    return nc_files, sub_dirs
+
+
+def _scan_tree(directory, num_threads):
+    """
+    Find all of the netCDF files in a directory tree. Each directory is
+    listed in a separate task, which is submitted as soon as the directory
+    is found, so that the whole tree is spread across the threads rather
+    than just its top-level sub-directories.
+
+    :param str directory: the top-level directory of the tree
+    :param int num_threads: the number of directories to list at once
+    :returns: the details of each netCDF file as returned by
+        `_scan_directory()`
+    :rtype: list
+    """
+    nc_files = []
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = {executor.submit(_scan_directory, directory)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_files, sub_dirs = future.result()
+                nc_files.extend(dir_files)
+                pending.update(executor.submit(_scan_directory, sub_dir)
+                               for sub_dir in sub_dirs)
+    return nc_files
+
+
+def _list_directories(directories, num_threads):
+    """
+    List several directories in parallel.
+
+    :param set directories: the directories to list
+    :param int num_threads: the number of directories to list at once
+    :returns: the directories as keys and a set of the names of the files in
+        each directory that exist, or None if the directory doesn't exist,
+        as values
+    :rtype: dict
+    """
+    directories = list(directories)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return dict(zip(directories,
+                        executor.map(_list_directory, directories)))
+
+
+def _list_directory(directory):
+    """
+    :param str directory: the directory to list
+    :returns: the names of the files in the directory that exist, which
+        doesn't include broken symbolic links, or None if the directory
+        doesn't exist
+    :rtype: set
+    """
+    try:
+        return {entry.name for entry in os.scandir(directory)
+                if entry.is_file()}
+    except OSError:
+        return None
+
+
 def parse_args():
     """
     Parse command-line arguments
@@ -154,6 +376,11 @@ def parse_args():
                                                   'scan (default: '
                                                   '%(default)s)',
                         default=BASE_OUTPUT_DIR)
+    parser.add_argument('-n', '--num-threads', help='the number of '
+                                                    'directories to scan at '
+                                                    'once (default: '
+                                                    '%(default)s)',
+                        type=int, default=MAX_SCAN_THREADS)
     parser.add_argument('-l', '--log-level', help='set logging level to one '
                                                   'of debug, info, warn (the '
                                                   'default), or error')
@@ -172,11 +399,18 @@ def main(args):
         logger.error("{} isn't mounted on this server".format(CEDA_BASE))
         sys.exit(1)
 
+    file_map = load_file_map()
+
     if not args.no_file_structure:
-        scan_file_structure(args.top_level)
+        changes = {}
+        scan_file_structure(args.top_level, file_map, changes,
+                            args.num_threads)
+        save_changes(changes)
 
     if not args.no_database:
-        scan_database()
+        changes = {}
+        scan_database(file_map, changes, args.num_threads)
+        save_changes(changes)
 
     logger.debug('Completed db_netcdf_housekeeping')
 
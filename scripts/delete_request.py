@@ -18,6 +18,7 @@ django.setup()
 from django.utils import timezone
 
 from pdata_app.models import RetrievalRequest, Settings
+from pdata_app.signals import defer_statistics
 from pdata_app.utils.common import (delete_drs_dir, construct_drs_path,
                                     date_filter_files)
 from pdata_app.utils.dbapi import match_one
@@ -94,7 +95,7 @@ def main(args):
                                             deletion_retrieval.start_year,
                                             deletion_retrieval.end_year)
 
-        if files_to_delete is None:
+        if not files_to_delete.exists():
             continue
 
         if not args.force:
@@ -113,7 +114,7 @@ def main(args):
                     ret_req.start_year,
                     ret_req.end_year
                 )
-                if ret_filtered_files is None:
+                if not ret_filtered_files.exists():
                     continue
                 # remove from the list of files to delete the ones that we have
                 # just found are still needed
@@ -226,5 +227,7 @@ if __name__ == "__main__":
         }
     })
 
-    # run the code
-    main(cmd_args)
+    # run the code, refreshing the statistics of the files' parents once
+    # at the end rather than as each file is saved
+    with defer_statistics():
+        main(cmd_args)
@@ -17,6 +17,7 @@ import django
 django.setup()
 
 from pdata_app.models import Settings, DataSubmission
+from pdata_app.signals import defer_statistics
 from pdata_app.utils.common import is_same_gws, construct_drs_path
 
 
@@ -186,5 +187,7 @@ if __name__ == "__main__":
         }
     })
 
-    # run the code
-    main(cmd_args)
+    # run the code, refreshing the statistics of the files' parents once
+    # at the end rather than as each file is saved
+    with defer_statistics():
+        main(cmd_args)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+populate_file_years.py
+
+Calculate the start_year and end_year of all DataFiles and ReplacedFiles from
+their times. These are set automatically whenever a file is saved. This script
+must be run with --missing-only after migration 0048 has added the years to
+calculate them for the existing files, and again after the times have been
+changed with a bulk update. Each chunk of files is saved in its own
+transaction so that the database can be used while it runs.
+"""
+from __future__ import unicode_literals, division, absolute_import
+
+import argparse
+import logging.config
+import sys
+
+import django
+django.setup()
+
+from django.db import transaction  # nopep8
+
+from pdata_app.models import DataFile, ReplacedFile  # nopep8
+from pdata_app.utils.common import calculate_file_years, grouper  # nopep8
+
+__version__ = '0.1.0b1'
+
+DEFAULT_LOG_LEVEL = logging.WARNING
+DEFAULT_LOG_FORMAT = '%(levelname)s: %(message)s'
+
+logger = logging.getLogger(__name__)
+
+# The number of files to update in each transaction
+CHUNK_SIZE = 5000
+
+
+def populate_years(model_class, only_missing):
+    """
+    Calculate and save the years of all files of the specified class.
+
+    :param model_class: DataFile or ReplacedFile
+    :param bool only_missing: only update files that don't have a start year
+    """
+    files = model_class.objects.exclude(start_time__isnull=True)
+    if only_missing:
+        files = files.filter(start_year__isnull=True)
+    files = files.only('id', 'start_time', 'end_time', 'time_units',
+                       'calendar', 'start_year', 'end_year').order_by('id')
+
+    num_updated = 0
+    for chunk in grouper(files.iterator(), CHUNK_SIZE):
+        changed = []
+        for data_file in chunk:
+            years = calculate_file_years(data_file.start_time,
+                                         data_file.end_time,
+                                         data_file.time_units,
+                                         data_file.calendar)
+            if years != (data_file.start_year, data_file.end_year):
+                data_file.start_year, data_file.end_year = years
+                changed.append(data_file)
+        with transaction.atomic():
+            model_class.objects.bulk_update(changed,
+                                            ['start_year', 'end_year'])
+        num_updated += len(changed)
+        logger.debug('{} {} objects updated'.format(num_updated,
+                                                    model_class.__name__))
+
+
+def parse_args():
+    """
+    Parse command-line arguments
+    """
+    parser = argparse.ArgumentParser(description='Populate the start and end '
+                                                 'years of data files and '
+                                                 'replaced files')
+    parser.add_argument('-m', '--missing-only',
+                        help='only update files without a start year',
+                        action='store_true')
+    parser.add_argument('-l', '--log-level',
+                        help='set logging level to one of debug, info, warn '
+                             '(the default), or error')
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s {}'.format(__version__))
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main(args):
+    """
+    Main entry point
+    """
+    for model_class in (DataFile, ReplacedFile):
+        populate_years(model_class, args.missing_only)
+
+    logger.debug('Completed populating years')
+
+
+if __name__ == "__main__":
+    cmd_args = parse_args()
+
+    # determine the log level
+    if cmd_args.log_level:
+        try:
+            log_level = getattr(logging, cmd_args.log_level.upper())
+        except AttributeError:
+            logger.setLevel(logging.WARNING)
+            logger.error('log-level must be one of: debug, info, warn '
+                         'or error')
+            sys.exit(1)
+    else:
+        log_level = DEFAULT_LOG_LEVEL
+
+    # configure the logger
+    logging.config.dictConfig({
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'standard': {
+                'format': DEFAULT_LOG_FORMAT,
+            },
+        },
+        'handlers': {
+            'default': {
+                'level': log_level,
+                'class': 'logging.StreamHandler',
+                'formatter': 'standard'
+            },
+        },
+        'loggers': {
+            '': {
+                'handlers': ['default'],
+                'level': log_level,
+                'propagate': True
+            }
+        }
+    })
+
+    # run the code
+    main(cmd_args)
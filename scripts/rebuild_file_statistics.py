@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+rebuild_file_statistics.py
+
+Recalculate the cached DataRequestStatistics and DataSubmissionStatistics from
+the DataFiles. The statistics are normally kept up to date automatically when
+DataFiles are saved or deleted but this script should be run after the
+statistics are first added, after the standard time units are changed or after
+any DataFiles have been changed by bulk operations that don't update the
+statistics. The web pages calculate the statistics of any data requests and
+data submissions that don't have them yet each time that they are displayed
+and so --missing-only can be used to quickly save just these.
+"""
+from __future__ import unicode_literals, division, absolute_import
+
+import argparse
+import logging.config
+import sys
+
+import django
+django.setup()
+
+from pdata_app.models import DataRequest, DataSubmission  # nopep8
+from pdata_app.utils.dbapi import refresh_statistics  # nopep8
+
+__version__ = '0.1.0b1'
+
+DEFAULT_LOG_LEVEL = logging.WARNING
+DEFAULT_LOG_FORMAT = '%(levelname)s: %(message)s'
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    """
+    Parse command-line arguments
+    """
+    parser = argparse.ArgumentParser(description='Rebuild the cached data '
+                                                 'request and data submission '
+                                                 'statistics')
+    parser.add_argument('-r', '--data-requests-only',
+                        help='only rebuild the data request statistics',
+                        action='store_true')
+    parser.add_argument('-s', '--data-submissions-only',
+                        help='only rebuild the data submission statistics',
+                        action='store_true')
+    parser.add_argument('-m', '--missing-only',
+                        help="only calculate the statistics of data requests "
+                             "and data submissions that don't have any yet",
+                        action='store_true')
+    parser.add_argument('-l', '--log-level',
+                        help='set logging level to one of debug, info, warn '
+                             '(the default), or error')
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s {}'.format(__version__))
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main(args):
+    """
+    Main entry point
+    """
+    dreqs = DataRequest.objects.all()
+    subs = DataSubmission.objects.all()
+    if args.missing_only:
+        dreqs = dreqs.filter(statistics__isnull=True)
+        subs = subs.filter(statistics__isnull=True)
+
+    if not args.data_submissions_only:
+        dreq_ids = dreqs.values_list('id', flat=True)
+        logger.debug('Rebuilding statistics for {} data requests'.
+                     format(dreq_ids.count()))
+        refresh_statistics(data_request_ids=dreq_ids)
+
+    if not args.data_requests_only:
+        sub_ids = subs.values_list('id', flat=True)
+        logger.debug('Rebuilding statistics for {} data submissions'.
+                     format(sub_ids.count()))
+        refresh_statistics(data_submission_ids=sub_ids)
+
+    logger.debug('Completed rebuilding statistics')
+
+
+if __name__ == "__main__":
+    cmd_args = parse_args()
+
+    # determine the log level
+    if cmd_args.log_level:
+        try:
+            log_level = getattr(logging, cmd_args.log_level.upper())
+        except AttributeError:
+            logger.setLevel(logging.WARNING)
+            logger.error('log-level must be one of: debug, info, warn '
+                         'or error')
+            sys.exit(1)
+    else:
+        log_level = DEFAULT_LOG_LEVEL
+
+    # configure the logger
+    logging.config.dictConfig({
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'standard': {
+                'format': DEFAULT_LOG_FORMAT,
+            },
+        },
+        'handlers': {
+            'default': {
+                'level': log_level,
+                'class': 'logging.StreamHandler',
+                'formatter': 'standard'
+            },
+        },
+        'loggers': {
+            '': {
+                'handlers': ['default'],
+                'level': log_level,
+                'propagate': True
+            }
+        }
+    })
+
+    # run the code
+    main(cmd_args)
@@ -9,10 +9,20 @@ is therefore assumed that all of the data in a retrieval is on a single tape
 system, but this is not checked by this script. `split_retrieve_request.py`
 and `auto_retrieve.py` can be used to split requests and run them on the
 appropriate tape systems respectively.
+
+Each tape URL is claimed before it is restored. If another retrieval has
+already claimed a URL then this retrieval doesn't read it from tape at the
+same time and instead exits with a status of `RETRIEVAL_WAITING_EXIT_STATUS`.
+`auto_retrieve.py` then runs this retrieval again later, when any files
+that it needs from the URL that the other retrieval didn't restore are
+restored, and it marks this retrieval as complete once all of its files
+are online.
 """
 from __future__ import unicode_literals, division, absolute_import
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 import datetime
 import glob
 from itertools import chain
@@ -33,11 +43,15 @@ django.setup()
 from django.contrib.auth.models import User
 from django.utils import timezone
 
-from pdata_app.models import Settings, RetrievalRequest, EmailQueue, DataFile
+from pdata_app.models import (Settings, RetrievalRequest, EmailQueue,
+                              DataFile, Checksum, TapeChecksum)
 from pdata_app.utils.common import (md5, sha256, adler32, construct_drs_path,
                                     get_temp_filename, is_same_gws, run_command,
-                                    date_filter_files, PAUSE_FILES, grouper)
-from pdata_app.utils.dbapi import match_one
+                                    date_filter_files, PAUSE_FILES, grouper,
+                                    get_gws_any_dir)
+from pdata_app.utils.dbapi import match_one, bulk_update_files
+from pdata_app.utils.tape_claims import (TapeUrlClaims, DEFAULT_CLAIM_DIR,
+                                         RETRIEVAL_WAITING_EXIT_STATUS)
 
 
 __version__ = '0.1.0b1'
@@ -57,6 +71,25 @@ MAX_TAPE_GET_PROC = 5
 # The maximum number of files to get from MASS in one moo get command
 # to avoid the length of the command being longer than the shell can manage
 MAX_MASS_FILES = 200
+# The maximum number of files to verify the checksums of simultaneously on
+# each group workspace
+MAX_CHECKSUM_THREADS = 4
+# The number of seconds to wait between checks for newly restored files when
+# restoring from elastic tape in pipelined mode
+PIPELINE_POLL_INTERVAL = 30
+# The number of files to check in each query when confirming that a
+# retrieval is complete
+MAX_IDS_PER_QUERY = 1000
+# The DataFile fields that are needed to retrieve files and to construct
+# their DRS paths
+RETRIEVAL_FIELDS = (
+    'name', 'incoming_name', 'incoming_directory', 'directory', 'online',
+    'tape_url', 'size', 'rip_code', 'grid', 'version', 'data_request_id',
+    'data_submission_id', 'project__short_name', 'activity_id__short_name',
+    'institute__short_name', 'climate_model__short_name',
+    'experiment__short_name', 'variable_request__table_name',
+    'variable_request__cmor_name', 'variable_request__out_name'
+)
 
 
 class ChecksumError(Exception):
@@ -86,6 +119,8 @@ def parallel_get_urls(tapes, args):
     manager = Manager()
     params = manager.Queue()
     error_event = manager.Event()
+    # the workers must not share the parent's database connections
+    django.db.connections.close_all()
     for i in range(MAX_TAPE_GET_PROC):
         p = Process(target=parallel_worker, args=(params, error_event))
         jobs.append(p)
@@ -117,9 +152,14 @@ def parallel_worker(params, error_event):
         catastrophic error has occurred in another process and processing
         should end
     """
+    # each worker makes its own database connection, which it keeps for all
+    # of the tape URLs that it restores
+    django.db.connections.close_all()
+
     while True:
-        # close existing connections so that a fresh connection is made
-        django.db.connections.close_all()
+        # replace the connection if it has been lost or has expired while
+        # the previous URL was being restored
+        django.db.close_old_connections()
 
         if error_event.is_set():
             return
@@ -223,19 +263,22 @@ def get_moose_url(tape_url, data_files, args):
 
     _remove_data_license_files(drs_dir)
 
-    for data_file in data_files:
-        filename = (data_file.name if not args.incoming
-                    else data_file.incoming_name)
-        if not args.skip_checksums:
-            try:
-                _check_file_checksum(
-                    data_file,
-                    os.path.join(drs_dir, filename)
-                )
-            except ChecksumError:
-                # warning message has already been displayed and so move on
-                # to next file
-                continue
+    file_paths = [(data_file,
+                   os.path.join(drs_dir, data_file.name if not args.incoming
+                                else data_file.incoming_name))
+                  for data_file in data_files]
+    if not args.skip_checksums:
+        failed_ids = _verify_checksums(file_paths, args)
+    else:
+        failed_ids = set()
+
+    restored_files = []
+    for data_file, file_path in file_paths:
+        if data_file.id in failed_ids:
+            # warning message has already been displayed and so move on
+            # to next file
+            continue
+        filename = os.path.basename(file_path)
 
         # create symbolic link from main directory if storing data in an
         # alternative directory
@@ -251,12 +294,14 @@ def get_moose_url(tape_url, data_files, args):
 
         data_file.directory = drs_dir
         data_file.online = True
-        try:
-            data_file.save()
-        except django.db.utils.IntegrityError:
-            logger.error('data_file.save() failed for {} {}'.
-                         format(data_file.directory, filename))
-            raise
+        restored_files.append(data_file)
+
+    try:
+        bulk_update_files(restored_files, ['directory', 'online'])
+    except django.db.utils.IntegrityError:
+        logger.error('Saving the restored files failed for {}'.
+                     format(drs_dir))
+        raise
 
 
 def get_et_url(tape_url, data_files, args):
@@ -270,17 +315,6 @@ def get_et_url(tape_url, data_files, args):
     """
     logger.debug('Starting restoring {}'.format(tape_url))
 
-    # make a file containing the paths of the files to retrieve from tape
-    filelist_name = get_temp_filename('et_files.txt')
-
-    with open(filelist_name, 'w') as fh:
-        for data_file in data_files:
-            filename = (data_file.name if not args.incoming
-                        else data_file.incoming_name)
-            fh.write(os.path.join(data_file.incoming_directory, filename)
-                     + '\n')
-    logger.debug('File list written to {}'.format(filelist_name))
-
     if args.alternative:
         base_dir = args.alternative
     else:
@@ -295,7 +329,31 @@ def get_et_url(tape_url, data_files, args):
     if not os.path.exists(retrieval_dir):
         os.makedirs(retrieval_dir)
 
-    logger.debug('Restoring to {}'.format(retrieval_dir))
+    # don't restore any files again that a previous attempt at this
+    # retrieval had already restored before it failed
+    files_to_get, restored_ids = find_unrestored_et_files(data_files,
+                                                          retrieval_dir, args)
+    if not files_to_get:
+        logger.debug('All files from {} have already been restored'.
+                     format(tape_url))
+        copy_et_files_into_drs(data_files, retrieval_dir, args,
+                               verified_ids=restored_ids)
+        _remove_retrieval_dir(retrieval_dir)
+        return
+
+    # make a file containing the paths of the files to retrieve from tape
+    filelist_name = get_temp_filename('et_files.txt')
+
+    with open(filelist_name, 'w') as fh:
+        for data_file in files_to_get:
+            filename = (data_file.name if not args.incoming
+                        else data_file.incoming_name)
+            fh.write(os.path.join(data_file.incoming_directory, filename)
+                     + '\n')
+    logger.debug('File list written to {}'.format(filelist_name))
+
+    logger.debug('Restoring {} of {} files to {}'.format(
+        len(files_to_get), len(data_files), retrieval_dir))
 
     cmd = ('/usr/bin/python /usr/bin/et_get.py -f {} -r {} -t {}'.
         format(filelist_name, retrieval_dir,
@@ -303,14 +361,19 @@ def get_et_url(tape_url, data_files, args):
 
     logger.debug('et_get.py command is:\n{}'.format(cmd))
 
-    try:
-        cmd_out = run_command(cmd)
-        pass
-    except RuntimeError as exc:
-        logger.error('et_get.py command failed\n{}'.format(exc.__str__()))
-        sys.exit(1)
+    if args.pipeline:
+        pipeline_et_files_into_drs(cmd, data_files, retrieval_dir, args,
+                                   verified_ids=restored_ids)
+    else:
+        try:
+            cmd_out = run_command(cmd)
+            pass
+        except RuntimeError as exc:
+            logger.error('et_get.py command failed\n{}'.format(exc.__str__()))
+            sys.exit(1)
 
-    copy_et_files_into_drs(data_files, retrieval_dir, args)
+        copy_et_files_into_drs(data_files, retrieval_dir, args,
+                               verified_ids=restored_ids)
 
     try:
         os.remove(filelist_name)
@@ -318,16 +381,205 @@ def get_et_url(tape_url, data_files, args):
         logger.warning('Unable to delete temporary file: {}'.
                        format(filelist_name))
 
+    _remove_retrieval_dir(retrieval_dir)
+
+    logger.debug('Restored {}'.format(tape_url))
+
+
+def find_unrestored_et_files(data_files, retrieval_dir, args):
+    """
+    Find the files that still need to be restored from elastic tape. Files
+    that a previous attempt at the retrieval restored before it failed,
+    either to the retrieval directory or into the DRS structure, don't need
+    to be restored again if they have the expected size and, unless
+    checksums are being skipped, the expected checksum.
+
+    :param list data_files: The DataFile objects to restore.
+    :param str retrieval_dir: The path that the files are retrieved to.
+    :param argparse.Namespace args: The parsed command line arguments
+        namespace.
+    :returns: the DataFile objects that need to be restored and the ids of
+        the files that have already been restored, whose checksums don't
+        need to be checked again
+    :rtype: tuple
+    """
+    file_paths = []
+    for data_file in data_files:
+        for file_path in (_extracted_file_path(data_file, retrieval_dir,
+                                               args),
+                          _drs_file_path(data_file, args)):
+            try:
+                if os.path.getsize(file_path) == data_file.size:
+                    file_paths.append((data_file, file_path))
+                    break
+            except OSError:
+                pass
+
+    if file_paths and not args.skip_checksums:
+        failed_ids = _verify_checksums(file_paths, args)
+    else:
+        failed_ids = set()
+
+    restored_ids = {data_file.id for data_file, _file_path in file_paths
+                    if data_file.id not in failed_ids}
+    if restored_ids:
+        logger.debug('{} files have already been restored'.
+                     format(len(restored_ids)))
+    return ([data_file for data_file in data_files
+             if data_file.id not in restored_ids], restored_ids)
+
+
+def _remove_retrieval_dir(retrieval_dir):
+    """
+    Delete the directory that files were retrieved from elastic tape to.
+
+    :param str retrieval_dir: The path that the files were retrieved to.
+    """
     try:
         shutil.rmtree(retrieval_dir)
     except OSError:
         logger.warning('Unable to delete retrieval directory: {}'.
                        format(retrieval_dir))
 
-    logger.debug('Restored {}'.format(tape_url))
+
+def pipeline_et_files_into_drs(cmd, data_files, retrieval_dir, args,
+                               verified_ids=None):
+    """
+    Run the et_get.py command in the background and copy each file into the
+    DRS structure, verify it and mark it as online as soon as it has been
+    restored, rather than waiting for all of the files to be restored. A file
+    is considered to have been restored once its size matches the size in
+    the database and hasn't changed since the previous poll. Unless checksums
+    are being skipped, each file's checksum is checked before it is moved
+    out of the retrieval directory and any file whose checksum doesn't match
+    is left there to be checked again once et_get.py has finished.
+
+    :param str cmd: The et_get.py command to run.
+    :param list data_files: The DataFile objects being restored.
+    :param str retrieval_dir: The path that the files are being retrieved
+        to.
+    :param argparse.Namespace args: The parsed command line arguments
+        namespace.
+    :param set verified_ids: The ids of any files whose checksums have
+        already been checked.
+    """
+    verified_ids = verified_ids or set()
+    output_name = get_temp_filename('et_get.log')
+    with open(output_name, 'w') as output_fh:
+        process = subprocess.Popen(cmd, stdout=output_fh,
+                                   stderr=subprocess.STDOUT, shell=True)
+
+    remaining = list(data_files)
+    # the files that had their expected size at the previous poll
+    complete_sizes = set()
+    # the files whose checksums didn't match, which aren't polled again
+    failed_ids = set()
+    while process.poll() is None:
+        restored = []
+        for data_file in remaining:
+            if data_file.id in failed_ids:
+                continue
+            if _et_file_restored(data_file, retrieval_dir, args):
+                if data_file.id in complete_sizes:
+                    restored.append(data_file)
+                else:
+                    complete_sizes.add(data_file.id)
+            else:
+                complete_sizes.discard(data_file.id)
+
+        unverified = [data_file for data_file in restored
+                      if data_file.id not in verified_ids]
+        if not args.skip_checksums and unverified:
+            failed_ids |= _verify_checksums(
+                [(data_file, _extracted_file_path(data_file, retrieval_dir,
+                                                  args))
+                 for data_file in unverified],
+                args
+            )
+            restored = [data_file for data_file in restored
+                        if data_file.id not in failed_ids]
+
+        if restored:
+            restored_ids = {data_file.id for data_file in restored}
+            copy_et_files_into_drs(restored, retrieval_dir, args,
+                                   verified_ids=restored_ids)
+            remaining = [data_file for data_file in remaining
+                         if data_file.id not in restored_ids]
+        time.sleep(PIPELINE_POLL_INTERVAL)
+
+    with open(output_name) as fh:
+        cmd_out = fh.read()
+    try:
+        os.remove(output_name)
+    except OSError:
+        logger.warning('Unable to delete temporary file: {}'.
+                       format(output_name))
+
+    # et_get.py returns 17 when it has completed successfully
+    if process.returncode not in (0, 17):
+        logger.error('et_get.py command failed\ncommand:\n{}\nproduced '
+                     'error:\n{}'.format(cmd, cmd_out))
+        sys.exit(1)
+
+    if remaining:
+        copy_et_files_into_drs(remaining, retrieval_dir, args,
+                               verified_ids=verified_ids)
+
+
+def _et_file_restored(data_file, retrieval_dir, args):
+    """
+    Check if a restored file has reached its expected size.
+
+    :param pdata_app.models.DataFile data_file: The file being restored.
+    :param str retrieval_dir: The path that the file is being retrieved to.
+    :param argparse.Namespace args: The parsed command line arguments
+        namespace.
+    :returns: True if the restored file exists and has the expected size
+    :rtype: bool
+    """
+    try:
+        return (os.path.getsize(_extracted_file_path(data_file,
+                                                     retrieval_dir, args)) ==
+                data_file.size)
+    except OSError:
+        return False
 
 
-def copy_et_files_into_drs(data_files, retrieval_dir, args):
+def _extracted_file_path(data_file, retrieval_dir, args):
+    """
+    :param pdata_app.models.DataFile data_file: The file being restored.
+    :param str retrieval_dir: The path that the file is retrieved to.
+    :param argparse.Namespace args: The parsed command line arguments
+        namespace.
+    :returns: the path that elastic tape restores the file to
+    :rtype: str
+    """
+    filename = (data_file.name if not args.incoming
+                else data_file.incoming_name)
+    return os.path.join(retrieval_dir,
+                        data_file.incoming_directory.lstrip('/'), filename)
+
+
+def _drs_file_path(data_file, args):
+    """
+    :param pdata_app.models.DataFile data_file: The file being restored.
+    :param argparse.Namespace args: The parsed command line arguments
+        namespace.
+    :returns: the path that the file is restored to in the DRS structure
+    :rtype: str
+    """
+    filename = (data_file.name if not args.incoming
+                else data_file.incoming_name)
+    drs_path = construct_drs_path(data_file)
+    if not args.alternative:
+        drs_dir = os.path.join(BASE_OUTPUT_DIR, drs_path)
+    else:
+        drs_dir = os.path.join(args.alternative, drs_path)
+    return os.path.join(drs_dir, filename)
+
+
+def copy_et_files_into_drs(data_files, retrieval_dir, args,
+                           verified_ids=None):
     """
     Copy files from the restored data cache into the DRS structure.
 
@@ -335,30 +587,29 @@ def copy_et_files_into_drs(data_files, retrieval_dir, args):
     :param str retrieval_dir: The path that the files were retrieved to.
     :param argparse.Namespace args: The parsed command line arguments
         namespace.
+    :param set verified_ids: The ids of any files whose checksums have
+        already been checked, which aren't checked again.
     """
     logger.debug('Copying elastic tape files')
 
+    file_paths = []
     for data_file in data_files:
-        file_submission_dir = data_file.incoming_directory
         filename = (data_file.name if not args.incoming
                     else data_file.incoming_name)
-        extracted_file_path = os.path.join(retrieval_dir,
-                                           file_submission_dir.lstrip('/'),
-                                           filename)
-        if not os.path.exists(extracted_file_path):
+        extracted_file_path = _extracted_file_path(data_file, retrieval_dir,
+                                                   args)
+        dest_file_path = _drs_file_path(data_file, args)
+        drs_dir = os.path.dirname(dest_file_path)
+        # the file may have been copied into the DRS by a previous attempt
+        # at this retrieval
+        if (not os.path.exists(extracted_file_path) and
+                not os.path.exists(dest_file_path)):
             msg = ('Unable to find file {} in the extracted data at {}. The '
                    'expected path was {}'.format(filename, retrieval_dir,
                                                  extracted_file_path))
             logger.error(msg)
             sys.exit(1)
 
-        drs_path = construct_drs_path(data_file)
-        if not args.alternative:
-            drs_dir = os.path.join(BASE_OUTPUT_DIR, drs_path)
-        else:
-            drs_dir = os.path.join(args.alternative, drs_path)
-        dest_file_path = os.path.join(drs_dir, filename)
-
         # create the path if it doesn't exist
         if not os.path.exists(drs_dir):
             os.makedirs(drs_dir)
@@ -369,57 +620,137 @@ def copy_et_files_into_drs(data_files, retrieval_dir, args):
         else:
             os.rename(extracted_file_path, dest_file_path)
 
-        if not args.skip_checksums:
-            try:
-                _check_file_checksum(data_file, dest_file_path)
-            except ChecksumError:
-                # warning message has already been displayed and so move on
-                # to next file
-                continue
+        file_paths.append((data_file, dest_file_path))
+
+    unverified_paths = [(data_file, file_path)
+                        for data_file, file_path in file_paths
+                        if data_file.id not in (verified_ids or ())]
+    if not args.skip_checksums and unverified_paths:
+        failed_ids = _verify_checksums(unverified_paths, args)
+    else:
+        failed_ids = set()
+
+    restored_files = []
+    for data_file, dest_file_path in file_paths:
+        if data_file.id in failed_ids:
+            # warning message has already been displayed and so move on
+            # to next file
+            continue
+        drs_dir, filename = os.path.split(dest_file_path)
 
         # create symbolic link from main directory if storing data in an
         # alternative directory
         if args.alternative and not is_same_gws(dest_file_path,
                                                 BASE_OUTPUT_DIR):
-            primary_path = os.path.join(BASE_OUTPUT_DIR, drs_path)
+            primary_path = os.path.join(BASE_OUTPUT_DIR,
+                                        construct_drs_path(data_file))
             if not os.path.exists(primary_path):
                 os.makedirs(primary_path)
-            os.symlink(dest_file_path,
-                       os.path.join(primary_path, filename))
+            # the link may have been created by a previous attempt at this
+            # retrieval
+            primary_file = os.path.join(primary_path, filename)
+            if not os.path.exists(primary_file):
+                os.symlink(dest_file_path, primary_file)
 
         # set directory and set status as being online
         data_file.directory = drs_dir
         data_file.online = True
-        data_file.save()
+        restored_files.append(data_file)
+
+    bulk_update_files(restored_files, ['directory', 'online'])
 
     logger.debug('Finished copying elastic tape files')
 
 
-def _check_file_checksum(data_file, file_path):
+def _verify_checksums(file_paths, args):
+    """
+    Check that restored files' checksums match the values in the database.
+    The checksums are calculated in a pool of threads for each group
+    workspace so that the number of files being read simultaneously from
+    each group workspace is limited.
+
+    :param list file_paths: tuples of each DataFile and the path to its
+        restored file
+    :param argparse.Namespace args: The parsed command line arguments
+        namespace.
+    :returns: the ids of the DataFiles whose checksums don't match
+    :rtype: set
+    """
+    checksum_class = TapeChecksum if args.incoming else Checksum
+    # there is only likely to be one checksum and so chose the last one
+    checksum_objs = {}
+    for checksum_obj in (checksum_class.objects.
+                         filter(data_file__in=[data_file for data_file, _path
+                                               in file_paths]).
+                         order_by('id')):
+        checksum_objs[checksum_obj.data_file_id] = checksum_obj
+
+    gws_files = {}
+    for data_file, file_path in file_paths:
+        checksum_obj = checksum_objs.get(data_file.id)
+        if not checksum_obj:
+            msg = ('No checksum exists in the database. Skipping check for {}'.
+                   format(file_path))
+            logger.warning(msg)
+            continue
+        gws_files.setdefault(_get_checksum_group(file_path), []).append(
+            (data_file, file_path, checksum_obj)
+        )
+
+    failed_ids = set()
+    with ExitStack() as stack:
+        futures = {}
+        for files in gws_files.values():
+            executor = stack.enter_context(
+                ThreadPoolExecutor(max_workers=args.checksum_threads)
+            )
+            for data_file, file_path, checksum_obj in files:
+                future = executor.submit(_check_file_checksum, file_path,
+                                         checksum_obj)
+                futures[future] = data_file
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except ChecksumError:
+                failed_ids.add(futures[future].id)
+
+    return failed_ids
+
+
+def _get_checksum_group(file_path):
+    """
+    Find the group workspace that a file is in so that the number of
+    checksums being calculated on each group workspace can be limited.
+
+    :param str file_path: the path to the file
+    :returns: the group workspace or None if the file isn't in one
+    :rtype: str
+    """
+    try:
+        return get_gws_any_dir(file_path)
+    except RuntimeError:
+        return None
+
+
+def _check_file_checksum(file_path, checksum_obj):
     """
     Check that a restored file's checksum matches the value in the database.
 
-    :param pdata_app.models.DataFile data_file: the database file object
     :param str file_path: the path to the restored file
+    :param checksum_obj: the Checksum or TapeChecksum from the database
     :raises ChecksumError: if the checksums don't match.
     """
     checksum_methods = {'ADLER32': adler32,
                         'MD5': md5,
                         'SHA256': sha256}
 
-    # there is only likely to be one checksum and so chose the last one
-    if not cmd_args.incoming:
-        checksum_obj = data_file.checksum_set.last()
-    else:
-        checksum_obj = data_file.tapechecksum_set.last()
-
-    if not checksum_obj:
-        msg = ('No checksum exists in the database. Skipping check for {}'.
-               format(file_path))
-        logger.warning(msg)
-        return
-
-    file_checksum = checksum_methods[checksum_obj.checksum_type](file_path)
+    # the checksum cache isn't used because a file that has been restored
+    # again may have the same inode, size and modification time as a
+    # cached file with different contents
+    file_checksum = checksum_methods[checksum_obj.checksum_type](
+        file_path, use_cache=False
+    )
 
     if file_checksum != checksum_obj.checksum_value:
         msg = ('Checksum for restored file does not match its value in the '
@@ -430,6 +761,105 @@ def _check_file_checksum(data_file, file_path):
         raise ChecksumError(msg)
 
 
+def plan_retrieval(retrieval):
+    """
+    Find all of the offline files that a retrieval needs in a single query
+    and group them by the tape URL that they are stored at. Only the fields
+    needed to retrieve the files are loaded.
+
+    :param pdata_app.models.RetrievalRequest retrieval: The retrieval.
+    :returns: a dictionary with the tape URLs as keys and lists of DataFile
+        objects as values, ordered with the URL containing the most data
+        first so that the longest retrievals are started first, and a
+        dictionary of the total size in bytes of the files at each URL
+    :rtype: tuple
+    """
+    data_files = date_filter_files(
+        DataFile.objects.filter(
+            data_request__in=retrieval.data_request.all(), online=False
+        ),
+        retrieval.start_year, retrieval.end_year
+    ).select_related(
+        'project', 'activity_id', 'institute', 'climate_model',
+        'experiment', 'variable_request'
+    ).only(*RETRIEVAL_FIELDS).order_by('tape_url', 'name')
+
+    url_files = {}
+    tape_sizes = {}
+    for data_file in data_files:
+        url_files.setdefault(data_file.tape_url, []).append(data_file)
+        tape_sizes[data_file.tape_url] = (tape_sizes.get(data_file.tape_url,
+                                                         0) + data_file.size)
+
+    tapes = {tape_url: url_files[tape_url]
+             for tape_url in sorted(url_files,
+                                    key=lambda url: -tape_sizes[url])}
+
+    logger.debug('{} files totalling {} bytes are needed from {} tape URLs'.
+                 format(sum([len(files) for files in tapes.values()]),
+                        sum(tape_sizes.values()), len(tapes)))
+    for tape_url, tape_size in tape_sizes.items():
+        logger.debug('{} {} files {} bytes'.format(tape_url,
+                                                   len(tapes[tape_url]),
+                                                   tape_size))
+
+    return tapes, tape_sizes
+
+
+def claim_tapes(tapes, claims):
+    """
+    Claim the tape URLs in a retrieval plan so that any other retrievals
+    that need data from the same URLs wait for this retrieval to restore
+    them rather than reading them from tape again. If another retrieval has
+    already claimed a URL then all of the files needed from the URL are
+    waited for, so that the URL isn't read twice at once, and any files that
+    the other retrieval isn't restoring are restored once its claim has been
+    released.
+
+    :param dict tapes: The tape URLs as keys and lists of DataFile objects as
+        values.
+    :param pdata_app.utils.tape_claims.TapeUrlClaims claims: The claims
+        made by this retrieval.
+    :returns: the tapes that this retrieval must restore and the tapes that
+        are being restored by other retrievals, in the same form as `tapes`
+    :rtype: tuple
+    """
+    claimed_tapes = {}
+    shared_tapes = {}
+    for tape_url, data_files in tapes.items():
+        if claims.claim(tape_url, [data_file.id for data_file in data_files]):
+            claimed_tapes[tape_url] = data_files
+            continue
+
+        claimed_ids = claims.claimed_files(tape_url)
+        num_shared = len([data_file for data_file in data_files
+                          if data_file.id in claimed_ids])
+        logger.debug('{} is being restored by retrieval {}, which is '
+                     'restoring {} of the {} files needed from it'.
+                     format(tape_url, claims.owner(tape_url), num_shared,
+                            len(data_files)))
+        shared_tapes[tape_url] = data_files
+    return claimed_tapes, shared_tapes
+
+
+def count_missing_files(tapes):
+    """
+    Count how many of the files in a retrieval plan are still offline.
+
+    :param dict tapes: The tape URLs as keys and lists of DataFile objects as
+        values.
+    :returns: the number of files that weren't restored
+    :rtype: int
+    """
+    file_ids = [data_file.id for data_files in tapes.values()
+                for data_file in data_files]
+    num_missing = 0
+    for id_chunk in grouper(file_ids, MAX_IDS_PER_QUERY):
+        num_missing += DataFile.objects.filter(id__in=list(id_chunk),
+                                               online=False).count()
+    return num_missing
+
+
 def _email_user_success(retrieval):
     """
     Send an email to request's creator advising them that their data's been
@@ -525,6 +955,17 @@ def parse_args():
         "checksums on restored files.", action='store_true')
     parser.add_argument('-i', '--incoming', help="restore the incoming "
                         "filename.", action='store_true')
+    parser.add_argument('-c', '--checksum-threads', help='the maximum number '
+        'of files to verify the checksums of simultaneously on each group '
+        'workspace (default: %(default)s)', type=int,
+        default=MAX_CHECKSUM_THREADS)
+    parser.add_argument('-p', '--pipeline', help="copy each file restored "
+        "from elastic tape into the DRS, verify it and mark it as online as "
+        "soon as it has been restored rather than waiting for all of the "
+        "files from each tape URL to be restored.", action='store_true')
+    parser.add_argument('-u', '--claim-dir', help='the directory containing '
+        'the files that record which retrieval is restoring each tape URL '
+        '(default: %(default)s)', default=DEFAULT_CLAIM_DIR)
     parser.add_argument('-l', '--log-level', help='set logging level to one of '
         'debug, info, warn (the default), or error')
     parser.add_argument('--version', action='version',
@@ -554,45 +995,36 @@ def main(args):
                             retrieval.date_complete.strftime('%Y-%m-%d %H:%M')))
         sys.exit(1)
 
-    tapes = {}
-    for data_req in retrieval.data_request.all():
-        all_files = data_req.datafile_set.filter(online=False)
-        filtered_files = date_filter_files(all_files, retrieval.start_year,
-                                           retrieval.end_year)
-        if filtered_files is None:
-            continue
-
-        tape_urls = list(set([qs['tape_url']
-                              for qs in filtered_files.values('tape_url')]))
-        tape_urls.sort()
+    tapes, _tape_sizes = plan_retrieval(retrieval)
 
-        for tape_url in tape_urls:
-            url_files = filtered_files.filter(tape_url=tape_url)
-            if tape_url in tapes:
-                tapes[tape_url] = list(chain(tapes[tape_url], url_files))
-            else:
-                tapes[tape_url] = list(url_files)
-
-    # lets get parallel to speed things up
-    parallel_get_urls(tapes, args)
+    # only restore the tape URLs that aren't already being restored by
+    # another retrieval
+    claims = TapeUrlClaims(args.claim_dir, retrieval.id)
+    claimed_tapes, shared_tapes = claim_tapes(tapes, claims)
+    try:
+        with claims.refreshing(claimed_tapes):
+            # lets get parallel to speed things up
+            parallel_get_urls(claimed_tapes, args)
+    finally:
+        for tape_url in claimed_tapes:
+            claims.release(tape_url)
     # get a fresh DB connection after exiting from parallel operation
     django.db.connections.close_all()
 
     # check that all files were restored
-    failed_files = False
-    for data_req in retrieval.data_request.all():
-        all_files = data_req.datafile_set.filter(online=False)
-        missing_files = date_filter_files(all_files, retrieval.start_year,
-                                          retrieval.end_year)
-        if missing_files is None:
-            continue
-        if missing_files.count() != 0:
-            failed_files = True
-
-    if failed_files:
+    num_missing = count_missing_files(claimed_tapes)
+    num_waiting = count_missing_files(shared_tapes)
+    if num_missing:
+        logger.error('{} files were not restored'.format(num_missing))
         _email_admin_failure(retrieval)
         logger.error('Failed retrieve_request.py for retrieval {}'.
                      format(args.retrieval_id))
+    elif num_waiting:
+        # auto_retrieve.py marks the retrieval as complete once the other
+        # retrievals have restored these files
+        logger.warning('{} files are still being restored by other '
+                       'retrievals'.format(num_waiting))
+        sys.exit(RETRIEVAL_WAITING_EXIT_STATUS)
     else:
         # set date_complete in the db
         retrieval.date_complete = timezone.now()
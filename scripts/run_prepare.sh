@@ -1,36 +1,41 @@
 #!/bin/bash
 # run_prepare.sh
-# The PRIMAVERA DMT's script to run the CMIP6 PrePARE software on a single file
-# It takes a single parameter, which is the name of the file.
+# The PRIMAVERA DMT's script to run the CMIP6 PrePARE software on one or more
+# files. It takes the names of the files as its parameters. All of the files
+# must have the same data_specs_version.
 
-# Check if file exists
-if [ ! -f $1 ]; then
-    echo 'File does not exist ' $1 >&2
-    exit 1
-fi
+# Check if the files exist
+for FILE in "$@"; do
+    if [ ! -f $FILE ]; then
+        echo 'File does not exist ' $FILE >&2
+        exit 1
+    fi
+done
+
+HEADER=`ncdump -h $1`
 
 CMOR=cmor_3_5
 
 # Find the correct set of tables for the data_specs_version
-if grep -q '01.00.13' <<< `ncdump -h $1`; then
+if grep -q '01.00.13' <<< "$HEADER"; then
     TABLE_DIR=/home/users/jseddon/primavera/original-cmor-tables/primavera_1.00.21/Tables
-elif grep -q '01.00.21' <<< `ncdump -h $1`; then
+elif grep -q '01.00.21' <<< "$HEADER"; then
     TABLE_DIR=/home/users/jseddon/primavera/original-cmor-tables/primavera_1.00.21/Tables
-elif grep -q '01.00.23' <<< `ncdump -h $1`; then
+elif grep -q '01.00.23' <<< "$HEADER"; then
     TABLE_DIR=/home/users/jseddon/primavera/original-cmor-tables/primavera_1.00.23/Tables
-elif grep -q '01.00.27' <<< `ncdump -h $1`; then
+elif grep -q '01.00.27' <<< "$HEADER"; then
     TABLE_DIR=/home/users/jseddon/primavera/original-cmor-tables/cmip6-cmor-tables-6.3.27/Tables
     CMOR=cmor_3_5
-elif grep -q '01.00.28' <<< `ncdump -h $1`; then
+elif grep -q '01.00.28' <<< "$HEADER"; then
     TABLE_DIR=/home/users/jseddon/primavera/original-cmor-tables/cmip6-cmor-tables-6.2.15.0/Tables
     CMOR=cmor_3_4_0
-elif grep -q '01.00.29' <<< `ncdump -h $1`; then
+elif grep -q '01.00.29' <<< "$HEADER"; then
     TABLE_DIR=/home/users/jseddon/primavera/original-cmor-tables/cmip6-cmor-tables-6.5.29/Tables
     CMOR=cmor_3_4_0
-elif grep -q '01.00.31' <<< `ncdump -h $1`; then
+elif grep -q '01.00.31' <<< "$HEADER"; then
     TABLE_DIR=/home/users/jseddon/primavera/original-cmor-tables/cmip6-cmor-tables-6.7.31/Tables
     CMOR=cmor_3_4_0
-elif grep -q '01.00.33' <<< `ncdump -h $1`; then
+elif grep -q '01.00.33' <<< "$HEADER"; then
     TABLE_DIR=/home/users/jseddon/primavera/original-cmor-tables/cmip6-cmor-tables-6.9.33/Tables
     CMOR=cmor_3_5
 else
@@ -38,8 +43,17 @@ else
     exit 1
 fi
 
+# Check that the remaining files can be checked with the same tables
+DATA_SPECS=`grep -o ':data_specs_version = "[^"]*"' <<< "$HEADER"`
+for FILE in "${@:2}"; do
+    if ! grep -qF "$DATA_SPECS" <<< `ncdump -h $FILE`; then
+        echo 'data_specs_version differs from ' $1 ' in ' $FILE >&2
+        exit 1
+    fi
+done
+
 # Set-up the environment and run PrePARE
 export PATH=/home/users/jseddon/software/miniconda3/bin:$PATH
 source activate $CMOR
 
-PrePARE --table-path $TABLE_DIR $1
+PrePARE --table-path $TABLE_DIR "$@"
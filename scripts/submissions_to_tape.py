@@ -23,6 +23,7 @@ import django.core.exceptions
 from django.template.defaultfilters import pluralize
 
 from pdata_app.models import DataSubmission
+from pdata_app.signals import defer_statistics
 from pdata_app.utils.common import get_temp_filename
 
 
@@ -92,10 +93,11 @@ def submission_to_tape(data_sub, overwrite=False):
                      format(batch_id))
         # add the batch id to all of the submission's files.
         num_files_updated = 0
-        for data_file in data_sub.get_data_files():
-            data_file.tape_url = 'et:{}'.format(batch_id)
-            data_file.save()
-            num_files_updated += 1
+        with defer_statistics():
+            for data_file in data_sub.get_data_files():
+                data_file.tape_url = 'et:{}'.format(batch_id)
+                data_file.save()
+                num_files_updated += 1
         logger.debug('Elastic tape URL added to {} file{}.'.
                      format(num_files_updated, pluralize(num_files_updated)))
     else:
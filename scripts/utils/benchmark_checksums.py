@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+benchmark_checksums.py
+
+Compare the throughput of calculating file checksums in this process with
+running the external adler32, md5sum and sha256sum programs on each file, and
+check that both methods give identical values.
+"""
+from __future__ import unicode_literals, division, absolute_import
+
+import argparse
+import logging.config
+import os
+from subprocess import check_output, CalledProcessError
+import sys
+import time
+
+from pdata_app.utils.common import (calculate_checksums, CHECKSUM_PROGRAMS,
+                                    CHECKSUM_BLOCK_SIZE)
+
+__version__ = '0.1.0b1'
+
+logger = logging.getLogger(__name__)
+
+ONE_MEBIBYTE = 2 ** 20
+
+
+def external_checksum(program, file_path):
+    """
+    Calculate a file's checksum by running an external program in a shell
+    in the way that the checksums used to be calculated.
+
+    :param str program: the name of the program to run
+    :param str file_path: the path of the file to checksum
+    :returns: the checksum or None if the program failed
+    """
+    try:
+        ret_val = check_output("{} '{}'".format(program, file_path),
+                               shell=True).decode('utf-8')
+    except (CalledProcessError, OSError):
+        return None
+    return ret_val.split()[0]
+
+
+def time_method(description, total_bytes, function, repeats):
+    """
+    Time the fastest of several runs of `function` and log the throughput.
+
+    :param str description: the name of the method to display
+    :param int total_bytes: the number of bytes read by each run
+    :param function: the function to time, which takes no arguments
+    :param int repeats: the number of times to run `function`
+    :returns: the value returned by the final run of `function`
+    """
+    best = None
+    for _index in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+
+    logger.info('{:<35} {:8.3f} s {:10.1f} MiB/s'.format(
+        description, best, total_bytes / ONE_MEBIBYTE / best
+        if best else float('inf')))
+    return result
+
+
+def parse_args():
+    """
+    Parse command-line arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the calculation '
+                                                 'of file checksums.')
+    parser.add_argument('files', nargs='+', help='the files to checksum')
+    parser.add_argument('-c', '--checksum-types', nargs='+',
+                        choices=sorted(CHECKSUM_PROGRAMS.values()),
+                        default=['ADLER32'],
+                        help='the checksum types to calculate (default: '
+                             '%(default)s)')
+    parser.add_argument('-r', '--repeats', type=int, default=3,
+                        help='the number of times to time each method '
+                             '(default: %(default)s)')
+    parser.add_argument('-b', '--block-size', type=int,
+                        default=CHECKSUM_BLOCK_SIZE // ONE_MEBIBYTE,
+                        help='the size in MiB of the blocks read from each '
+                             'file (default: %(default)s)')
+    parser.add_argument('-s', '--skip-external', action='store_true',
+                        help="don't run the external programs")
+    parser.add_argument('-l', '--log-level',
+                        help='set logging level (default: %(default)s)',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        default='info')
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s {}'.format(__version__))
+    args = parser.parse_args()
+
+    return args
+
+
+def main(args):
+    """
+    Main entry point
+    """
+    total_bytes = sum([os.path.getsize(path) for path in args.files])
+    block_size = args.block_size * ONE_MEBIBYTE
+    logger.info('Checksumming {} files containing {:.1f} MiB'.format(
+        len(args.files), total_bytes / ONE_MEBIBYTE))
+
+    results = {}
+    for use_mmap in (False, True):
+        description = 'in-process {}{}'.format(
+            '+'.join(args.checksum_types), ' (mmap)' if use_mmap else '')
+        results[description] = time_method(
+            description, total_bytes,
+            lambda: [calculate_checksums(path, args.checksum_types,
+                                         block_size, use_mmap)
+                     for path in args.files],
+            args.repeats
+        )
+
+    if not args.skip_external:
+        programs = {checksum_type: program
+                    for program, checksum_type in CHECKSUM_PROGRAMS.items()}
+        external = [{} for _path in args.files]
+        for checksum_type in args.checksum_types:
+            values = time_method(
+                'external {}'.format(programs[checksum_type]), total_bytes,
+                lambda: [external_checksum(programs[checksum_type], path)
+                         for path in args.files],
+                args.repeats
+            )
+            for file_values, value in zip(external, values):
+                file_values[checksum_type] = value
+        results['external programs'] = external
+
+    reference = results.pop('in-process {}'.format(
+        '+'.join(args.checksum_types)))
+    for description, values in results.items():
+        for path, expected, actual in zip(args.files, reference, values):
+            if expected != actual:
+                logger.error('{} gives different checksums for {}: {} {}'.
+                             format(description, path, expected, actual))
+                sys.exit(1)
+    logger.info('All checksums match')
+
+
+if __name__ == "__main__":
+    cmd_args = parse_args()
+
+    # determine the log level
+    log_level = getattr(logging, cmd_args.log_level.upper())
+
+    # configure the logger
+    logging.config.dictConfig({
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'standard': {
+                'format': '%(levelname)s: %(message)s',
+            },
+        },
+        'handlers': {
+            'default': {
+                'level': log_level,
+                'class': 'logging.StreamHandler',
+                'formatter': 'standard'
+            },
+        },
+        'loggers': {
+            '': {
+                'handlers': ['default'],
+                'level': log_level,
+                'propagate': True
+            }
+        }
+    })
+
+    # run the code
+    main(cmd_args)
@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+"""
+benchmark_validation.py
+
+Measure the throughput of validating a data submission. A synthetic
+submission of CMIP6 netCDF files is created and the files are checksummed,
+validated with varying numbers of processes and then added to a temporary
+test database. The files per second, MiB per second, peak memory and
+database queries per file of each stage are written as JSON so that the
+results can be tracked over time.
+
+The submission's files are evicted from the page cache before each stage
+so that the MiB per second measures reading from disk rather than from
+memory, unless --warm-cache is given. Where the files can't be evicted,
+the results record that the cache was warm. Queries made by worker
+processes can't be captured and so queries per file are only reported for
+stages that run in a single process.
+
+The test database is created and destroyed by this script and so the DMT's
+own database is not changed.
+"""
+from __future__ import unicode_literals, division, absolute_import
+
+import argparse
+import datetime
+import json
+import logging.config
+import math
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+
+from netCDF4 import Dataset
+import numpy as np
+
+import django
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from pdata_app.models import (ActivityId, ClimateModel, DataFile,
+                              DataRequest, DataSubmission, Experiment,
+                              Institute, Project, VariableRequest)
+from pdata_app.utils.common import calculate_checksums
+from pdata_app.utils.dbapi import get_or_create
+import scripts.validate_data_submission as validate_data_submission
+from test.test_datasets import DatasetForTests
+from vocabs.vocabs import FREQUENCY_VALUES, VARIABLE_TYPES
+
+__version__ = '0.1.0b1'
+
+logger = logging.getLogger(__name__)
+
+ONE_MEBIBYTE = 2 ** 20
+
+# The vocabulary that the synthetic files use
+INSTITUTE = 'MOHC'
+CLIMATE_MODEL = 'HadGEM3-GC31-LM'
+EXPERIMENT = 'highresSST-present'
+ACTIVITY_ID = 'HighResMIP'
+VARIANT_LABEL = 'r1i1p1f1'
+TIME_UNITS = 'days since 1950-01-01'
+CALENDAR = '360_day'
+
+# For each frequency: the MIP table, the number of time points in each
+# year, the format of the dates in the file names and the offset in days
+# of each time point from the start of its period
+FREQUENCIES = {
+    'mon': ('Amon', 12, ('{}01', '{}12'), 15.),
+    'day': ('day', 360, ('{}0101', '{}1230'), 0.5),
+    '3hr': ('3hr', 2880, ('{}01010130', '{}12302230'), 0.0625),
+}
+
+
+class BenchmarkDataset(DatasetForTests):
+    """
+    A synthetic submission of CMIP6 netCDF files, each containing one year
+    of random data. The horizontal grid is sized so that each file is
+    approximately the size requested.
+    """
+    def __init__(self, incoming_dir, variables, frequencies, num_files,
+                 file_size, compress=False):
+        """
+        :param str incoming_dir: the directory to create the files in
+        :param list variables: the names of the variables
+        :param list frequencies: the frequencies to create files at
+        :param int num_files: the total number of files to create
+        :param int file_size: the approximate size of each file in bytes
+        :param bool compress: compress the data in the files
+        """
+        self.INCOMING_DIR = incoming_dir
+        self.file_size = file_size
+        self.compress = compress
+        self.file_details = {}
+
+        streams = [(var, freq) for freq in frequencies for var in variables]
+        files = []
+        for index in range(num_files):
+            var_name, frequency = streams[index % len(streams)]
+            year = 1950 + index // len(streams)
+            table, _steps, date_formats, _offset = FREQUENCIES[frequency]
+            filename = '{}_{}_{}_{}_{}_gn_{}-{}.nc'.format(
+                var_name, table, CLIMATE_MODEL, EXPERIMENT, VARIANT_LABEL,
+                date_formats[0].format(year), date_formats[1].format(year)
+            )
+            files.append(filename)
+            self.file_details[filename] = (var_name, frequency, year)
+
+        super(BenchmarkDataset, self).__init__('benchmark', tuple(files))
+
+    @property
+    def file_paths(self):
+        return [os.path.join(self.INCOMING_DIR, filename)
+                for filename in self.files]
+
+    def create_test_files(self):
+        "Creates netCDF files in incoming."
+        if not os.path.isdir(self.INCOMING_DIR):
+            os.makedirs(self.INCOMING_DIR)
+
+        for filename in self.files:
+            self._write_file(filename, *self.file_details[filename])
+
+    def _write_file(self, filename, var_name, frequency, year):
+        """
+        Write a single CMIP6 netCDF file.
+
+        :param str filename: the name of the file
+        :param str var_name: the variable in the file
+        :param str frequency: the frequency of the data
+        :param int year: the year of data that the file contains
+        """
+        table, steps, _date_formats, offset = FREQUENCIES[frequency]
+        points = max(self.file_size // (4 * steps), 2)
+        num_lats = max(int(math.sqrt(points / 2)), 1)
+        num_lons = 2 * num_lats
+        period = 360. / steps
+        start = (year - 1950) * 360.
+
+        with Dataset(os.path.join(self.INCOMING_DIR, filename), 'w') as nc:
+            nc.setncatts({
+                'Conventions': 'CF-1.7 CMIP-6.2',
+                'activity_id': ACTIVITY_ID,
+                'data_specs_version': '01.00.27',
+                'experiment_id': EXPERIMENT,
+                'frequency': frequency,
+                'grid_label': 'gn',
+                'institution_id': INSTITUTE,
+                'mip_era': 'CMIP6',
+                'source_id': CLIMATE_MODEL,
+                'table_id': table,
+                'variable_id': var_name,
+                'variant_label': VARIANT_LABEL,
+            })
+            nc.createDimension('time', None)
+            nc.createDimension('bnds', 2)
+            nc.createDimension('lat', num_lats)
+            nc.createDimension('lon', num_lons)
+
+            time_var = nc.createVariable('time', 'f8', ('time',))
+            time_var.setncatts({'standard_name': 'time', 'axis': 'T',
+                                'units': TIME_UNITS, 'calendar': CALENDAR,
+                                'bounds': 'time_bnds'})
+            time_var[:] = start + offset + period * np.arange(steps)
+            time_bnds = nc.createVariable('time_bnds', 'f8', ('time', 'bnds'))
+            time_bnds[:, 0] = start + period * np.arange(steps)
+            time_bnds[:, 1] = start + period * np.arange(1, steps + 1)
+
+            lat = nc.createVariable('lat', 'f8', ('lat',))
+            lat.setncatts({'standard_name': 'latitude', 'axis': 'Y',
+                           'units': 'degrees_north'})
+            lat[:] = np.linspace(-90., 90., num_lats)
+            lon = nc.createVariable('lon', 'f8', ('lon',))
+            lon.setncatts({'standard_name': 'longitude', 'axis': 'X',
+                           'units': 'degrees_east'})
+            lon[:] = np.linspace(0., 360., num_lons, endpoint=False)
+
+            data = nc.createVariable(var_name, 'f4', ('time', 'lat', 'lon'),
+                                     zlib=self.compress,
+                                     chunksizes=(1, num_lats, num_lons))
+            data.setncatts({'standard_name': 'air_temperature',
+                            'long_name': var_name, 'units': 'K',
+                            'cell_methods': 'area: time: mean'})
+            for index in range(steps):
+                data[index] = np.random.random_sample(
+                    (num_lats, num_lons)).astype('f4')
+
+
+def create_vocabularies(dataset, mip_era):
+    """
+    Create the database objects that the synthetic files refer to.
+
+    :param BenchmarkDataset dataset: the synthetic submission
+    :param str mip_era: the project that the files are submitted to
+    """
+    project = get_or_create(Project, short_name=mip_era, full_name=mip_era)
+    institute = get_or_create(Institute, short_name=INSTITUTE,
+                              full_name=INSTITUTE)
+    climate_model = get_or_create(ClimateModel, short_name=CLIMATE_MODEL,
+                                  full_name=CLIMATE_MODEL)
+    experiment = get_or_create(Experiment, short_name=EXPERIMENT,
+                               full_name=EXPERIMENT)
+    get_or_create(ActivityId, short_name=ACTIVITY_ID, full_name=ACTIVITY_ID)
+
+    streams = {(var_name, frequency) for var_name, frequency, _year in
+               dataset.file_details.values()}
+    for var_name, frequency in streams:
+        var_req = get_or_create(VariableRequest,
+                                table_name=FREQUENCIES[frequency][0],
+                                long_name=var_name, units='K',
+                                var_name=var_name,
+                                standard_name='air_temperature',
+                                cell_methods='area: time: mean',
+                                positive='', variable_type=VARIABLE_TYPES[
+                                    'real'],
+                                dimensions='longitude latitude time',
+                                cmor_name=var_name, modeling_realm='atmos',
+                                frequency=FREQUENCY_VALUES[frequency],
+                                cell_measures='area: areacella',
+                                uid=var_name)
+        get_or_create(DataRequest, project=project, institute=institute,
+                      climate_model=climate_model, experiment=experiment,
+                      variable_request=var_req, rip_code=VARIANT_LABEL,
+                      request_start_time=0., request_end_time=36000.,
+                      time_units=TIME_UNITS, calendar=CALENDAR)
+
+
+def drop_page_cache(file_paths):
+    """
+    Evict files from the operating system's page cache so that they are
+    read from disk by the next stage.
+
+    :param list file_paths: the paths of the files to evict
+    :returns: True if the files were evicted
+    :rtype: bool
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+
+    # dirty pages aren't evicted and so the files are written to disk first
+    os.sync()
+    for file_path in file_paths:
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return True
+
+
+def measure(stage, num_processes, dataset, function, warm_cache=False):
+    """
+    Run one stage of the benchmark and measure its performance.
+
+    :param str stage: the name of the stage
+    :param int num_processes: the number of processes that the stage uses
+    :param BenchmarkDataset dataset: the files that the stage processes
+    :param function: the function to run, which takes no arguments
+    :param bool warm_cache: if True then the files aren't evicted from the
+        page cache before the stage is run
+    :returns: the measurements and the value returned by `function`
+    :rtype: tuple
+    """
+    total_bytes = sum([os.path.getsize(path) for path in dataset.file_paths])
+    num_files = len(dataset.files)
+
+    cold_cache = not warm_cache and drop_page_cache(dataset.file_paths)
+
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        result = function()
+        duration = time.perf_counter() - start
+
+    # ru_maxrss is in kibibytes on Linux and is the maximum of any single
+    # process, which for the children is the largest worker so far
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    # only the queries made by this process are captured
+    if num_processes == 1 and num_files:
+        queries_per_file = len(queries) / num_files
+    else:
+        queries_per_file = None
+
+    measurements = {
+        'stage': stage,
+        'processes': num_processes,
+        'files': num_files,
+        'bytes': total_bytes,
+        'cold_cache': cold_cache,
+        'seconds': duration,
+        'files_per_second': num_files / duration if duration else None,
+        'mib_per_second': (total_bytes / ONE_MEBIBYTE / duration
+                           if duration else None),
+        'peak_rss_mib': peak_rss / 1024,
+        'queries_per_file': queries_per_file,
+    }
+    logger.info('{stage:<16} {processes:3d} processes {files_per_second:9.2f} '
+                'files/s {mib_per_second:9.1f} MiB/s {queries} queries/file '
+                '{cache} cache'.format(
+                    queries=('{:6.2f}'.format(queries_per_file)
+                             if queries_per_file is not None else '   n/a'),
+                    cache='cold' if cold_cache else 'warm',
+                    **measurements))
+    return measurements, result
+
+
+def run_benchmark(args, dataset):
+    """
+    Run each stage of the benchmark.
+
+    :param argparse.Namespace args: the command line arguments
+    :param BenchmarkDataset dataset: the synthetic submission
+    :returns: the measurements of each stage
+    :rtype: list
+    """
+    results = []
+
+    measurements, _checksums = measure(
+        'checksum', 1, dataset,
+        lambda: [calculate_checksums(path, ['ADLER32'])
+                 for path in dataset.file_paths],
+        args.warm_cache
+    )
+    results.append(measurements)
+
+    user = get_or_create(User, username='benchmark')
+    data_sub = get_or_create(DataSubmission,
+                             incoming_directory=dataset.INCOMING_DIR,
+                             directory=dataset.INCOMING_DIR, user=user)
+
+    for num_processes in args.processes:
+        measurements, validated_metadata = measure(
+            'validate', num_processes, dataset,
+            lambda: list(validate_data_submission.identify_and_validate(
+                dataset.file_paths, args.mip_era, num_processes, 'CMIP6')),
+            args.warm_cache
+        )
+        measurements['validated'] = len(validated_metadata)
+        results.append(measurements)
+        if len(validated_metadata) != len(dataset.files):
+            logger.warning('Only {} of {} files passed validation'.format(
+                len(validated_metadata), len(dataset.files)))
+
+        measurements, _result = measure(
+            'update_database', 1, dataset,
+            lambda: validate_data_submission.update_database_submission(
+                validated_metadata, data_sub),
+            args.warm_cache
+        )
+        results.append(measurements)
+        DataFile.objects.filter(data_submission=data_sub).delete()
+
+    return results
+
+
+def parse_args():
+    """
+    Parse command-line arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the validation '
+                                                 'of a data submission.')
+    parser.add_argument('-n', '--num-files', type=int, default=20,
+                        help='the number of files in the submission '
+                             '(default: %(default)s)')
+    parser.add_argument('-s', '--file-size', type=int, default=16,
+                        help='the approximate size of each file in MiB '
+                             '(default: %(default)s)')
+    parser.add_argument('-v', '--variables', nargs='+', default=['tas'],
+                        help='the variables in the submission (default: '
+                             '%(default)s)')
+    parser.add_argument('-f', '--frequencies', nargs='+', default=['day'],
+                        choices=sorted(FREQUENCIES),
+                        help='the frequencies of the files in the '
+                             'submission (default: %(default)s)')
+    parser.add_argument('-p', '--processes', nargs='+', type=int,
+                        default=[1, 2, 4],
+                        help='the numbers of processes to validate with '
+                             '(default: %(default)s)')
+    parser.add_argument('-c', '--compress', action='store_true',
+                        help='compress the data in the files')
+    parser.add_argument('-w', '--warm-cache', action='store_true',
+                        help="don't evict the files from the page cache "
+                             "before each stage")
+    parser.add_argument('-d', '--directory',
+                        help='the directory to create the submission in '
+                             '(default: a new temporary directory)')
+    parser.add_argument('-j', '--mip-era', default='CMIP6',
+                        help='the project to submit the files to (default: '
+                             '%(default)s)')
+    parser.add_argument('-o', '--output',
+                        help='the file to write the JSON results to '
+                             '(default: standard output)')
+    parser.add_argument('-l', '--log-level',
+                        help='set logging level (default: %(default)s)',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        default='info')
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s {}'.format(__version__))
+    args = parser.parse_args()
+
+    return args
+
+
+def main(args):
+    """
+    Main entry point
+    """
+    # the validation uses the command line arguments of its own script
+    validate_data_submission.cmd_args = argparse.Namespace(
+        data_limit=validate_data_submission.DATA_INTEGRITY_MEMORY_LIMIT
+    )
+
+    parent_dir = args.directory or tempfile.mkdtemp()
+    dataset = BenchmarkDataset(os.path.join(parent_dir, 'submission'),
+                               args.variables, args.frequencies,
+                               args.num_files, args.file_size * ONE_MEBIBYTE,
+                               args.compress)
+    old_database_name = connection.creation.create_test_db(verbosity=0,
+                                                           autoclobber=True,
+                                                           serialize=False)
+    try:
+        logger.info('Creating {} files'.format(args.num_files))
+        dataset.create_test_files()
+        create_vocabularies(dataset, args.mip_era)
+        results = run_benchmark(args, dataset)
+    finally:
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+        if args.directory:
+            shutil.rmtree(dataset.INCOMING_DIR)
+        else:
+            shutil.rmtree(parent_dir)
+
+    output = {
+        'version': __version__,
+        'date': datetime.datetime.utcnow().isoformat(),
+        'host': platform.node(),
+        'database': connection.vendor,
+        'parameters': {
+            'num_files': args.num_files,
+            'file_size_mib': args.file_size,
+            'variables': args.variables,
+            'frequencies': args.frequencies,
+            'compress': args.compress,
+            'warm_cache': args.warm_cache,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(output, fh, indent=4)
+    else:
+        print(json.dumps(output, indent=4))
+
+
+if __name__ == "__main__":
+    cmd_args = parse_args()
+
+    # determine the log level
+    log_level = getattr(logging, cmd_args.log_level.upper())
+
+    # configure the logger
+    logging.config.dictConfig({
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'standard': {
+                'format': '%(levelname)s: %(message)s',
+            },
+        },
+        'handlers': {
+            'default': {
+                'level': log_level,
+                'class': 'logging.StreamHandler',
+                'formatter': 'standard'
+            },
+        },
+        'loggers': {
+            '': {
+                'handlers': ['default'],
+                'level': log_level,
+                'propagate': True
+            }
+        }
+    })
+
+    # run the code
+    main(cmd_args)
@@ -7,16 +7,18 @@ data submission in the Data Management Tool.
 """
 from __future__ import unicode_literals, division, absolute_import
 import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import datetime
+import io
 import itertools
 import json
 import logging.config
-from multiprocessing import Process, Manager
 from multiprocessing.pool import ThreadPool
 from netCDF4 import Dataset
 import os
 import re
 import shutil
+import sqlite3
 import subprocess
 import sys
 import time
@@ -38,12 +40,20 @@ import django
 django.setup()
 
 from django.contrib.auth.models import User
+from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
+from django.db import transaction
 
 from pdata_app.models import (Project, ClimateModel, Experiment, DataSubmission,
     DataFile, VariableRequest, DataRequest, Checksum, Settings, Institute,
     ActivityId, EmailQueue)
-from pdata_app.utils.dbapi import get_or_create, match_one
-from pdata_app.utils.common import adler32, list_files, pdt2num
+from pdata_app.utils.dbapi import match_one, refresh_statistics
+from pdata_app.utils.fk_resolver import ForeignKeyResolver
+from pdata_app.utils.common import (adler32, list_files, pdt2num, grouper,
+                                    calculate_file_years, get_checksums)
+from pdata_app.utils.validation_store import (ValidationResult,
+                                              ValidationResultStore,
+                                              default_store_path,
+                                              DEFAULT_STORE_DIR)
 from vocabs.vocabs import STATUS_VALUES, CHECKSUM_TYPES
 
 # Ignore warnings displayed when loading data
@@ -58,10 +68,25 @@ logger = logging.getLogger(__name__)
 
 CONTACT_PERSON_USER_ID = 'jseddon'
 
-# The maximum size (in bytes) of file to read into memory for an HDF
-# data integrity check
-# 1073741824 = 1 GiB
-MAX_DATA_INTEGRITY_SIZE = 1073741824
+# The maximum amount of data (in bytes) to read into memory at once during an
+# HDF data integrity check
+# 268435456 = 256 MiB
+DATA_INTEGRITY_MEMORY_LIMIT = 268435456
+
+# The number of files that are given to each validation process at a time
+VALIDATION_CHUNK_SIZE = 10
+
+# The number of chunks of files to queue for each validation process
+MAX_QUEUED_CHUNKS = 2
+
+# The number of files to insert into the database in each transaction
+BULK_CREATE_CHUNK_SIZE = 1000
+
+# The number of file names to look up in each database query
+NAME_QUERY_CHUNK_SIZE = 1000
+
+# The maximum number of files to check in each run of PrePARE
+PREPARE_BATCH_SIZE = 50
 
 # Don't run PrePARE on the following var/table combinations as they've
 # been removed from the CMIP6 data request, but are still needed for
@@ -77,6 +102,10 @@ SKIP_PREPARE_VARS = ['psl_E3hrPt', 'ua850_E3hrPt', 'va850_E3hrPt',
 ]
 
 
+# The ForeignKeyResolver used by the validation in this process
+_fk_resolver = None
+
+
 class SubmissionError(Exception):
     """
     An exception to indicate that there has been an error that means that
@@ -85,11 +114,15 @@ class SubmissionError(Exception):
     pass
 
 
-def identify_and_validate(filenames, project, num_processes, file_format):
+def identify_and_validate(filenames, project, num_processes, file_format,
+                          results_store=None):
     """
     Loop through a list of file names, identify each file's metadata and then
-    validate it. The looping is done in parallel using the multiprocessing
-    library module.
+    validate it. The files are split into chunks, which are validated in
+    parallel by a pool of processes, and the metadata of the files in each
+    chunk that pass validation is yielded as soon as the chunk is complete.
+    Only a few chunks are queued at any time so that the memory used doesn't
+    depend on the number of files.
 
     clt_Amon_HadGEM2-ES_historical_r1i1p1_185912-188411.nc
 
@@ -98,106 +131,314 @@ def identify_and_validate(filenames, project, num_processes, file_format):
     :param int num_processes: The number of parallel processes to use
     :param str file_format: The CMOR version of the netCDF files, one out of-
         CMIP5 or CMIP6
-    :returns: A list containing the metadata dictionary generated for each file
-    :rtype: multiprocessing.Manager.list
-    """
-    jobs = []
-    manager = Manager()
-    params = manager.Queue()
-    result_list = manager.list()
-    error_event = manager.Event()
-    if num_processes != 1:
-        for i in range(num_processes):
-            p = Process(target=identify_and_validate_file, args=(params,
-                result_list, error_event))
-            jobs.append(p)
-            p.start()
-
-    func_input_pair = list(zip(filenames,
-                          (project,) * len(filenames),
-                          (file_format,) * len(filenames)))
-    blank_pair = (None, None, None)
-
-    iters = itertools.chain(func_input_pair, (blank_pair,) * num_processes)
-    for item in iters:
-        params.put(item)
+    :param pdata_app.utils.validation_store.ValidationResultStore
+        results_store: If specified then the result of validating each file
+        is recorded in this store.
+    :returns: A generator of the metadata dictionary generated for each file
+        that passes validation
+    :raises SubmissionError: if a serious error means that the submission
+        cannot continue
+    """
+    chunks = (list(chunk) for chunk in
+              grouper(filenames, VALIDATION_CHUNK_SIZE))
+    num_checked = 0
+
+    # load the objects that the files' foreign keys can refer to before any
+    # workers are started so that they are shared by all of the workers
+    fk_resolver = ForeignKeyResolver()
 
     if num_processes == 1:
-        identify_and_validate_file(params, result_list, error_event)
-    else:
-        for j in jobs:
-            j.join()
+        _set_fk_resolver(fk_resolver)
+        for chunk in chunks:
+            results = _identify_and_validate_chunk(chunk, project,
+                                                   file_format)
+            for metadata in _record_results(results, results_store):
+                yield metadata
+            num_checked += len(chunk)
+            _log_progress(num_checked, len(filenames))
+        return
+
+    # the workers must not share the parent's database connections
+    django.db.connections.close_all()
 
-    if error_event.is_set():
-        raise SubmissionError()
+    with ProcessPoolExecutor(max_workers=num_processes,
+                             initializer=_init_worker,
+                             initargs=(fk_resolver,)) as executor:
+        pending = {}
+
+        def submit_chunks(num_chunks):
+            for chunk in itertools.islice(chunks, num_chunks):
+                future = executor.submit(_identify_and_validate_chunk, chunk,
+                                         project, file_format)
+                pending[future] = len(chunk)
+
+        submit_chunks(MAX_QUEUED_CHUNKS * num_processes)
+        while pending:
+            done, _not_done = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                num_checked += pending.pop(future)
+                try:
+                    results = future.result()
+                except SubmissionError:
+                    for queued_future in pending:
+                        queued_future.cancel()
+                    raise
+                for metadata in _record_results(results, results_store):
+                    yield metadata
+                _log_progress(num_checked, len(filenames))
+            submit_chunks(len(done))
+
+
+def remove_existing_files(filenames):
+    """
+    Find any files whose names are already in the database, which therefore
+    fail validation, in as few queries as possible so that they are rejected
+    before any files are opened.
 
-    return result_list
+    :param list filenames: The paths of the submitted files
+    :returns: the paths of the files that aren't already in the database
+    :rtype: list
+    """
+    existing = set()
+    for chunk in grouper(filenames, NAME_QUERY_CHUNK_SIZE):
+        basenames = [os.path.basename(filename) for filename in chunk]
+        existing.update(DataFile.objects.filter(
+            name__in=basenames
+        ).values_list('name', flat=True))
+
+    new_files = []
+    for filename in filenames:
+        basename = os.path.basename(filename)
+        if basename in existing:
+            logger.warning('File failed validation. File {} already exists '
+                           'in the database.'.format(basename))
+        else:
+            new_files.append(filename)
+    return new_files
 
 
-def identify_and_validate_file(params, output, error_event):
+def load_validated_files(filenames, results_store, verify_checksums=False):
     """
-    Identify `filename`'s metadata and then validate the file. The function
-    continues getting items to process from the parameter queue until a None
-    is received.
+    Find the files that passed validation in an earlier run of this script
+    and that haven't changed since then.
+
+    :param list filenames: The paths of the submitted files
+    :param pdata_app.utils.validation_store.ValidationResultStore
+        results_store: The results of earlier validations
+    :param bool verify_checksums: True to recalculate each file's checksum
+        to confirm that it is unchanged, rather than relying on its size and
+        modification time
+    :returns: a list of the metadata of the files that have already been
+        validated, and a list of the paths of the files that still need to be
+        validated
+    :rtype: tuple
+    """
+    # each object referred to by the metadata is only loaded once
+    objects = {}
+
+    def object_hook(dict_):
+        if dict_.get('__class__') in (None, 'PartialDateTime'):
+            return _dict_to_object(dict_)
+        key = json.dumps(dict_, sort_keys=True)
+        if key not in objects:
+            objects[key] = _dict_to_object(dict_)
+        if objects[key] is None:
+            raise ValueError('Cannot find {} {}'.format(dict_['__class__'],
+                                                        dict_['__kwargs__']))
+        return objects[key]
+
+    validated_metadata = []
+    to_validate = []
+    for filename in filenames:
+        metadata = _load_validated_file(filename, results_store, object_hook,
+                                        verify_checksums)
+        if metadata is None:
+            to_validate.append(filename)
+        else:
+            validated_metadata.append(metadata)
 
-    :param multiprocessing.Manager.Queue params: A queue, with each item being a
-        tuple of the filename to load, the name of the project and the netCDF
-        file CMOR version
-    :param multiprocessing.Manager.list output: A list containing the output
-        metadata dictionaries for each file
-    :param multiprocessing.Manager.Event error_event: If set then a catastrophic
-        error has occurred in another process and processing should end
+    logger.debug('%s files passed validation in an earlier run',
+                 len(validated_metadata))
+    return validated_metadata, to_validate
+
+
+def _load_validated_file(filename, results_store, object_hook,
+                         verify_checksums):
     """
-    while True:
-        # close existing connections so that a fresh connection is made
-        django.db.connections.close_all()
+    Load the metadata of a file if it passed validation in an earlier run and
+    its size and modification time, and optionally its checksum, are
+    unchanged.
+
+    :param str filename: The path of the file
+    :param pdata_app.utils.validation_store.ValidationResultStore
+        results_store: The results of earlier validations
+    :param object_hook: The function to convert the objects in the stored
+        JSON metadata
+    :param bool verify_checksums: True to check that the file's checksum
+        matches the stored checksum
+    :returns: the file's metadata or None if it must be validated
+    :rtype: dict
+    """
+    try:
+        result = results_store.get(filename, os.stat(filename))
+    except (OSError, sqlite3.Error):
+        return None
+
+    if result is None or not result.passed:
+        return None
+
+    if verify_checksums and result.checksum_value is not None:
+        try:
+            checksums = get_checksums(filename, [result.checksum_type])
+        except (IOError, OSError, ValueError):
+            return None
+        if checksums[result.checksum_type] != result.checksum_value:
+            return None
+
+    try:
+        return json.loads(result.metadata, object_hook=object_hook)
+    except (ValueError, ObjectDoesNotExist, MultipleObjectsReturned):
+        return None
+
+
+def _record_results(results, results_store):
+    """
+    Record the outcome of validating a chunk of files in the results store
+    and generate the metadata of the files that passed.
+
+    :param list results: A tuple for each file of its path, the result of
+        os.stat() before it was validated and its metadata or None if it
+        failed validation
+    :param pdata_app.utils.validation_store.ValidationResultStore
+        results_store: The store to record the results in, or None to not
+        record them
+    :returns: A generator of the metadata dictionaries of the files that
+        passed validation
+    """
+    for filename, file_stat, metadata in results:
+        if results_store is not None and file_stat is not None:
+            if metadata is None:
+                result = ValidationResult(False, None, None, None)
+            else:
+                result = ValidationResult(
+                    True, metadata.get('checksum_type'),
+                    metadata.get('checksum_value'),
+                    json.dumps(metadata, default=_object_to_default)
+                )
+            try:
+                results_store.set(filename, file_stat, result)
+            except sqlite3.Error as exc:
+                logger.debug('Unable to record validation result for {}: '
+                             '{}'.format(filename, exc))
+        if metadata is not None:
+            yield metadata
+
+
+def _init_worker(fk_resolver):
+    """
+    Run once when each validation worker process starts so that the worker
+    makes its own database connection, which it then keeps for all of the
+    files that it validates.
+
+    :param pdata_app.utils.fk_resolver.ForeignKeyResolver fk_resolver: The
+        preloaded foreign key objects.
+    """
+    django.db.connections.close_all()
+    _set_fk_resolver(fk_resolver)
+
+
+def _set_fk_resolver(fk_resolver):
+    """
+    Set the foreign key resolver used to validate files in this process.
+
+    :param pdata_app.utils.fk_resolver.ForeignKeyResolver fk_resolver: The
+        preloaded foreign key objects.
+    """
+    global _fk_resolver
+    _fk_resolver = fk_resolver
+
+
+def _log_progress(num_checked, num_files):
+    """
+    Display how many files have been validated so far.
+
+    :param int num_checked: the number of files checked so far
+    :param int num_files: the total number of files
+    """
+    logger.debug('Validated {} of {} files'.format(num_checked, num_files))
+
+
+def _identify_and_validate_chunk(filenames, project, file_format):
+    """
+    Identify and validate each of the files in a chunk. This function is run
+    in the worker processes.
 
-        if error_event.is_set():
-            return
+    :param list filenames: The files to process
+    :param str project: The name of the project
+    :param str file_format: The CMOR version of the netCDF files
+    :returns: a tuple for each file of its path, the result of os.stat()
+        before it was validated, or None if this failed, and its metadata or
+        None if it failed validation
+    :rtype: list
+    :raises SubmissionError: if a serious error means that the submission
+        cannot continue
+    """
+    results = []
+    for filename in filenames:
+        try:
+            file_stat = os.stat(filename)
+        except OSError:
+            file_stat = None
+        metadata = identify_and_validate_file(filename, project, file_format)
+        results.append((filename, file_stat, metadata))
+    return results
 
-        filename, project, file_format = params.get()
 
-        if filename is None:
-            return
+def identify_and_validate_file(filename, project, file_format):
+    """
+    Identify `filename`'s metadata and then validate the file, retrying once
+    if the database is temporarily unavailable.
 
+    :param str filename: The name of the file
+    :param str project: The name of the project
+    :param str file_format: The format of the file (CMIP5 or CMIP6)
+    :returns: the file's metadata or None if it failed validation
+    :rtype: dict
+    :raises SubmissionError: if a serious error means that the submission
+        cannot continue
+    """
+    try:
+        return _identify_and_validate_file(filename, project, file_format)
+    except django.db.utils.OperationalError:
+        # Wait and then re-run once in case of temporary database
+        # high load
+        logger.warning('django.db.utils.OperationalError waiting for one '
+                       'minute and then retrying.')
+        time.sleep(60)
+        # the connection may have been lost and so make a new one
+        django.db.connections.close_all()
         try:
-            _identify_and_validate_file(filename, project, file_format,output,
-                                        error_event)
+            return _identify_and_validate_file(filename, project,
+                                               file_format)
         except django.db.utils.OperationalError:
-            # Wait and then re-run once in case of temporary database
-            # high load
-            logger.warning('django.db.utils.OperationalError waiting for one '
-                           'minute and then retrying.')
-            time.sleep(60)
-            try:
-                _identify_and_validate_file(filename, project, file_format,
-                                            output, error_event)
-            except django.db.utils.OperationalError:
-                logger.error('django.db.utils.OperationalError for a second '
-                             'time. Exiting.')
-                error_event.set()
-                raise
+            logger.error('django.db.utils.OperationalError for a second '
+                         'time. Exiting.')
+            raise SubmissionError()
 
 
-def _identify_and_validate_file(filename, project, file_format, output,
-                                error_event):
+def _identify_and_validate_file(filename, project, file_format):
     """
     Do the validation of a file.
 
     :param str filename: The name of the file
     :param str project: The name of the project
     :param str file_format: The format of the file (CMIP5 or CMIP6)
-    :param multiprocessing.Manager.list output: A list containing the output
-        metadata dictionaries for each file
-    :param multiprocessing.Manager.Event error_event: If set then a catastrophic
-        error has occurred in another process and processing should end
+    :returns: the file's metadata or None if it failed validation
+    :rtype: dict
+    :raises SubmissionError: if a serious error means that the submission
+        cannot continue
     """
     try:
-        basename = os.path.basename(filename)
-        if DataFile.objects.filter(name=basename).count() > 0:
-            msg = 'File {} already exists in the database.'.format(basename)
-            raise FileValidationError(msg)
-
         metadata = identify_filename_metadata(filename, file_format)
 
         if metadata['table'].startswith('Prim'):
@@ -205,6 +446,12 @@ def _identify_and_validate_file(filename, project, file_format, output,
         else:
             metadata['project'] = project
 
+        # Read the whole file sequentially for the checksum before any other
+        # checks so that the later reads of the same file are served from
+        # the page cache rather than the file system
+        bytes_read_start = _process_bytes_read()
+        calculate_checksum(metadata)
+
         if 'fx' in metadata['table']:
             cf = iris.fileformats.cf.CFReader(filename)
             metadata.update(identify_cell_measures_metadata(cf, filename))
@@ -213,26 +460,36 @@ def _identify_and_validate_file(filename, project, file_format, output,
             cube = load_cube(filename)
             metadata.update(identify_contents_metadata(cube, filename))
             validate_file_contents(cube, metadata)
-            _contents_hdf_check(cube, metadata, cmd_args.data_limit)
+            _contents_hdf_check(metadata, cmd_args.data_limit)
 
-        verify_fk_relationships(metadata)
+        bytes_read_end = _process_bytes_read()
+        if bytes_read_start is not None and bytes_read_end is not None:
+            metadata['bytes_read'] = bytes_read_end - bytes_read_start
+            logger.debug('Read {} bytes validating {}'.format(
+                metadata['bytes_read'], metadata['basename']))
+        else:
+            metadata['bytes_read'] = None
 
-        calculate_checksum(metadata)
+        verify_fk_relationships(metadata, _fk_resolver)
     except SubmissionError:
         msg = ('A serious file error means the submission cannot continue: '
                '{}'.format(filename))
         logger.error(msg)
-        error_event.set()
+        raise
     except FileValidationError as fve:
         msg = 'File failed validation. {}'.format(fve.__str__())
         logger.warning(msg)
+        return None
     else:
-        output.append(metadata)
+        return metadata
 
 
 def calculate_checksum(metadata):
+    # the checksum cache isn't used because the checksum recorded for the
+    # file must come from reading its data
     checksum_value = adler32(os.path.join(metadata['directory'],
-                                          metadata['basename']))
+                                          metadata['basename']),
+                             use_cache=False)
     if checksum_value:
         metadata['checksum_type'] = CHECKSUM_TYPES['ADLER32']
         metadata['checksum_value'] = checksum_value
@@ -244,24 +501,38 @@ def calculate_checksum(metadata):
         metadata['checksum_value'] = None
 
 
-def verify_fk_relationships(metadata):
+def _process_bytes_read():
+    """
+    Find the total number of bytes that this process has read from files,
+    whether from the file system or the page cache.
+
+    :returns: the number of bytes read or None if this isn't available on
+        this platform
+    :rtype: int
+    """
+    try:
+        with open('/proc/self/io') as fh:
+            for line in fh:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def verify_fk_relationships(metadata, fk_resolver):
     """
     Identify the variable_request and data_request objects corresponding to this file.
 
     :param dict metadata: Metadata identified for this file.
+    :param pdata_app.utils.fk_resolver.ForeignKeyResolver fk_resolver: The
+        preloaded objects to find the file's foreign keys in.
     :raises SubmissionError: If there are no existing entries in the
         database for `Project`, `ClimateModel` or `Experiment`.
     """
-    foreign_key_types = [
-        (Project, 'project'),
-        (ClimateModel, 'climate_model'),
-        (Experiment, 'experiment'),
-        (Institute, 'institute'),
-        (ActivityId, 'activity_id')]
-
     # get values for each of the foreign key types
-    for object_type, object_str in foreign_key_types:
-        result = match_one(object_type, short_name=metadata[object_str])
+    for object_str, _object_type in fk_resolver.VOCABULARIES:
+        result = fk_resolver.get_vocabulary(object_str, metadata[object_str])
         if result:
             metadata[object_str] = result
         else:
@@ -272,37 +543,32 @@ def verify_fk_relationships(metadata):
             raise SubmissionError(msg)
 
     # find the data request
-    dreq_match = match_one(
-        DataRequest,
-        project=metadata['project'],
-        institute=metadata['institute'],
-        climate_model=metadata['climate_model'],
-        experiment=metadata['experiment'],
-        variable_request__table_name=metadata['table'],
-        variable_request__cmor_name=metadata['var_name'],
-        rip_code=metadata['rip_code']
+    dreq_keys = {
+        'project': metadata['project'],
+        'institute': metadata['institute'],
+        'climate_model': metadata['climate_model'],
+        'experiment': metadata['experiment'],
+        'table_name': metadata['table'],
+        'rip_code': metadata['rip_code']
+    }
+    dreq_matches = fk_resolver.get_data_requests(
+        cmor_name=metadata['var_name'], **dreq_keys
     )
-    if dreq_match:
-        metadata['data_request'] = dreq_match
-        metadata['variable'] = dreq_match.variable_request
+    if len(dreq_matches) == 1:
+        metadata['data_request'] = dreq_matches[0]
+        metadata['variable'] = dreq_matches[0].variable_request
     else:
         # if cmor_name doesn't match then it may be a variable where out_name
         # is different to cmor_name so check these
-        dreq_matches = DataRequest.objects.filter(
-            project=metadata['project'],
-            institute=metadata['institute'],
-            climate_model=metadata['climate_model'],
-            experiment=metadata['experiment'],
-            variable_request__table_name=metadata['table'],
-            variable_request__var_name=metadata['var_name'],
-            rip_code=metadata['rip_code']
+        dreq_matches = fk_resolver.get_data_requests(
+            var_name=metadata['var_name'], **dreq_keys
         )
-        if dreq_matches.count() == 0:
+        if len(dreq_matches) == 0:
             msg = ('No data request found for file: {}.'.
                    format(metadata['basename']))
             logger.error(msg)
             raise FileValidationError(msg)
-        elif dreq_matches.count() == 1:
+        elif len(dreq_matches) == 1:
             metadata['data_request'] = dreq_matches[0]
             metadata['variable'] = dreq_matches[0].variable_request
         else:
@@ -314,13 +580,14 @@ def verify_fk_relationships(metadata):
                 logger.error(msg)
                 raise FileValidationError(msg)
             if plev_name:
-                plev_matches = dreq_matches.filter(
-                    variable_request__dimensions__icontains=plev_name
+                plev_matches = fk_resolver.get_data_requests(
+                    var_name=metadata['var_name'], dimension=plev_name,
+                    **dreq_keys
                 )
-                if plev_matches.count() == 1:
+                if len(plev_matches) == 1:
                     metadata['data_request'] = plev_matches[0]
                     metadata['variable'] = plev_matches[0].variable_request
-                elif plev_matches.count() == 0:
+                elif len(plev_matches) == 0:
                     msg = ('No data requests found with plev {} for file: {}.'.
                            format(plev_name, metadata['basename']))
                     logger.error(msg)
@@ -349,9 +616,8 @@ def update_database_submission(validated_metadata, data_sub, files_online=True,
     :param bool files_online: True if the files are online.
     :returns:
     """
-    for data_file in validated_metadata:
-        create_database_file_object(data_file, data_sub, files_online,
-                                    file_version)
+    bulk_create_database_file_objects(validated_metadata, data_sub,
+                                      files_online, file_version)
 
     data_sub.status = STATUS_VALUES['VALIDATED']
     data_sub.save()
@@ -389,25 +655,87 @@ def write_json_file(validated_metadata, filename):
     logger.debug('Metadata written to JSON file {}'.format(filename))
 
 
-def create_database_file_object(metadata, data_submission, file_online=True,
-                                file_version=None):
+def bulk_create_database_file_objects(validated_metadata, data_submission,
+                                      file_online=True, file_version=None):
     """
-    Create a database entry for a data file
+    Create database entries for many data files and their checksums. The
+    objects are created in memory and then inserted in chunks, with each
+    chunk in its own transaction. On PostgreSQL the files are loaded with
+    COPY. Any files that conflict with existing files are reported
+    individually. Signals aren't sent and so the statistics of the affected
+    data requests and the submission are recalculated afterwards, even if a
+    later chunk fails after earlier chunks have been committed.
 
-    :param dict metadata: This file's metadata.
+    :param list validated_metadata: A list containing the metadata dictionary
+        generated for each file
     :param pdata_app.models.DataSubmission data_submission: The parent data
         submission.
-    :param bool file_online: True if the file is online.
-    :param str file_version: The version string to apply to each file. The 
+    :param bool file_online: True if the files are online.
+    :param str file_version: The version string to apply to each file. The
         string from the incoming directory name or the current date is used
         if a string isn't supplied.
-    :returns:
+    :raises SubmissionError: if any of the files can't be created
     """
     # get a fresh DB connection after exiting from parallel operation
     django.db.connections.close_all()
 
     time_units = Settings.get_solo().standard_time_units
 
+    data_files = [_make_data_file(metadata, data_submission, file_online,
+                                  file_version, time_units)
+                  for metadata in validated_metadata]
+
+    conflicts = _find_conflicts(data_files)
+    if conflicts:
+        for data_file, reason in conflicts:
+            logger.error('Unable to submit file {}: {}'.format(data_file.name,
+                                                               reason))
+        msg = '{} files conflict with existing files'.format(len(conflicts))
+        raise SubmissionError(msg)
+
+    try:
+        for chunk in grouper(zip(validated_metadata, data_files),
+                             BULK_CREATE_CHUNK_SIZE):
+            chunk_metadata, chunk_files = zip(*chunk)
+            try:
+                with transaction.atomic():
+                    _insert_data_files(chunk_files, data_submission)
+                    Checksum.objects.bulk_create([
+                        Checksum(data_file=data_file,
+                                 checksum_value=metadata['checksum_value'],
+                                 checksum_type=metadata['checksum_type'])
+                        for metadata, data_file in zip(chunk_metadata,
+                                                       chunk_files)
+                        if metadata['checksum_value']
+                    ])
+            except django.db.utils.IntegrityError:
+                _report_integrity_errors(chunk_files)
+                raise SubmissionError('Unable to submit all of the files')
+    finally:
+        # the chunks that have already been committed must be included in
+        # the statistics even if a later chunk fails
+        refresh_statistics(
+            [data_file.data_request_id for data_file in data_files],
+            [data_submission.id]
+        )
+
+
+def _make_data_file(metadata, data_submission, file_online, file_version,
+                    time_units):
+    """
+    Make an unsaved DataFile object from a file's metadata.
+
+    :param dict metadata: This file's metadata.
+    :param pdata_app.models.DataSubmission data_submission: The parent data
+        submission.
+    :param bool file_online: True if the file is online.
+    :param str file_version: The version string to apply to the file or None
+        to use the string from the incoming directory name or the current
+        date.
+    :param str time_units: The standard time units.
+    :returns: the new file
+    :rtype: pdata_app.models.DataFile
+    """
     if file_version:
         version_string = file_version
     else:
@@ -424,46 +752,167 @@ def create_database_file_object(metadata, data_submission, file_online=True,
     # if the file isn't online (e.g. loaded from JSON) then directory is blank
     directory = metadata['directory'] if file_online else None
 
-    # create a data file. If the file already exists in the database with
-    # identical metadata then nothing happens. If the file exists but with
-    # slightly different metadata then django.db.utils.IntegrityError is
-    # raised
-    try:
-        data_file = DataFile.objects.create(
-            name=metadata['basename'],
-            incoming_name=metadata['basename'],
-            incoming_directory=metadata['directory'],
-            directory=directory, size=metadata['filesize'],
-            project=metadata['project'],
-            institute=metadata['institute'],
-            climate_model=metadata['climate_model'],
-            activity_id=metadata['activity_id'],
-            experiment=metadata['experiment'],
-            variable_request=metadata['variable'],
-            data_request=metadata['data_request'],
-            frequency=metadata['frequency'], rip_code=metadata['rip_code'],
-            start_time=pdt2num(metadata['start_date'], time_units,
-                               metadata['calendar']) if metadata['start_date']
-                                            else None,
-            end_time=pdt2num(metadata['end_date'], time_units,
-                             metadata['calendar'], start_of_period=False) if
-                             metadata['start_date'] else None,
-            time_units=time_units, calendar=metadata['calendar'],
-            version=version_string,
-            data_submission=data_submission, online=file_online,
-            grid=metadata.get('grid'),
-            tape_url = metadata.get('tape_url')
-        )
-    except django.db.utils.IntegrityError as exc:
-        msg = ('Unable to submit file {}: {}'.format(metadata['basename'],
-                                                     exc.__str__()))
-        logger.error(msg)
-        raise SubmissionError(msg)
+    data_file = DataFile(
+        name=metadata['basename'],
+        incoming_name=metadata['basename'],
+        incoming_directory=metadata['directory'],
+        directory=directory, size=metadata['filesize'],
+        project=metadata['project'],
+        institute=metadata['institute'],
+        climate_model=metadata['climate_model'],
+        activity_id=metadata['activity_id'],
+        experiment=metadata['experiment'],
+        variable_request=metadata['variable'],
+        data_request=metadata['data_request'],
+        frequency=metadata['frequency'], rip_code=metadata['rip_code'],
+        start_time=pdt2num(metadata['start_date'], time_units,
+                           metadata['calendar']) if metadata['start_date']
+                                        else None,
+        end_time=pdt2num(metadata['end_date'], time_units,
+                         metadata['calendar'], start_of_period=False) if
+                         metadata['start_date'] else None,
+        time_units=time_units, calendar=metadata['calendar'],
+        version=version_string,
+        data_submission=data_submission, online=file_online,
+        grid=metadata.get('grid'),
+        tape_url = metadata.get('tape_url')
+    )
+    # save() isn't called when the files are created in bulk
+    data_file.start_year, data_file.end_year = calculate_file_years(
+        data_file.start_time, data_file.end_time, data_file.time_units,
+        data_file.calendar
+    )
+    return data_file
 
-    if metadata['checksum_value']:
-        checksum = get_or_create(Checksum, data_file=data_file,
-                                 checksum_value=metadata['checksum_value'],
-                                 checksum_type=metadata['checksum_type'])
+
+def _find_conflicts(data_files):
+    """
+    Find any files that would break the unique constraint on name and
+    directory, either with existing files or with other new files.
+
+    :param list data_files: The new unsaved DataFile objects.
+    :returns: tuples of each conflicting file and the reason for the conflict
+    :rtype: list
+    """
+    conflicts = []
+    seen = set()
+    for data_file in data_files:
+        key = (data_file.name, data_file.directory)
+        if data_file.directory is not None and key in seen:
+            conflicts.append((data_file, 'file is included more than once'))
+        seen.add(key)
+
+    for chunk in grouper(data_files, NAME_QUERY_CHUNK_SIZE):
+        chunk = [data_file for data_file in chunk
+                 if data_file.directory is not None]
+        existing = set(DataFile.objects.filter(
+            name__in=[data_file.name for data_file in chunk]
+        ).values_list('name', 'directory'))
+        for data_file in chunk:
+            if (data_file.name, data_file.directory) in existing:
+                conflicts.append((data_file, 'file already exists in the '
+                                             'database'))
+
+    return conflicts
+
+
+def _insert_data_files(data_files, data_submission):
+    """
+    Insert new files into the database and set their primary keys. This must
+    be called inside a transaction.
+
+    :param list data_files: The new unsaved DataFile objects.
+    :param pdata_app.models.DataSubmission data_submission: The files' data
+        submission.
+    """
+    connection = django.db.connection
+    if connection.vendor == 'postgresql':
+        _copy_data_files(data_files, connection)
+    else:
+        DataFile.objects.bulk_create(data_files)
+
+    if all(data_file.pk for data_file in data_files):
+        return
+
+    # find the primary keys of the new files, which are unique within the
+    # submission by their name and incoming directory
+    file_ids = {
+        (name, incoming_directory): file_id
+        for name, incoming_directory, file_id in
+        DataFile.objects.filter(
+            data_submission=data_submission,
+            name__in=[data_file.name for data_file in data_files]
+        ).values_list('name', 'incoming_directory', 'id')
+    }
+    for data_file in data_files:
+        data_file.pk = file_ids[(data_file.name,
+                                 data_file.incoming_directory)]
+        data_file._state.adding = False
+
+
+def _copy_data_files(data_files, connection):
+    """
+    Load new files into a PostgreSQL database using COPY, which is much
+    faster than INSERT.
+
+    :param list data_files: The new unsaved DataFile objects.
+    :param connection: The PostgreSQL database connection.
+    """
+    fields = [field for field in DataFile._meta.concrete_fields
+              if not field.primary_key]
+    rows = io.StringIO()
+    for data_file in data_files:
+        rows.write('\t'.join([
+            _copy_value(field.get_db_prep_save(getattr(data_file,
+                                                       field.attname),
+                                               connection))
+            for field in fields
+        ]) + '\n')
+    rows.seek(0)
+
+    quote_name = connection.ops.quote_name
+    sql = 'COPY {} ({}) FROM STDIN'.format(
+        quote_name(DataFile._meta.db_table),
+        ', '.join([quote_name(field.column) for field in fields])
+    )
+    with connection.cursor() as cursor:
+        cursor.copy_expert(sql, rows)
+
+
+def _copy_value(value):
+    """
+    Convert a value to PostgreSQL's COPY text format.
+
+    :param value: The database value.
+    :returns: The value as text.
+    :rtype: str
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t').
+            replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def _report_integrity_errors(data_files):
+    """
+    Try to insert each file individually, rolling back afterwards, to find
+    and report which files caused an integrity error when a chunk of files
+    was inserted.
+
+    :param list data_files: The DataFile objects that couldn't be inserted.
+    """
+    for data_file in data_files:
+        data_file.pk = None
+        data_file._state.adding = True
+        try:
+            with transaction.atomic():
+                DataFile.objects.bulk_create([data_file])
+                transaction.set_rollback(True)
+        except django.db.utils.IntegrityError as exc:
+            logger.error('Unable to submit file {}: {}'.format(
+                data_file.name, exc.__str__()))
 
 
 def move_rejected_files(submission_dir):
@@ -602,9 +1051,12 @@ def add_tape_url(metadata, tape_base_url, submission_dir):
 
 def run_prepare(file_paths, num_processes):
     """
-    Run PrePARE on each file in the submission. Any failures are reported
-    as an error with the logging and an exception is raised at the end of
-    processing if one or more files has failed.
+    Run PrePARE on each file in the submission. The files are checked in
+    batches of files from the same MIP table so that PrePARE and its tables
+    are only loaded once per batch. The batches are run in parallel by a pool
+    of threads, each of which waits for its PrePARE process. Any failures are
+    reported as an error with the logging and an exception is raised at the
+    end of processing if one or more files has failed.
 
     :param list file_paths: The paths of the files in the submission's
         directory.
@@ -613,54 +1065,88 @@ def run_prepare(file_paths, num_processes):
     failed PrePARE's checks.
     """
     logger.debug('Starting PrePARE on {} files'.format(len(file_paths)))
-    jobs = []
-    manager = Manager()
-    params = manager.Queue()
-    file_failed = manager.Event()
-    if num_processes != 1:
-        for i in range(num_processes):
-            p = Process(target=_run_prepare, args=(params, file_failed))
-            jobs.append(p)
-            p.start()
-
-    for item in itertools.chain(file_paths, (None,) * num_processes):
-        params.put(item)
+    batches = _prepare_batches(file_paths, num_processes)
+    logger.debug('PrePARE will be run {} times'.format(len(batches)))
 
-    if num_processes == 1:
-        _run_prepare(params, file_failed)
-    else:
-        for j in jobs:
-            j.join()
-
-    if file_failed.is_set():
+    file_failed = False
+    pool = ThreadPool(num_processes)
+    try:
+        for failures in pool.imap_unordered(_run_prepare, batches):
+            for file_path, output in failures:
+                logger.error('File {} failed PrePARE\n{}'.format(file_path,
+                                                                 output))
+                file_failed = True
+    finally:
+        pool.close()
+        pool.join()
+
+    if file_failed:
         logger.error('Not all files passed PrePARE')
         raise SubmissionError()
 
     logger.debug('All files successfully checked by PrePARE')
 
 
-def _contents_hdf_check(cube, metadata, max_size=MAX_DATA_INTEGRITY_SIZE):
+def _prepare_batches(file_paths, num_processes):
+    """
+    Split the files into batches to check with PrePARE. All of the files in
+    each batch are from the same MIP table. The batches are made small
+    enough for every process to have some work to do. Files that PrePARE
+    can't check are not included.
+
+    :param list file_paths: The paths of the files to check.
+    :param int num_processes: The number of processes to use in parallel.
+    :returns: lists of the file paths in each batch
+    :rtype: list
+    """
+    tables = {}
+    for file_path in file_paths:
+        skip_this_var = False
+        for skip_var in SKIP_PREPARE_VARS:
+            if skip_var in file_path:
+                logger.debug('Skipping running PrePARE on {}'.
+                             format(file_path))
+                skip_this_var = True
+                break
+        if skip_this_var:
+            continue
+
+        # CMIP6 file names are <variable>_<table>_<model>_...
+        name_cmpts = os.path.basename(file_path).split('_')
+        table = name_cmpts[1] if len(name_cmpts) > 1 else ''
+        tables.setdefault(table, []).append(file_path)
+
+    num_files = sum([len(table_files) for table_files in tables.values()])
+    batch_size = min(PREPARE_BATCH_SIZE,
+                     max(-(-num_files // num_processes), 1))
+
+    batches = []
+    for table in sorted(tables):
+        for batch in grouper(tables[table], batch_size):
+            batches.append(list(batch))
+    return batches
+
+
+def _contents_hdf_check(metadata, memory_limit=DATA_INTEGRITY_MEMORY_LIMIT):
     """
-    Check that the entire data of the file can be read into memory without
-    any errors. Corrupt files typically generate an HDF error. Files larger
-    than `max_size` are not read and a warning is displayed. Most files are
-    under this limit, but those over are excessively slow to validate.
+    Check that all of the data in the file can be read without any errors.
+    Corrupt files typically generate an HDF error. Every variable is read in
+    slices so that no more than approximately `memory_limit` bytes are held
+    in memory at once, which allows files of any size to be checked.
 
-    :param iris.cube.Cube cube: The cube to check
     :param dict metadata: Metadata obtained from the file
-    :param int max_size: Files larger than this (in bytes) are not checked
+    :param int memory_limit: The maximum number of bytes to read at once
     :returns: True if file read ok.
     :raises FileValidationError: If there was any problem reading the data.
     """
-    if os.path.getsize(os.path.join(metadata['directory'],
-                                    metadata['basename'])) > max_size:
-        logger.warning('File {} is larger than {} bytes. File contents '
-                       'reading check not run.'.format(metadata['basename'],
-                                                       max_size))
-        return True
-
     try:
-        _data = cube.data
+        with Dataset(os.path.join(metadata['directory'],
+                                  metadata['basename'])) as rootgrp:
+            # the raw values are sufficient to check that the data can be
+            # decompressed
+            rootgrp.set_auto_maskandscale(False)
+            for variable in rootgrp.variables.values():
+                _read_variable(variable, memory_limit)
     except Exception:
         msg = 'Unable to read data from file {}.'.format(metadata['basename'])
         raise FileValidationError(msg)
@@ -668,44 +1154,163 @@ def _contents_hdf_check(cube, metadata, max_size=MAX_DATA_INTEGRITY_SIZE):
         return True
 
 
-def _run_prepare(params, file_failed):
+def _read_variable(variable, memory_limit, index=()):
+    """
+    Read all of the data in a netCDF variable, or the part of it selected by
+    `index`, in slices along its first remaining dimension. The slices are
+    aligned with the variable's HDF chunks so that each chunk is only
+    decompressed once. If a single chunk's slice would be larger than
+    `memory_limit` then each index of the dimension is read separately
+    instead, and so each chunk is decompressed once for every index along
+    this dimension that it spans.
+
+    :param netCDF4.Variable variable: The variable to read
+    :param int memory_limit: The maximum number of bytes to read at once
+    :param tuple index: The indices of the leading dimensions that have
+        already been selected
     """
-    Check a single file with PrePARE. This function is called in parallel by
-    multiprocessing.
+    shape = variable.shape[len(index):]
+    if not shape:
+        variable[index]
+        return
+
+    item_size = max(getattr(variable.dtype, 'itemsize', 1), 1)
+    slice_bytes = item_size
+    for length in shape[1:]:
+        slice_bytes *= length
+
+    chunking = variable.chunking()
+    if chunking == 'contiguous':
+        chunk_length = 1
+    else:
+        chunk_length = chunking[len(index)]
+
+    if slice_bytes * chunk_length > memory_limit and len(shape) > 1:
+        for dim_index in range(shape[0]):
+            _read_variable(variable, memory_limit, index + (dim_index,))
+        return
+
+    step = max(memory_limit // slice_bytes // chunk_length, 1) * chunk_length
+    for start in range(0, shape[0], step):
+        variable[index + (slice(start, start + step),)]
+
 
-    :param multiprocessing.Manager.Queue params: A queue, with each item being
-        the full path of a file in the submission to check.
-    :param multiprocessing.Manager.Event file_failed: If set then one or more
-        files has failed validation.
+def _run_prepare(file_paths):
     """
-    while True:
-        file_path = params.get()
+    Check a batch of files with PrePARE. If the batch fails then the files
+    that failed are found from PrePARE's report on each file. If the output
+    doesn't contain a report on every file in the batch, or doesn't report
+    any failures, then each of the files is checked again separately.
+
+    :param list file_paths: The full paths of the files to check.
+    :returns: tuples of the path of each file that failed and PrePARE's
+        output
+    :rtype: list
+    """
+    prep_res = _run_prepare_script(file_paths)
+    output = prep_res.stdout.decode('utf-8')
 
-        if file_path is None:
-            return
+    if _prepare_passed(prep_res):
+        return []
 
-        skip_this_var = False
-        for skip_var in SKIP_PREPARE_VARS:
-            if skip_var in file_path:
-                logger.debug('Skipping running PrePARE on {}'.
-                             format(file_path))
-                skip_this_var = True
-                break
-        if skip_this_var:
-            continue
+    if len(file_paths) == 1:
+        return [(file_paths[0], output)]
 
-        prepare_script = os.path.join(
-            os.path.dirname(os.path.realpath(__file__)),
-            'run_prepare.sh'
-        )
+    file_statuses = _prepare_file_statuses(output)
+    failures = [(file_path, output) for file_path in file_paths
+                if not file_statuses.get(file_path, True)]
+    if failures and set(file_paths).issubset(file_statuses):
+        return failures
+
+    logger.debug('Unable to find the files that failed in the output from a '
+                 'batch of {} files. Checking each file separately.'.
+                 format(len(file_paths)))
+    failures = []
+    for file_path in file_paths:
+        failures.extend(_run_prepare([file_path]))
+    return failures
+
+
+def _run_prepare_script(file_paths):
+    """
+    Run PrePARE on one or more files.
+
+    :param list file_paths: The full paths of the files to check, which must
+        all have the same data_specs_version.
+    :returns: the completed process
+    :rtype: subprocess.CompletedProcess
+    """
+    prepare_script = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        'run_prepare.sh'
+    )
+
+    return subprocess.run([prepare_script] + list(file_paths),
+                          stdout=subprocess.PIPE)
+
+
+def _prepare_passed(prep_res):
+    """
+    Determine whether all of the files checked by a run of PrePARE passed.
+    PrePARE's summary of the number of files with errors is checked as well
+    as its return code.
+
+    :param subprocess.CompletedProcess prep_res: The completed PrePARE run.
+    :returns: True if all of the files passed
+    :rtype: bool
+    """
+    if prep_res.returncode:
+        return False
+
+    num_errors = re.search(r'Number of files? with error\(s\): *(\d+)',
+                           prep_res.stdout.decode('utf-8'))
+    return num_errors is None or int(num_errors.group(1)) == 0
 
-        prep_res = subprocess.run([prepare_script, file_path],
-                                  stdout=subprocess.PIPE)
 
-        if prep_res.returncode:
-            logger.error('File {} failed PrePARE\n{}'.
-                         format(file_path, prep_res.stdout.decode('utf-8')))
-            file_failed.set()
+def _prepare_file_statuses(output):
+    """
+    Find PrePARE's report on each file from its output, which contains a
+    line like `CV SUCCESS :: <path>` or `CV FAIL :: <path>` for each file
+    that it checked.
+
+    :param str output: PrePARE's output.
+    :returns: the path of each file reported on as the key and True if it
+        passed as the value
+    :rtype: dict
+    """
+    # remove the colours from the output
+    output = re.sub(r'\x1b\[[0-9;]*m', '', output)
+    return {file_path: status == 'SUCCESS' for status, file_path in
+            re.findall(r'CV (SUCCESS|FAIL) *:: *(\S+)', output)}
+
+
+def _open_results_store(db_path, prepared):
+    """
+    :param str db_path: The path of the validation results store
+    :param bool prepared: True if the files are checked with PrePARE
+    :returns: the store or None if it can't be opened
+    :rtype: pdata_app.utils.validation_store.ValidationResultStore
+    """
+    try:
+        return ValidationResultStore(db_path, prepared)
+    except sqlite3.Error as exc:
+        logger.warning('Unable to open validation results store {}: {}. '
+                       'All files will be validated.'.format(db_path, exc))
+        return None
+
+
+def _remove_results_store(db_path):
+    """
+    Delete the validation results store once the submission's files have
+    been added to the database and so won't need to be validated again.
+
+    :param str db_path: The path of the validation results store
+    """
+    try:
+        os.remove(db_path)
+    except OSError as exc:
+        logger.warning('Unable to delete validation results store {}: {}'.
+                       format(db_path, exc.strerror))
 
 
 def _get_submission_object(submission_dir):
@@ -869,12 +1474,31 @@ def parse_args():
         'do not create a data submission', action='store_true')
     parser.add_argument('-n', '--no-prepare', help="don't run PrePARE",
                         action='store_true')
-    parser.add_argument('-d', '--data-limit', help='the maximum size of file '
-                                                   '(in bytes) to load into '
-                                                   'memory for an HDF '
-                                                   'integrity check (default: '
+    parser.add_argument('-d', '--data-limit', help='the maximum amount of '
+                                                   'data (in bytes) to load '
+                                                   'into memory at once '
+                                                   'during an HDF integrity '
+                                                   'check (default: '
                                                    '%(default)s)',
-                        type=int, default=MAX_DATA_INTEGRITY_SIZE)
+                        type=int, default=DATA_INTEGRITY_MEMORY_LIMIT)
+    parser.add_argument('--results-store', help='the SQLite file to record '
+                                                'the result of validating '
+                                                'each file in (default: a '
+                                                'file in {} that is deleted '
+                                                'once the submission has '
+                                                'been ingested)'.format(
+                                                    DEFAULT_STORE_DIR))
+    parser.add_argument('--revalidate', help='validate all files, even if '
+                                             'they passed validation in an '
+                                             'earlier run',
+                        action='store_true')
+    parser.add_argument('--verify-checksums', help='recalculate the '
+                                                   'checksums of files that '
+                                                   'passed validation in an '
+                                                   'earlier run rather than '
+                                                   'relying on their size and '
+                                                   'modification time',
+                        action='store_true')
     parser.add_argument('--version', action='version',
         version='%(prog)s {}'.format(__version__))
     args = parser.parse_args()
@@ -896,6 +1520,7 @@ def main(args):
     logger.debug('Project: %s', args.mip_era)
     logger.debug('Processes requested: %s', args.processes)
 
+    store_path = None
     try:
         if args.input:
             validated_metadata = read_json_file(args.input)
@@ -915,11 +1540,24 @@ def main(args):
                     logger.error(msg)
                     raise SubmissionError(msg)
 
+            new_files = remove_existing_files(data_files)
+
+            store_path = (args.results_store or
+                          default_store_path(submission_dir))
+            results_store = _open_results_store(store_path,
+                                                not args.no_prepare)
+            if results_store is not None and not args.revalidate:
+                validated_metadata, new_files = load_validated_files(
+                    new_files, results_store, args.verify_checksums)
+            else:
+                validated_metadata = []
+
             try:
                 if not args.no_prepare:
-                    run_prepare(data_files, args.processes)
-                validated_metadata = list(identify_and_validate(data_files,
-                    args.mip_era, args.processes, args.file_format))
+                    run_prepare(new_files, args.processes)
+                validated_metadata.extend(identify_and_validate(new_files,
+                    args.mip_era, args.processes, args.file_format,
+                    results_store))
             except SubmissionError:
                 if not args.validate_only and not args.output:
                     send_admin_rejection_email(data_sub)
@@ -927,6 +1565,12 @@ def main(args):
 
             logger.debug('%s files validated successfully',
                          len(validated_metadata))
+            bytes_read = [metadata['bytes_read']
+                          for metadata in validated_metadata
+                          if metadata.get('bytes_read') is not None]
+            if bytes_read:
+                logger.debug('%s bytes read from %s files during validation',
+                             sum(bytes_read), len(bytes_read))
 
             if args.validate_only:
                 logger.debug('Data submission not run (-v option specified)')
@@ -953,6 +1597,8 @@ def main(args):
                                        files_online, args.version_string)
             logger.debug('%s files submitted successfully',
                 match_one(DataSubmission, incoming_directory=submission_dir).get_data_files().count())
+            if store_path and not args.results_store:
+                _remove_results_store(store_path)
 
     except SubmissionError:
         sys.exit(1)
@@ -0,0 +1,230 @@
+"""
+test_auto_retrieve.py - unit tests for auto_retrieve.py
+"""
+from __future__ import unicode_literals, division, absolute_import
+import datetime
+import os
+import shutil
+import tempfile
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import django
+django.setup()
+
+from django.test import TestCase
+
+from pdata_app.models import (DataRequest, EmailQueue, RetrievalRequest,
+                              Settings)
+from pdata_app.tests.common import make_example_files
+from pdata_app.utils.dbapi import get_or_create
+from pdata_app.utils.tape_claims import RETRIEVAL_WAITING_EXIT_STATUS
+
+from scripts.auto_retrieve import (find_pending_retrievals, choose_retrievals,
+                                   adopt_running_retrievals,
+                                   reap_finished_retrievals,
+                                   complete_restored_retrievals,
+                                   PendingRetrieval,
+                                   RunningRetrieval, MASS, ELASTIC_TAPE,
+                                   RETRY_INTERVAL, WAITING_RETRY_INTERVAL)
+
+
+def _pending(retrieval_id, requester_id=1, priority=0, size=1,
+             tape_system=ELASTIC_TAPE):
+    return PendingRetrieval(retrieval_id, requester_id, priority,
+                            datetime.datetime(2020, 1, 1, 0, 0, retrieval_id),
+                            size, tape_system)
+
+
+def _running(retrieval_id, requester_id=1, tape_system=ELASTIC_TAPE):
+    return RunningRetrieval(retrieval_id, requester_id, tape_system, 1, None)
+
+
+class TestFindPendingRetrievals(TestCase):
+    def setUp(self):
+        make_example_files(self)
+        self.ret_mass = RetrievalRequest.objects.create(
+            requester=self.user, start_year=1000, end_year=3000)
+        self.ret_mass.data_request.add(self.dreq1, self.dreq2)
+        self.dreq_et = DataRequest.objects.get(id=self.dreq1.id)
+        self.dreq_et.id = None
+        self.dreq_et.institute = get_or_create(
+            self.dreq1.institute.__class__, short_name='CNRM',
+            full_name='CNRM'
+        )
+        self.dreq_et.save()
+        self.ret_et = RetrievalRequest.objects.create(
+            requester=self.user, start_year=1000, end_year=3000)
+        self.ret_et.data_request.add(self.dreq_et)
+
+    def test_tape_systems(self):
+        pending = find_pending_retrievals([MASS, ELASTIC_TAPE], set())
+        self.assertEqual(
+            {(ret.retrieval_id, ret.tape_system) for ret in pending},
+            {(self.ret_mass.id, MASS), (self.ret_et.id, ELASTIC_TAPE)}
+        )
+
+    def test_one_tape_system(self):
+        pending = find_pending_retrievals([MASS], set())
+        self.assertEqual([ret.retrieval_id for ret in pending],
+                         [self.ret_mass.id])
+
+    def test_offline_size(self):
+        pending = find_pending_retrievals([MASS], set())
+        self.assertEqual(pending[0].size, 12)
+
+    def test_mixed_skipped(self):
+        self.ret_mass.data_request.add(self.dreq_et)
+        pending = find_pending_retrievals([MASS, ELASTIC_TAPE], set())
+        self.assertEqual([ret.retrieval_id for ret in pending],
+                         [self.ret_et.id])
+
+    def test_excluded(self):
+        pending = find_pending_retrievals([MASS, ELASTIC_TAPE],
+                                          {self.ret_mass.id})
+        self.assertEqual([ret.retrieval_id for ret in pending],
+                         [self.ret_et.id])
+
+    def test_complete_skipped(self):
+        self.ret_et.date_complete = datetime.datetime(
+            2020, 1, 1, tzinfo=datetime.timezone.utc)
+        self.ret_et.save()
+        pending = find_pending_retrievals([MASS, ELASTIC_TAPE], set())
+        self.assertEqual([ret.retrieval_id for ret in pending],
+                         [self.ret_mass.id])
+
+
+class TestCompleteRestoredRetrievals(TestCase):
+    def setUp(self):
+        make_example_files(self)
+        self.user.first_name = 'Fred'
+        self.user.save()
+        get_or_create(self.user.__class__,
+                      username=Settings.get_solo().contact_user_id)
+        self.ret = RetrievalRequest.objects.create(
+            requester=self.user, start_year=1000, end_year=3000)
+        self.ret.data_request.add(self.dreq2)
+
+    def test_restored(self):
+        pending = find_pending_retrievals([MASS], set())
+        self.assertEqual([(ret.retrieval_id, ret.size) for ret in pending],
+                         [(self.ret.id, 0)])
+
+        complete_restored_retrievals([self.ret.id])
+
+        self.ret.refresh_from_db()
+        self.assertIsNotNone(self.ret.date_complete)
+        self.assertEqual(EmailQueue.objects.get().recipient, self.user)
+        self.assertEqual(find_pending_retrievals([MASS], set()), [])
+
+    def test_already_complete(self):
+        date_complete = datetime.datetime(2020, 1, 1,
+                                          tzinfo=datetime.timezone.utc)
+        self.ret.date_complete = date_complete
+        self.ret.save()
+
+        complete_restored_retrievals([self.ret.id])
+
+        self.ret.refresh_from_db()
+        self.assertEqual(self.ret.date_complete, date_complete)
+        self.assertEqual(EmailQueue.objects.count(), 0)
+
+
+class TestChooseRetrievals(TestCase):
+    def test_limits(self):
+        pending = [_pending(1), _pending(2), _pending(3, tape_system=MASS)]
+        chosen = choose_retrievals(pending, {}, {MASS: 1, ELASTIC_TAPE: 1},
+                                   4)
+        self.assertEqual([ret.retrieval_id for ret in chosen], [1, 3])
+
+    def test_running_counted(self):
+        pending = [_pending(1), _pending(2, tape_system=MASS)]
+        chosen = choose_retrievals(pending, {5: _running(5)},
+                                   {MASS: 2, ELASTIC_TAPE: 1}, 4)
+        self.assertEqual([ret.retrieval_id for ret in chosen], [2])
+
+    def test_max_retrievals(self):
+        pending = [_pending(1), _pending(2), _pending(3)]
+        chosen = choose_retrievals(pending, {5: _running(5)},
+                                   {ELASTIC_TAPE: 5}, 3)
+        self.assertEqual([ret.retrieval_id for ret in chosen], [1, 2])
+
+    def test_priority(self):
+        pending = [_pending(1), _pending(2, priority=1)]
+        chosen = choose_retrievals(pending, {}, {ELASTIC_TAPE: 1}, 4)
+        self.assertEqual([ret.retrieval_id for ret in chosen], [2])
+
+    def test_smallest_first(self):
+        pending = [_pending(1, size=10), _pending(2, size=5)]
+        chosen = choose_retrievals(pending, {}, {ELASTIC_TAPE: 2}, 4)
+        self.assertEqual([ret.retrieval_id for ret in chosen], [2, 1])
+
+    def test_fair_between_requesters(self):
+        pending = [_pending(1, requester_id=1), _pending(2, requester_id=1),
+                   _pending(3, requester_id=2, size=10)]
+        chosen = choose_retrievals(pending, {}, {ELASTIC_TAPE: 2}, 4)
+        self.assertEqual([ret.retrieval_id for ret in chosen], [1, 3])
+
+    def test_priority_before_fairness(self):
+        pending = [_pending(1, requester_id=1, priority=1),
+                   _pending(2, requester_id=2)]
+        chosen = choose_retrievals(pending, {5: _running(5, requester_id=1)},
+                                   {ELASTIC_TAPE: 2}, 4)
+        self.assertEqual([ret.retrieval_id for ret in chosen], [1])
+
+
+class TestLockFiles(TestCase):
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.lock_dir)
+
+        patch = mock.patch('scripts.auto_retrieve.logger')
+        self.mock_logger = patch.start()
+        self.addCleanup(patch.stop)
+
+        patch = mock.patch('scripts.auto_retrieve.pid_running')
+        self.mock_pid_running = patch.start()
+        self.addCleanup(patch.stop)
+        self.mock_pid_running.side_effect = lambda pid: pid == 100
+
+        patch = mock.patch('scripts.auto_retrieve.time.time')
+        self.mock_time = patch.start()
+        self.addCleanup(patch.stop)
+        self.mock_time.return_value = 1000
+
+        for retrieval_id, pid in ((1, 100), (2, 200)):
+            with open(os.path.join(self.lock_dir, 'retrieval_{}.lock'.
+                                   format(retrieval_id)), 'w') as fh:
+                fh.write('{} et 7\n'.format(pid))
+
+    def test_adopt(self):
+        running = adopt_running_retrievals(self.lock_dir)
+        self.assertEqual(running, {1: RunningRetrieval(1, 7, 'et', 100,
+                                                       None)})
+        self.assertEqual(os.listdir(self.lock_dir), ['retrieval_1.lock'])
+
+    def test_reap(self):
+        mock_process = mock.Mock()
+        mock_process.poll.return_value = 1
+        running = {1: RunningRetrieval(1, 7, 'et', 100, None),
+                   2: RunningRetrieval(2, 7, 'et', 200, mock_process)}
+        retry_times = {}
+        reap_finished_retrievals(running, self.lock_dir, retry_times)
+        self.assertEqual(list(running), [1])
+        self.assertEqual(retry_times, {2: 1000 + RETRY_INTERVAL})
+        self.assertEqual(os.listdir(self.lock_dir), ['retrieval_1.lock'])
+        self.mock_logger.error.assert_called_once()
+
+    def test_reap_waiting(self):
+        mock_process = mock.Mock()
+        mock_process.poll.return_value = RETRIEVAL_WAITING_EXIT_STATUS
+        running = {2: RunningRetrieval(2, 7, 'et', 200, mock_process)}
+        retry_times = {}
+        reap_finished_retrievals(running, self.lock_dir, retry_times)
+        self.assertEqual(running, {})
+        # the retrieval backs off rather than being run again at every poll
+        self.assertEqual(retry_times, {2: 1000 + WAITING_RETRY_INTERVAL})
+        self.assertEqual(os.listdir(self.lock_dir), ['retrieval_1.lock'])
+        self.mock_logger.error.assert_not_called()
@@ -0,0 +1,214 @@
+"""
+test_db_netcdf_housekeeping.py - unit tests for db_netcdf_housekeeping.py
+"""
+from __future__ import unicode_literals, division, absolute_import
+import os
+import shutil
+import tempfile
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import django
+django.setup()
+
+from django.test import TestCase
+
+from pdata_app.models import DataFile
+from pdata_app.tests.common import make_example_files
+from pdata_app.utils.common import construct_drs_path
+
+from scripts.db_netcdf_housekeeping import (load_file_map, save_changes,
+                                            scan_database,
+                                            scan_file_structure, FileRecord,
+                                            _scan_directory)
+
+
+class TestHousekeeping(TestCase):
+    def setUp(self):
+        make_example_files(self)
+        self.data_file4 = DataFile.objects.get(name='test4')
+        self.data_file8 = DataFile.objects.get(name='test8')
+
+        patch = mock.patch('scripts.db_netcdf_housekeeping.logger')
+        self.mock_logger = patch.start()
+        self.addCleanup(patch.stop)
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.base_dir = os.path.join(self.temp_dir, 'stream1')
+
+        patch = mock.patch('scripts.db_netcdf_housekeeping.BASE_OUTPUT_DIR',
+                           self.base_dir)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        patch = mock.patch('scripts.db_netcdf_housekeeping.is_same_gws')
+        self.mock_same_gws = patch.start()
+        self.addCleanup(patch.stop)
+        self.mock_same_gws.return_value = True
+
+    def _make_file(self, directory, name):
+        directory = os.path.join(self.temp_dir, directory)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        file_path = os.path.join(directory, name)
+        with open(file_path, 'w') as fh:
+            fh.write('data')
+        return file_path
+
+    def _move_db_file(self, data_file, directory, name=None):
+        data_file.directory = os.path.join(self.temp_dir, directory)
+        if name:
+            data_file.name = name
+        data_file.save()
+
+
+class TestLoadFileMap(TestHousekeeping):
+    def test_contents(self):
+        with self.assertNumQueries(1):
+            file_map = load_file_map()
+
+        self.assertEqual(set(file_map), {'test1', 'test2', 'test4', 'test8'})
+        self.assertEqual(file_map['test1'], [FileRecord(
+            self.data_file1.id, '/some/dir1', True,
+            self.data_file1.data_request_id,
+            self.data_file1.data_submission_id
+        )])
+
+    def test_duplicate_names(self):
+        self._move_db_file(self.data_file8, 'dir8', 'test4')
+
+        file_map = load_file_map()
+
+        self.assertEqual({record.id for record in file_map['test4']},
+                         {self.data_file4.id, self.data_file8.id})
+
+
+class TestScanDatabase(TestHousekeeping):
+    def test_missing_files(self):
+        self._make_file('dir1', 'test1')
+        self._move_db_file(self.data_file1, 'dir1')
+        self._move_db_file(self.data_file2, 'dir2')
+        file_map = load_file_map()
+        changes = {}
+
+        scan_database(file_map, changes, num_threads=2)
+        save_changes(changes)
+
+        self.assertEqual(list(changes), [self.data_file2.id])
+        self.data_file1.refresh_from_db()
+        self.assertTrue(self.data_file1.online)
+        self.data_file2.refresh_from_db()
+        self.assertFalse(self.data_file2.online)
+        self.assertIsNone(self.data_file2.directory)
+        self.dreq2.statistics.refresh_from_db()
+        self.assertEqual(self.dreq2.statistics.num_online, 0)
+
+    def test_symlink_created(self):
+        self.mock_same_gws.return_value = False
+        file_path = self._make_file('dir1', 'test1')
+        self._move_db_file(self.data_file1, 'dir1')
+        self._make_file('dir2', 'test2')
+        self._move_db_file(self.data_file2, 'dir2')
+        link_dir = os.path.join(self.base_dir,
+                                construct_drs_path(self.data_file2))
+        os.makedirs(link_dir)
+        os.symlink(os.path.join(self.temp_dir, 'dir2', 'test2'),
+                   os.path.join(link_dir, 'test2'))
+
+        scan_database(load_file_map(), {})
+
+        link_path = os.path.join(self.base_dir,
+                                 construct_drs_path(self.data_file1), 'test1')
+        self.assertEqual(os.readlink(link_path), file_path)
+        self.mock_logger.warning.assert_called_once_with(
+            'Created symlink for file test1 from {}'.format(link_path)
+        )
+
+
+class TestScanFileStructure(TestHousekeeping):
+    def test_file_changes(self):
+        # an offline file that is found on disk
+        self._make_file('stream1/a/b', 'test4.nc')
+        self._move_db_file(self.data_file4, 'old_dir', 'test4.nc')
+        # an online file that has moved
+        self._make_file('stream1/c', 'test1.nc')
+        self._move_db_file(self.data_file1, 'old_dir', 'test1.nc')
+        # an online file without a directory
+        self._make_file('stream1', 'test2.nc')
+        self.data_file2.name = 'test2.nc'
+        self.data_file2.directory = None
+        self.data_file2.save()
+        # a file that isn't in the database
+        self._make_file('stream1/a', 'unknown.nc')
+        file_map = load_file_map()
+        changes = {}
+
+        scan_file_structure(self.base_dir, file_map, changes, num_threads=2)
+        save_changes(changes)
+
+        self.assertEqual(set(changes), {self.data_file1.id,
+                                        self.data_file2.id,
+                                        self.data_file4.id})
+        for data_file, directory in ((self.data_file1, 'stream1/c'),
+                                     (self.data_file2, 'stream1'),
+                                     (self.data_file4, 'stream1/a/b')):
+            data_file.refresh_from_db()
+            self.assertTrue(data_file.online)
+            self.assertEqual(data_file.directory,
+                             os.path.realpath(os.path.join(self.temp_dir,
+                                                           directory)))
+        self.assertEqual(
+            file_map['test4.nc'][0].directory,
+            os.path.realpath(os.path.join(self.temp_dir, 'stream1/a/b'))
+        )
+        self.mock_logger.error.assert_called_once_with(
+            'File not found in database: {}'.format(
+                os.path.join(self.base_dir, 'a', 'unknown.nc'))
+        )
+
+    def test_broken_links(self):
+        # a link that can be replaced
+        file_path = self._make_file('gws2', 'test1.nc')
+        self._move_db_file(self.data_file1, 'gws2', 'test1.nc')
+        os.makedirs(os.path.join(self.base_dir, 'a'))
+        link_path = os.path.join(self.base_dir, 'a', 'test1.nc')
+        os.symlink(os.path.join(self.temp_dir, 'missing.nc'), link_path)
+        # a link to a file that doesn't exist
+        self.data_file2.name = 'test2.nc'
+        self.data_file2.directory = None
+        self.data_file2.save()
+        broken_path = os.path.join(self.base_dir, 'a', 'test2.nc')
+        os.symlink(os.path.join(self.temp_dir, 'missing.nc'), broken_path)
+        file_map = load_file_map()
+        changes = {}
+
+        scan_file_structure(self.base_dir, file_map, changes)
+        save_changes(changes)
+
+        self.assertEqual(os.readlink(link_path), file_path)
+        self.assertFalse(os.path.lexists(broken_path))
+        self.assertEqual(list(changes), [self.data_file2.id])
+        self.data_file2.refresh_from_db()
+        self.assertFalse(self.data_file2.online)
+
+    def test_single_project_tree(self):
+        # all of the files are below a single top-level directory
+        self._make_file('stream1/PRIMAVERA/a/b/c', 'test1.nc')
+        self._make_file('stream1/PRIMAVERA/a/d', 'test4.nc')
+        self._move_db_file(self.data_file1, 'old_dir', 'test1.nc')
+        self._move_db_file(self.data_file4, 'old_dir', 'test4.nc')
+        file_map = load_file_map()
+        changes = {}
+
+        with mock.patch('scripts.db_netcdf_housekeeping._scan_directory',
+                        wraps=_scan_directory) as mock_scan:
+            scan_file_structure(self.base_dir, file_map, changes,
+                                num_threads=4)
+
+        self.assertEqual(set(changes), {self.data_file1.id,
+                                        self.data_file4.id})
+        # every directory in the tree is listed in its own task
+        self.assertEqual(mock_scan.call_count, 6)
@@ -3,6 +3,9 @@ test_validate_data_submission.py - unit tests for retrieve_request.py
 """
 from __future__ import unicode_literals, division, absolute_import
 import datetime
+import os
+import shutil
+import tempfile
 try:
     from unittest import mock
 except ImportError:
@@ -15,15 +18,20 @@ from django.contrib.auth.models import User
 from django.test import TestCase
 from django.utils.timezone import make_aware
 
+from pdata_app.utils.common import construct_drs_path
 from pdata_app.utils.dbapi import get_or_create, match_one
+from pdata_app.utils.tape_claims import TapeUrlClaims
 from pdata_app.models import (Project, Institute, ClimateModel, ActivityId,
                               Experiment, VariableRequest, DataRequest,
                               RetrievalRequest, DataFile, DataSubmission,
-                              Settings)
+                              Settings, Checksum)
 from vocabs.vocabs import (CALENDARS, FREQUENCY_VALUES, STATUS_VALUES,
                            VARIABLE_TYPES)
 
-from scripts.retrieve_request import main, get_tape_url
+from scripts.retrieve_request import (main, get_tape_url, _verify_checksums,
+                                      plan_retrieval, count_missing_files,
+                                      claim_tapes, pipeline_et_files_into_drs,
+                                      find_unrestored_et_files)
 import scripts.retrieve_request
 
 
@@ -158,6 +166,7 @@ class TestIntegrationTests(TestCase):
             skip_checksums = True
             alternative = None
             incoming = False
+            pipeline = False
 
         self.mock_exists.side_effect = [
             False,  # if os.path.exists(retrieval_dir):
@@ -198,6 +207,7 @@ class TestIntegrationTests(TestCase):
             skip_checksums = True
             alternative = None
             incoming = False
+            pipeline = False
 
         self.mock_exists.side_effect = [
             # first tape_url
@@ -247,6 +257,7 @@ class TestIntegrationTests(TestCase):
             skip_checksums = True
             alternative = None
             incoming = False
+            pipeline = False
 
         ns = ArgparseNamespace()
 
@@ -268,6 +279,7 @@ class TestIntegrationTests(TestCase):
             skip_checksums = True
             alternative = None
             incoming = False
+            pipeline = False
 
         ns = ArgparseNamespace()
         self.assertRaises(SystemExit, main, ns)
@@ -287,13 +299,15 @@ class TestIntegrationTests(TestCase):
             skip_checksums = True
             alternative = '/gws/nopw/j04/primavera3/spare_dir'
             incoming = False
+            pipeline = False
 
         self.mock_exists.side_effect = [
             False,  # if os.path.exists(retrieval_dir):
             True,  # if not os.path.exists(extracted_file_path):
             True,  # if not os.path.exists(drs_dir):
             False,  # if os.path.exists(dest_file_path):
-            True  # if not os.path.exists(primary_path):
+            True,  # if not os.path.exists(primary_path):
+            False  # if not os.path.exists(primary_file):
         ]
 
         ns = ArgparseNamespace()
@@ -315,3 +329,465 @@ class TestIntegrationTests(TestCase):
             'MOHC/MY-MODEL/experiment/r1i1p1f1/my-table/my-var/gn/v12345678/'
             'file_one.nc'
         )
+
+    def test_alternative_dir_resumed(self):
+        ret_req = get_or_create(RetrievalRequest, requester=self.user,
+                                start_year=1000, end_year=3000, id=999999)
+        ret_req.data_request.add(self.dreq1)
+        ret_req.save()
+
+        class ArgparseNamespace(object):
+            retrieval_id = ret_req.id
+            no_restore = False
+            skip_checksums = True
+            alternative = '/gws/nopw/j04/primavera3/spare_dir'
+            incoming = False
+            pipeline = False
+
+        # a previous attempt moved the file and created the link but didn't
+        # update the database
+        self.mock_exists.side_effect = [
+            True,  # if not os.path.exists(retrieval_dir):
+            False,  # if not os.path.exists(extracted_file_path):
+            True,  # and not os.path.exists(dest_file_path):
+            True,  # if not os.path.exists(drs_dir):
+            True,  # if os.path.exists(dest_file_path):
+            True,  # if not os.path.exists(primary_path):
+            True  # if not os.path.exists(primary_file):
+        ]
+
+        ns = ArgparseNamespace()
+        get_tape_url('et:1234', [self.df1], ns)
+
+        self.mock_rename.assert_not_called()
+        self.mock_symlink.assert_not_called()
+        df = match_one(DataFile, name='file_one.nc')
+        self.assertTrue(df.online)
+        self.assertEqual(df.directory, '/gws/nopw/j04/primavera3/spare_dir/'
+                                       'CMIP6/HighResMIP/MOHC/MY-MODEL/'
+                                       'experiment/r1i1p1f1/my-table/my-var/'
+                                       'gn/v12345678')
+
+    def test_checksums_verified(self):
+        ret_req = get_or_create(RetrievalRequest, requester=self.user,
+                                start_year=1000, end_year=3000, id=999999)
+        ret_req.data_request.add(self.dreq1)
+        ret_req.save()
+
+        class ArgparseNamespace(object):
+            retrieval_id = ret_req.id
+            no_restore = False
+            skip_checksums = False
+            alternative = None
+            incoming = False
+            pipeline = False
+            checksum_threads = 2
+
+        Checksum.objects.create(data_file=self.df1, checksum_value='1',
+                                checksum_type='ADLER32')
+
+        self.mock_exists.side_effect = [
+            False,  # if os.path.exists(retrieval_dir):
+            True,  # if not os.path.exists(extracted_file_path):
+            True,  # if not os.path.exists(drs_dir):
+            False  # if os.path.exists(dest_file_path):
+        ]
+
+        ns = ArgparseNamespace()
+        with mock.patch('scripts.retrieve_request.adler32') as mock_adler:
+            mock_adler.return_value = '2'
+            get_tape_url('et:1234', [self.df1], ns)
+        # the restored file must be read rather than trusting the cache
+        mock_adler.assert_called_once_with(mock.ANY, use_cache=False)
+
+        df = match_one(DataFile, name='file_one.nc')
+        self.assertFalse(df.online)
+        self.assertIsNone(df.directory)
+
+    def test_plan_retrieval(self):
+        self.df3.size = 5
+        self.df3.save()
+        ret_req = get_or_create(RetrievalRequest, requester=self.user,
+                                start_year=1000, end_year=3000)
+        ret_req.data_request.add(self.dreq1, self.dreq2)
+
+        tapes, tape_sizes = plan_retrieval(ret_req)
+
+        self.assertEqual(list(tapes), ['et:8765', 'et:1234', 'et:5678'])
+        self.assertEqual(tapes['et:1234'], [self.df1])
+        self.assertEqual(tapes['et:5678'], [self.df2])
+        self.assertEqual(tapes['et:8765'], [self.df3])
+        self.assertEqual(tape_sizes, {'et:1234': 1, 'et:5678': 1,
+                                      'et:8765': 5})
+
+    def test_plan_retrieval_filtered(self):
+        self.df1.online = True
+        self.df1.save()
+        ret_req = get_or_create(RetrievalRequest, requester=self.user,
+                                start_year=1950, end_year=1950)
+        ret_req.data_request.add(self.dreq1, self.dreq2)
+
+        tapes, tape_sizes = plan_retrieval(ret_req)
+
+        self.assertEqual(tapes, {'et:5678': [self.df2]})
+
+    def test_plan_retrieval_queries(self):
+        ret_req = get_or_create(RetrievalRequest, requester=self.user,
+                                start_year=1000, end_year=3000)
+        ret_req.data_request.add(self.dreq1, self.dreq2)
+
+        with self.assertNumQueries(1):
+            tapes, _tape_sizes = plan_retrieval(ret_req)
+            drs_paths = [construct_drs_path(data_file)
+                         for data_files in tapes.values()
+                         for data_file in data_files]
+            [(data_file.incoming_directory, data_file.name)
+             for data_files in tapes.values() for data_file in data_files]
+
+        self.assertIn('CMIP6/HighResMIP/MOHC/MY-MODEL/experiment/r1i1p1f1/'
+                      'my-table/my-var/gn/v12345678', drs_paths)
+
+    def test_count_missing_files(self):
+        ret_req = get_or_create(RetrievalRequest, requester=self.user,
+                                start_year=1000, end_year=3000)
+        ret_req.data_request.add(self.dreq1, self.dreq2)
+        tapes, _tape_sizes = plan_retrieval(ret_req)
+        self.df2.online = True
+        self.df2.save()
+
+        self.assertEqual(count_missing_files(tapes), 2)
+
+
+class TestClaimTapes(TestCase):
+    """Test that tape URLs being restored by other retrievals are shared"""
+    def setUp(self):
+        self.claim_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.claim_dir)
+
+    def test_claim_tapes(self):
+        data_files = [mock.MagicMock(id=index) for index in range(4)]
+        TapeUrlClaims(self.claim_dir, 5).claim('et:5678', [1, 2])
+        tapes = {'et:1234': [data_files[0]],
+                 'et:5678': [data_files[1], data_files[3]],
+                 'et:8765': [data_files[2]]}
+
+        claimed_tapes, shared_tapes = claim_tapes(
+            tapes, TapeUrlClaims(self.claim_dir, 6)
+        )
+
+        self.assertEqual(claimed_tapes, {'et:1234': [data_files[0]],
+                                         'et:8765': [data_files[2]]})
+        # the file that the other retrieval isn't restoring is also waited
+        # for so that the URL isn't read from tape twice at once
+        self.assertEqual(shared_tapes, {'et:5678': [data_files[1],
+                                                    data_files[3]]})
+        self.assertEqual(TapeUrlClaims(self.claim_dir, 7).
+                         claimed_files('et:1234'), {0})
+
+
+class TestPipelineEtFiles(TestCase):
+    """Test that files are copied into the DRS as soon as they're restored"""
+    def setUp(self):
+        patch = mock.patch('scripts.retrieve_request.logger')
+        self.mock_logger = patch.start()
+        self.addCleanup(patch.stop)
+
+        patch = mock.patch('scripts.retrieve_request.time.sleep')
+        self.mock_sleep = patch.start()
+        self.addCleanup(patch.stop)
+
+        patch = mock.patch('scripts.retrieve_request.copy_et_files_into_drs')
+        self.mock_copy = patch.start()
+        self.addCleanup(patch.stop)
+
+        patch = mock.patch('scripts.retrieve_request.subprocess.Popen')
+        self.mock_popen = patch.start()
+        self.addCleanup(patch.stop)
+
+        self.retrieval_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.retrieval_dir)
+        os.makedirs(os.path.join(self.retrieval_dir, 'gws', 'incoming'))
+
+        self.data_files = [
+            mock.MagicMock(id=index, size=10,
+                           incoming_directory='/gws/incoming')
+            for index in range(2)
+        ]
+        for index, data_file in enumerate(self.data_files):
+            data_file.name = 'file{}.nc'.format(index)
+
+        patch = mock.patch('scripts.retrieve_request._verify_checksums')
+        self.mock_verify = patch.start()
+        self.addCleanup(patch.stop)
+        self.mock_verify.return_value = set()
+
+        class ArgparseNamespace(object):
+            incoming = False
+            skip_checksums = True
+        self.args = ArgparseNamespace()
+
+    def _write_file(self, index, size=10):
+        with open(os.path.join(self.retrieval_dir, 'gws', 'incoming',
+                               'file{}.nc'.format(index)), 'wb') as fh:
+            fh.write(b'a' * size)
+
+    def _set_polls(self, actions, return_code=0):
+        """
+        Make the et_get.py process call each of `actions` in turn each time
+        that it is polled and then finish with `return_code`.
+        """
+        process = self.mock_popen.return_value
+        process.returncode = return_code
+        actions = list(actions)
+
+        def poll():
+            if actions:
+                actions.pop(0)()
+                return None
+            return return_code
+        process.poll.side_effect = poll
+
+    def test_progressive(self):
+        self._set_polls([lambda: self._write_file(0),
+                         lambda: self._write_file(1, size=5),
+                         lambda: self._write_file(1),
+                         lambda: None])
+
+        pipeline_et_files_into_drs('et_get.py', self.data_files,
+                                   self.retrieval_dir, self.args)
+
+        self.assertEqual(self.mock_copy.call_args_list, [
+            mock.call([self.data_files[0]], self.retrieval_dir, self.args,
+                      verified_ids={0}),
+            mock.call([self.data_files[1]], self.retrieval_dir, self.args,
+                      verified_ids={1})
+        ])
+        self.assertEqual(self.mock_sleep.call_count, 4)
+        self.mock_verify.assert_not_called()
+
+    def test_size_must_be_stable(self):
+        # the file has its expected size at the last poll before et_get.py
+        # finishes and so it is only copied once et_get.py has finished
+        self._set_polls([lambda: self._write_file(0),
+                         lambda: self._write_file(0, size=5),
+                         lambda: self._write_file(0)])
+
+        pipeline_et_files_into_drs('et_get.py', self.data_files[:1],
+                                   self.retrieval_dir, self.args)
+
+        self.mock_copy.assert_called_once_with([self.data_files[0]],
+                                               self.retrieval_dir, self.args,
+                                               verified_ids=set())
+
+    def test_checksum_failure(self):
+        self.args.skip_checksums = False
+        self.mock_verify.return_value = {0}
+        self._set_polls([lambda: (self._write_file(0), self._write_file(1)),
+                         lambda: None, lambda: None, lambda: None])
+
+        pipeline_et_files_into_drs('et_get.py', self.data_files,
+                                   self.retrieval_dir, self.args)
+
+        self.mock_verify.assert_called_once_with([
+            (self.data_files[0], os.path.join(self.retrieval_dir, 'gws',
+                                              'incoming', 'file0.nc')),
+            (self.data_files[1], os.path.join(self.retrieval_dir, 'gws',
+                                              'incoming', 'file1.nc'))
+        ], self.args)
+        # the file that failed isn't checked again at the later polls but is
+        # copied and checked again after et_get.py has finished
+        self.assertEqual(self.mock_copy.call_args_list, [
+            mock.call([self.data_files[1]], self.retrieval_dir, self.args,
+                      verified_ids={1}),
+            mock.call([self.data_files[0]], self.retrieval_dir, self.args,
+                      verified_ids=set())
+        ])
+
+    def test_already_verified(self):
+        # file0 was restored and verified by a previous attempt
+        self.args.skip_checksums = False
+        self._set_polls([lambda: self._write_file(1), lambda: None])
+        self._write_file(0)
+
+        pipeline_et_files_into_drs('et_get.py', self.data_files,
+                                   self.retrieval_dir, self.args,
+                                   verified_ids={0})
+
+        self.mock_verify.assert_called_once_with([
+            (self.data_files[1], os.path.join(self.retrieval_dir, 'gws',
+                                              'incoming', 'file1.nc'))
+        ], self.args)
+        self.mock_copy.assert_called_once_with(self.data_files,
+                                               self.retrieval_dir, self.args,
+                                               verified_ids={0, 1})
+
+    def test_restored_after_finishing(self):
+        self._set_polls([], return_code=17)
+        self._write_file(0)
+        self._write_file(1)
+
+        pipeline_et_files_into_drs('et_get.py', self.data_files,
+                                   self.retrieval_dir, self.args)
+
+        self.mock_copy.assert_called_once_with(self.data_files,
+                                               self.retrieval_dir, self.args,
+                                               verified_ids=set())
+
+    def test_failure(self):
+        self._set_polls([lambda: self._write_file(0), lambda: None],
+                        return_code=1)
+
+        self.assertRaises(SystemExit, pipeline_et_files_into_drs,
+                          'et_get.py', self.data_files, self.retrieval_dir,
+                          self.args)
+
+        self.mock_copy.assert_called_once_with([self.data_files[0]],
+                                               self.retrieval_dir, self.args,
+                                               verified_ids={0})
+        self.mock_logger.error.assert_called_once()
+
+
+class TestFindUnrestoredEtFiles(TestCase):
+    """Test that files restored by a previous attempt aren't restored again"""
+    def setUp(self):
+        patch = mock.patch('scripts.retrieve_request.logger')
+        self.mock_logger = patch.start()
+        self.addCleanup(patch.stop)
+
+        patch = mock.patch('scripts.retrieve_request._verify_checksums')
+        self.mock_verify = patch.start()
+        self.addCleanup(patch.stop)
+        self.mock_verify.return_value = set()
+
+        patch = mock.patch('scripts.retrieve_request.construct_drs_path')
+        self.mock_drs_path = patch.start()
+        self.addCleanup(patch.stop)
+        self.mock_drs_path.return_value = 'drs'
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.retrieval_dir = os.path.join(self.temp_dir, 'retrieval')
+        os.makedirs(os.path.join(self.retrieval_dir, 'gws', 'incoming'))
+        os.makedirs(os.path.join(self.temp_dir, 'stream1', 'drs'))
+
+        self.data_files = [
+            mock.MagicMock(id=index, size=10,
+                           incoming_directory='/gws/incoming')
+            for index in range(3)
+        ]
+        for index, data_file in enumerate(self.data_files):
+            data_file.name = 'file{}.nc'.format(index)
+
+        class ArgparseNamespace(object):
+            incoming = False
+            skip_checksums = False
+            alternative = os.path.join(self.temp_dir, 'stream1')
+        self.args = ArgparseNamespace()
+
+    def _write_file(self, file_path, size=10):
+        with open(file_path, 'wb') as fh:
+            fh.write(b'a' * size)
+
+    def _extracted_path(self, index):
+        return os.path.join(self.retrieval_dir, 'gws', 'incoming',
+                            'file{}.nc'.format(index))
+
+    def _drs_path(self, index):
+        return os.path.join(self.temp_dir, 'stream1', 'drs',
+                            'file{}.nc'.format(index))
+
+    def test_none_restored(self):
+        self.assertEqual(find_unrestored_et_files(self.data_files,
+                                                  self.retrieval_dir,
+                                                  self.args),
+                         (self.data_files, set()))
+        self.mock_verify.assert_not_called()
+
+    def test_extracted(self):
+        self._write_file(self._extracted_path(0))
+        self._write_file(self._extracted_path(1), size=5)
+        self.assertEqual(find_unrestored_et_files(self.data_files,
+                                                  self.retrieval_dir,
+                                                  self.args),
+                         (self.data_files[1:], {0}))
+        self.mock_verify.assert_called_once_with(
+            [(self.data_files[0], self._extracted_path(0))], self.args
+        )
+
+    def test_in_drs(self):
+        self._write_file(self._drs_path(2))
+        self.assertEqual(find_unrestored_et_files(self.data_files,
+                                                  self.retrieval_dir,
+                                                  self.args),
+                         (self.data_files[:2], {2}))
+
+    def test_checksum_mismatch(self):
+        self._write_file(self._extracted_path(0))
+        self._write_file(self._drs_path(1))
+        self.mock_verify.return_value = {1}
+        self.assertEqual(find_unrestored_et_files(self.data_files,
+                                                  self.retrieval_dir,
+                                                  self.args),
+                         (self.data_files[1:], {0}))
+
+    def test_skip_checksums(self):
+        self.args.skip_checksums = True
+        self._write_file(self._extracted_path(0))
+        self.assertEqual(find_unrestored_et_files(self.data_files,
+                                                  self.retrieval_dir,
+                                                  self.args),
+                         (self.data_files[1:], {0}))
+        self.mock_verify.assert_not_called()
+
+
+class TestVerifyChecksums(TestCase):
+    """Test the concurrent checking of restored files' checksums"""
+    def setUp(self):
+        patch = mock.patch('scripts.retrieve_request.logger')
+        self.mock_logger = patch.start()
+        self.addCleanup(patch.stop)
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+        self.file_paths = []
+        for index in range(5):
+            data_file = mock.MagicMock(id=index)
+            file_path = os.path.join(self.temp_dir, 'file{}.nc'.format(index))
+            with open(file_path, 'wb') as fh:
+                fh.write(b'Wikipedia' * 1000)
+            self.file_paths.append((data_file, file_path))
+
+        class ArgparseNamespace(object):
+            incoming = False
+            checksum_threads = 2
+        self.args = ArgparseNamespace()
+
+        patch = mock.patch('scripts.retrieve_request.Checksum')
+        self.mock_checksum = patch.start()
+        self.addCleanup(patch.stop)
+        self.checksums = [
+            mock.MagicMock(data_file_id=index, checksum_type='ADLER32',
+                           checksum_value='4221634219')
+            for index in range(5)
+        ]
+        (self.mock_checksum.objects.filter.return_value.order_by.
+         return_value) = self.checksums
+
+    def test_all_match(self):
+        self.assertEqual(set(), _verify_checksums(self.file_paths, self.args))
+
+    def test_mismatches(self):
+        self.checksums[1].checksum_value = '1'
+        self.checksums[3].checksum_type = 'MD5'
+        self.assertEqual({1, 3}, _verify_checksums(self.file_paths,
+                                                   self.args))
+
+    def test_no_checksum(self):
+        self.checksums[4].checksum_value = '1'
+        del self.checksums[2]
+        self.assertEqual({4}, _verify_checksums(self.file_paths, self.args))
+        self.mock_logger.warning.assert_any_call(
+            'No checksum exists in the database. Skipping check for '
+            '{}'.format(self.file_paths[2][1])
+        )
@@ -1,9 +1,16 @@
 """
 test_validate_data_submission.py - unit tests for validate_data_submission.py
 """
+import os
+import shutil
+import subprocess
+import tempfile
+
+import django
 from django.contrib.auth.models import User
 from django.test import tag, TestCase
 import mock
+import numpy as np
 
 try:
     import iris
@@ -11,15 +18,22 @@ except ImportError:
     pass
 else:
     # Only import the validations if Iris is available
-    from scripts.validate_data_submission import update_database_submission
-from pdata_app.models import DataSubmission
+    from scripts.validate_data_submission import (
+        update_database_submission, bulk_create_database_file_objects,
+        remove_existing_files, _read_variable, _process_bytes_read,
+        _prepare_batches, _run_prepare, run_prepare, load_validated_files,
+        _record_results, SubmissionError)
+from pdata_app.models import Checksum, DataFile, DataSubmission
+from pdata_app.tests.common import make_example_files
 from pdata_app.utils.dbapi import get_or_create
+from pdata_app.utils.validation_store import ValidationResultStore
 from vocabs.vocabs import STATUS_VALUES
 
 
 @tag('validation')
 class TestUpdateDatabaseSubmission(TestCase):
-    @mock.patch('scripts.validate_data_submission.create_database_file_object')
+    @mock.patch('scripts.validate_data_submission.'
+                'bulk_create_database_file_objects')
     def setUp(self, mock_create_file):
         self.mock_create_file = mock_create_file
         user = get_or_create(User, username='fred')
@@ -34,5 +48,359 @@ class TestUpdateDatabaseSubmission(TestCase):
         self.assertEqual(self.ds.status, 'VALIDATED')
 
     def test_create_db_file_called(self):
-        self.mock_create_file.assert_called_once_with(self.metadata[0],
+        self.mock_create_file.assert_called_once_with(self.metadata,
                                                       self.ds, True, None)
+
+
+@tag('validation')
+class TestBulkCreateDatabaseFileObjects(TestCase):
+    def setUp(self):
+        make_example_files(self)
+        self.dsub = get_or_create(DataSubmission,
+                                  incoming_directory='/new/incoming/20200101',
+                                  directory='/new/incoming/20200101',
+                                  user=self.user)
+        self.metadata = [
+            self._make_metadata('new{}.nc'.format(index))
+            for index in range(5)
+        ]
+
+    def _make_metadata(self, basename):
+        return {
+            'basename': basename,
+            'directory': '/new/incoming/20200101',
+            'filesize': 10,
+            'project': self.dreq1.project,
+            'institute': self.dreq1.institute,
+            'climate_model': self.dreq1.climate_model,
+            'activity_id': self.data_file1.activity_id,
+            'experiment': self.dreq1.experiment,
+            'variable': self.dreq1.variable_request,
+            'data_request': self.dreq1,
+            'frequency': 'mon',
+            'rip_code': 'r1i1p1f1',
+            'start_date': None,
+            'end_date': None,
+            'calendar': '360_day',
+            'grid': 'gn',
+            'checksum_type': 'ADLER32',
+            'checksum_value': '1234',
+        }
+
+    @mock.patch('scripts.validate_data_submission.BULK_CREATE_CHUNK_SIZE', 2)
+    def test_files_created(self):
+        bulk_create_database_file_objects(self.metadata, self.dsub)
+        new_files = DataFile.objects.filter(data_submission=self.dsub)
+        self.assertEqual(5, new_files.count())
+        self.assertEqual('v20200101', new_files.first().version)
+        self.assertEqual(5, Checksum.objects.filter(
+            data_file__in=new_files).count())
+        for data_file in new_files:
+            self.assertEqual(data_file.name,
+                             data_file.checksum_set.first().data_file.name)
+
+    def test_no_checksum(self):
+        self.metadata[0]['checksum_value'] = None
+        bulk_create_database_file_objects(self.metadata, self.dsub)
+        self.assertEqual(4, Checksum.objects.filter(
+            data_file__data_submission=self.dsub).count())
+
+    def test_statistics(self):
+        bulk_create_database_file_objects(self.metadata, self.dsub)
+        self.dsub.statistics.refresh_from_db()
+        self.assertEqual(5, self.dsub.statistics.num_files)
+        self.assertEqual(50, self.dsub.statistics.total_size)
+
+    @mock.patch('scripts.validate_data_submission.logger')
+    def test_conflicts(self, mock_logger):
+        self.metadata.append(self._make_metadata('new1.nc'))
+        self.assertRaises(SubmissionError, bulk_create_database_file_objects,
+                          self.metadata, self.dsub)
+        mock_logger.error.assert_called_with(
+            'Unable to submit file new1.nc: file is included more than once'
+        )
+        self.assertFalse(DataFile.objects.filter(
+            data_submission=self.dsub).exists())
+
+    @mock.patch('scripts.validate_data_submission.BULK_CREATE_CHUNK_SIZE', 2)
+    @mock.patch('scripts.validate_data_submission._report_integrity_errors')
+    def test_statistics_after_failure(self, mock_report):
+        import scripts.validate_data_submission as validate
+        insert_data_files = validate._insert_data_files
+        calls = []
+
+        def fail_second_chunk(data_files, data_submission):
+            calls.append(data_files)
+            if len(calls) == 2:
+                raise django.db.utils.IntegrityError()
+            insert_data_files(data_files, data_submission)
+
+        with mock.patch('scripts.validate_data_submission._insert_data_files',
+                        side_effect=fail_second_chunk):
+            self.assertRaises(SubmissionError,
+                              bulk_create_database_file_objects,
+                              self.metadata, self.dsub)
+
+        self.dsub.statistics.refresh_from_db()
+        self.assertEqual(2, self.dsub.statistics.num_files)
+        self.assertEqual(20, self.dsub.statistics.total_size)
+
+
+@tag('validation')
+class TestRemoveExistingFiles(TestCase):
+    def setUp(self):
+        make_example_files(self)
+
+    @mock.patch('scripts.validate_data_submission.logger')
+    def test_existing_removed(self, mock_logger):
+        filenames = ['/incoming/new1.nc',
+                     '/incoming/{}'.format(self.data_file1.name),
+                     '/incoming/new2.nc']
+        self.assertEqual(['/incoming/new1.nc', '/incoming/new2.nc'],
+                         remove_existing_files(filenames))
+        mock_logger.warning.assert_called_once_with(
+            'File failed validation. File {} already exists in the '
+            'database.'.format(self.data_file1.name)
+        )
+
+    @mock.patch('scripts.validate_data_submission.NAME_QUERY_CHUNK_SIZE', 1)
+    def test_chunked(self):
+        filenames = ['/incoming/{}'.format(self.data_file1.name),
+                     '/incoming/{}'.format(self.data_file2.name),
+                     '/incoming/new1.nc']
+        with self.assertNumQueries(3):
+            self.assertEqual(['/incoming/new1.nc'],
+                             remove_existing_files(filenames))
+
+
+class FakeVariable(object):
+    """
+    A netCDF4.Variable that records the indices that are read from it.
+    """
+    def __init__(self, shape, chunking, dtype=np.float32):
+        self.shape = shape
+        self._chunking = chunking
+        self.dtype = np.dtype(dtype)
+        self.reads = []
+
+    def chunking(self):
+        return self._chunking
+
+    def __getitem__(self, index):
+        self.reads.append(index)
+
+
+@tag('validation')
+class TestReadVariable(TestCase):
+    def test_chunk_aligned(self):
+        variable = FakeVariable((10, 4, 5), [2, 4, 5])
+        _read_variable(variable, 400)
+        self.assertEqual(variable.reads, [(slice(0, 4),), (slice(4, 8),),
+                                          (slice(8, 12),)])
+
+    def test_contiguous(self):
+        variable = FakeVariable((10, 4, 5), 'contiguous')
+        _read_variable(variable, 250)
+        self.assertEqual(variable.reads, [(slice(0, 3),), (slice(3, 6),),
+                                          (slice(6, 9),), (slice(9, 12),)])
+
+    def test_large_slices_split(self):
+        variable = FakeVariable((2, 4, 5), [1, 2, 5])
+        _read_variable(variable, 50)
+        self.assertEqual(variable.reads, [(0, slice(0, 2)), (0, slice(2, 4)),
+                                          (1, slice(0, 2)), (1, slice(2, 4))])
+
+    def test_scalar(self):
+        variable = FakeVariable((), 'contiguous')
+        _read_variable(variable, 50)
+        self.assertEqual(variable.reads, [()])
+
+
+@tag('validation')
+class TestProcessBytesRead(TestCase):
+    @mock.patch('scripts.validate_data_submission.open',
+                mock.mock_open(read_data='rchar: 1234\nwchar: 56\n'))
+    def test_bytes_read(self):
+        self.assertEqual(1234, _process_bytes_read())
+
+    @mock.patch('scripts.validate_data_submission.open')
+    def test_unavailable(self, mock_open):
+        mock_open.side_effect = IOError()
+        self.assertIsNone(_process_bytes_read())
+
+
+@tag('validation')
+class TestPrepareBatches(TestCase):
+    def test_grouped_by_table(self):
+        file_paths = ['/a/tas_Amon_m_e_r1i1p1f1_gn_1950-1950.nc',
+                      '/a/psl_day_m_e_r1i1p1f1_gn_1950-1950.nc',
+                      '/a/ua_Amon_m_e_r1i1p1f1_gn_1950-1950.nc']
+        self.assertEqual(_prepare_batches(file_paths, 1), [
+            ['/a/tas_Amon_m_e_r1i1p1f1_gn_1950-1950.nc',
+             '/a/ua_Amon_m_e_r1i1p1f1_gn_1950-1950.nc'],
+            ['/a/psl_day_m_e_r1i1p1f1_gn_1950-1950.nc']
+        ])
+
+    def test_skipped(self):
+        file_paths = ['/a/tas_Amon_m_e_r1i1p1f1_gn_1950-1950.nc',
+                      '/a/tas_Primday_m_e_r1i1p1f1_gn_1950-1950.nc']
+        self.assertEqual(_prepare_batches(file_paths, 1), [
+            ['/a/tas_Amon_m_e_r1i1p1f1_gn_1950-1950.nc']
+        ])
+
+    @mock.patch('scripts.validate_data_submission.PREPARE_BATCH_SIZE', 3)
+    def test_batch_size(self):
+        file_paths = ['/a/tas_Amon_m_e_r1i1p1f1_gn_{}.nc'.format(year)
+                      for year in range(8)]
+        batches = _prepare_batches(file_paths, 2)
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 2])
+
+    def test_spread_over_processes(self):
+        file_paths = ['/a/tas_Amon_m_e_r1i1p1f1_gn_{}.nc'.format(year)
+                      for year in range(8)]
+        batches = _prepare_batches(file_paths, 4)
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 2, 2])
+
+
+@tag('validation')
+class TestRunPrepare(TestCase):
+    def setUp(self):
+        patch = mock.patch('scripts.validate_data_submission.'
+                           '_run_prepare_script')
+        self.mock_script = patch.start()
+        self.addCleanup(patch.stop)
+
+    def _result(self, return_code, num_errors, statuses=()):
+        output = ''.join('\x1b[91m\u2514\u2500\u2500> :: CV {:<7} :: {}'
+                         '\x1b[0m\n'.format(status, file_path)
+                         for file_path, status in statuses)
+        output += 'Number of file with error(s): {}\n'.format(num_errors)
+        return subprocess.CompletedProcess([], return_code,
+                                           output.encode('utf-8'))
+
+    def test_batch_passes(self):
+        self.mock_script.return_value = self._result(0, 0)
+        self.assertEqual(_run_prepare(['/a/1.nc', '/a/2.nc']), [])
+        self.mock_script.assert_called_once_with(['/a/1.nc', '/a/2.nc'])
+
+    def test_batch_fails(self):
+        result = self._result(1, 1, [('/a/1.nc', 'SUCCESS'),
+                                     ('/a/2.nc', 'FAIL')])
+        self.mock_script.return_value = result
+        self.assertEqual(_run_prepare(['/a/1.nc', '/a/2.nc']),
+                         [('/a/2.nc', result.stdout.decode('utf-8'))])
+        self.mock_script.assert_called_once_with(['/a/1.nc', '/a/2.nc'])
+
+    def test_output_not_parsed(self):
+        self.mock_script.side_effect = [self._result(1, 1),
+                                        self._result(0, 0),
+                                        self._result(1, 1)]
+        self.assertEqual(
+            _run_prepare(['/a/1.nc', '/a/2.nc']),
+            [('/a/2.nc', 'Number of file with error(s): 1\n')]
+        )
+        self.mock_script.assert_has_calls([
+            mock.call(['/a/1.nc', '/a/2.nc']),
+            mock.call(['/a/1.nc']),
+            mock.call(['/a/2.nc'])
+        ])
+
+    def test_errors_counted(self):
+        self.mock_script.return_value = self._result(0, 1)
+        self.assertEqual(_run_prepare(['/a/1.nc']),
+                         [('/a/1.nc', 'Number of file with error(s): 1\n')])
+
+    @mock.patch('scripts.validate_data_submission.logger')
+    def test_run_prepare(self, mock_logger):
+        self.mock_script.side_effect = [
+            self._result(1, 1, [('/a/tas_Amon_1.nc', 'FAIL')]),
+            self._result(0, 0)
+        ]
+        self.assertRaises(SubmissionError, run_prepare,
+                          ['/a/tas_Amon_1.nc', '/a/tas_day_1.nc'], 2)
+        mock_logger.error.assert_any_call(
+            'File /a/tas_Amon_1.nc failed PrePARE\n{}'.format(
+                self._result(1, 1, [('/a/tas_Amon_1.nc', 'FAIL')]).
+                stdout.decode('utf-8'))
+        )
+
+
+@tag('validation')
+class TestValidationResults(TestCase):
+    def setUp(self):
+        make_example_files(self)
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.store = ValidationResultStore(os.path.join(self.temp_dir,
+                                                        'results.db'))
+        self.file_paths = []
+        for index in range(2):
+            file_path = os.path.join(self.temp_dir, 'file{}.nc'.format(index))
+            with open(file_path, 'wb') as fh:
+                fh.write(b'Wikipedia')
+            self.file_paths.append(file_path)
+        self.metadata = {
+            'basename': 'file0.nc',
+            'project': self.dreq1.project,
+            'data_request': self.dreq1,
+            'checksum_type': 'ADLER32',
+            'checksum_value': '300286872'
+        }
+
+    def _record(self, metadata):
+        results = [(self.file_paths[0], os.stat(self.file_paths[0]),
+                    metadata),
+                   (self.file_paths[1], os.stat(self.file_paths[1]), None)]
+        return list(_record_results(results, self.store))
+
+    def test_passed_reused(self):
+        self.assertEqual([self.metadata], self._record(self.metadata))
+        validated, to_validate = load_validated_files(self.file_paths,
+                                                      self.store)
+        self.assertEqual(to_validate, [self.file_paths[1]])
+        self.assertEqual(validated, [self.metadata])
+
+    def test_checksum_not_recalculated(self):
+        self._record(self.metadata)
+        with mock.patch('scripts.validate_data_submission.get_checksums') \
+                as mock_checksums:
+            validated, to_validate = load_validated_files(self.file_paths,
+                                                          self.store)
+        mock_checksums.assert_not_called()
+        self.assertEqual(validated, [self.metadata])
+
+    def test_checksum_changed(self):
+        self.metadata['checksum_value'] = '1'
+        self._record(self.metadata)
+        validated, to_validate = load_validated_files(
+            self.file_paths, self.store, verify_checksums=True
+        )
+        self.assertEqual(to_validate, self.file_paths)
+        self.assertEqual(validated, [])
+
+    def test_file_changed(self):
+        self._record(self.metadata)
+        with open(self.file_paths[0], 'ab') as fh:
+            fh.write(b'more')
+        validated, to_validate = load_validated_files(self.file_paths,
+                                                      self.store)
+        self.assertEqual(to_validate, self.file_paths)
+
+    def test_object_deleted(self):
+        self.metadata['data_request'] = self.dreq3
+        self._record(self.metadata)
+        self.dreq3.delete()
+        validated, to_validate = load_validated_files(self.file_paths,
+                                                      self.store)
+        self.assertEqual(to_validate, self.file_paths)
+
+    def test_objects_loaded_once(self):
+        results = [(file_path, os.stat(file_path), self.metadata)
+                   for file_path in self.file_paths]
+        list(_record_results(results, self.store))
+        with self.assertNumQueries(4):
+            validated, to_validate = load_validated_files(self.file_paths,
+                                                          self.store)
+        self.assertEqual(2, len(validated))
+        self.assertIs(validated[0]['data_request'],
+                      validated[1]['data_request'])